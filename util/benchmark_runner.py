@@ -0,0 +1,882 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2022 Mischback
+# SPDX-License-Identifier: MIT
+# SPDX-FileType: SOURCE
+
+"""Run benchmarks against a mail server setup."""
+
+
+# Python imports
+import argparse
+import logging
+import logging.config
+import os
+import sys
+import time
+from typing import Any
+
+# app imports
+from mailsrv_aux.common import parser
+from mailsrv_aux.common.exceptions import MailsrvBaseException
+from mailsrv_aux.common.log import LOGGING_DEFAULT_CONFIG, add_level
+from mailsrv_aux.test_suite.benchmark import (
+    AuthStormBenchmark,
+    CipherHandshakeBenchmark,
+    TransferModeBenchmark,
+)
+from mailsrv_aux.test_suite.capacity import (
+    MODES,
+    PROTOCOLS,
+    CapacityCurve,
+    ConcurrencyCeilingProbe,
+    load_curves,
+    log_curve_comparison,
+    save_curves,
+)
+from mailsrv_aux.test_suite.eventlog import EventLog
+from mailsrv_aux.test_suite.latency import (
+    PATH_MAILBOX,
+    PATH_SUBMISSION,
+    DeliveryLatencyPoller,
+)
+from mailsrv_aux.test_suite.limits import SizeLimitProbe, SubmissionSizeLimitProbe
+from mailsrv_aux.test_suite.lmtp import LMTP_PORT, LmtpDeliveryBenchmark
+from mailsrv_aux.test_suite.load import AdaptiveLoadTestSuite, AimdRateController
+from mailsrv_aux.test_suite.maildir import (
+    DEFAULT_HOME_TEMPLATE,
+    MaildirVerifyMailGotDelivered,
+    expand_home,
+)
+from mailsrv_aux.test_suite.messages import (
+    KIND_TEXT,
+    MESSAGE_KINDS,
+    MessageFactory,
+    SizeDistribution,
+    parse_size,
+)
+from mailsrv_aux.test_suite.parallel import verify_mailboxes
+from mailsrv_aux.test_suite.pop3 import VerifyMailGotDelivered
+from mailsrv_aux.test_suite.tls import create_session_context, log_handshake_stats
+
+# get a module-level logger
+logger = logging.getLogger()
+
+# add the VERBOSE / SUMMARY log levels
+add_level("VERBOSE", logging.INFO - 1)
+add_level("SUMMARY", logging.INFO + 1)
+
+
+def benchmark_ciphers(args: argparse.Namespace) -> None:
+    """Benchmark the STARTTLS handshake for Postfix's cipher list."""
+    ciphers = parser.PostfixMainCfParser(args.postfix_main_cf).get_cipherlist(
+        args.cipherlist_parameter
+    )
+    logger.debug("ciphers: %r", ciphers)
+
+    for port in args.ports:
+        CipherHandshakeBenchmark(
+            target_ip=args.target_host,
+            target_port=port,
+            ciphers=ciphers,
+            handshakes=args.handshakes,
+        ).run()
+
+
+def benchmark_auth_storm(args: argparse.Namespace) -> None:
+    """Stress the SASL authentication with concurrent logins."""
+    dovecot_passwd = parser.PasswdFileParser(args.dovecot_userdb)
+
+    credentials = {}
+    for username in dovecot_passwd.get_usernames():
+        password = dovecot_passwd.get_plain_password(username)
+        if password is None:
+            logger.verbose("Skipping '%s', no plain text password", username)  # type: ignore [attr-defined]
+            continue
+        credentials[username] = password
+    logger.debug("credentials for: %r", list(credentials))
+
+    tls_context = None if args.no_tls_resumption else create_session_context()
+
+    AuthStormBenchmark(
+        target_ip=args.target_host,
+        target_port=args.port,
+        credentials=credentials,
+        attempts=args.attempts,
+        concurrency=args.concurrency,
+        invalid_ratio=args.invalid_ratio,
+        repeat_ratio=args.repeat_ratio,
+        mechanism=args.mechanism,
+        seed=args.seed,
+        tls_context=tls_context,
+    ).run()
+
+    log_handshake_stats(tls_context)
+
+
+def benchmark_load(args: argparse.Namespace) -> None:
+    """Send mails at an adaptive rate to find the sustainable throughput."""
+    postfix_vmailboxes = parser.KeyParser(args.postfix_vmailboxes).get_values()
+    postfix_valiases = parser.KeyValueParser(args.postfix_valiases).get_values()
+    recipients = postfix_vmailboxes + list(postfix_valiases.keys())
+    logger.debug("recipients: %r", recipients)
+
+    event_log = None if args.event_log is None else EventLog(args.event_log)
+    try:
+        AdaptiveLoadTestSuite(
+            target_ip=args.target_host,
+            target_port=args.port,
+            recipients=recipients,
+            messages=args.messages,
+            starttls=args.starttls,
+            controller=AimdRateController(
+                initial_rate=args.initial_rate, max_rate=args.max_rate
+            ),
+            max_retries=args.max_retries,
+            message_factory=MessageFactory(
+                sizes=SizeDistribution.parse(args.message_sizes, seed=args.seed),
+                kinds=args.message_kinds,
+                seed=args.seed,
+            ),
+            event_log=event_log,
+        ).run()
+    finally:
+        if event_log is not None:
+            event_log.close()
+
+
+def benchmark_transfer(args: argparse.Namespace) -> None:
+    """Compare the throughput of DATA, BDAT and 8BITMIME."""
+    TransferModeBenchmark(
+        target_ip=args.target_host,
+        target_port=args.port,
+        recipient=args.recipient,
+        messages=args.messages,
+        message_factory=MessageFactory(
+            sizes=SizeDistribution.parse(args.message_sizes, seed=args.seed),
+            kinds=args.message_kinds,
+            seed=args.seed,
+        ),
+        modes=args.modes,
+        chunk_sizes=[parse_size(size) for size in args.chunk_sizes],
+        starttls=args.starttls,
+    ).run()
+
+
+def benchmark_size_limit(args: argparse.Namespace) -> None:
+    """Discover the effective message size limits on the MTA and submission path."""
+    dovecot_passwd = parser.PasswdFileParser(args.dovecot_userdb)
+
+    probe_args: dict[str, Any] = {
+        "target_ip": args.target_host,
+        "recipient": args.recipient,
+        "min_size": parse_size(args.min_size),
+        "max_size": parse_size(args.max_size),
+        "resolution": parse_size(args.resolution),
+        "declare_size": not args.no_size_declaration,
+    }
+
+    probes: list[SizeLimitProbe] = [
+        SizeLimitProbe(target_port=args.port, starttls=args.starttls, **probe_args)
+    ]
+    if args.submission_user is not None:
+        password = dovecot_passwd.get_plain_password(args.submission_user)
+        if password is None:
+            logger.error("Did not find plain text password")
+            password = ""
+        probes.append(
+            SubmissionSizeLimitProbe(
+                target_port=args.submission_port,
+                username=args.submission_user,
+                password=password,
+                from_address=args.submission_user,
+                **probe_args,
+            )
+        )
+
+    protocols = [probe.run() for probe in probes]
+
+    if not args.verify_delivery:
+        return
+
+    # Check the delivery of the accepted probes; probes, that did not show up,
+    # were rejected during delivery (LMTP / quota)
+    password = dovecot_passwd.get_plain_password(args.recipient)
+    if password is None:
+        logger.error("Did not find plain text password")
+        password = ""
+
+    for probe, protocol in zip(probes, protocols):
+        path = PATH_SUBMISSION if probe.origin == PATH_SUBMISSION else PATH_MAILBOX
+        report = DeliveryLatencyPoller(
+            {args.recipient: [(tag, path) for tag in probe.result.accepted]},
+            protocol,
+            {args.recipient: password},
+            target_ip=args.target_host,
+            target_port=args.pop3_port,
+            timeout=args.delivery_timeout,
+        ).run()
+        probe.result.apply_delivery(report.missing.get(args.recipient, []))
+        logger.summary("%s", probe.result)  # type: ignore [attr-defined]
+
+
+def benchmark_lmtp(args: argparse.Namespace) -> None:
+    """Deliver mails to Dovecot's LMTP service directly, bypassing Postfix."""
+    dovecot_passwd = parser.PasswdFileParser(args.dovecot_userdb)
+    dovecot_users = set(dovecot_passwd.get_usernames())
+    postfix_vmailboxes = parser.KeyParser(args.postfix_vmailboxes).get_values()
+
+    # LMTP only accepts the actual mailboxes
+    recipients = [mailbox for mailbox in postfix_vmailboxes if mailbox in dovecot_users]
+    logger.debug("recipients: %r", recipients)
+
+    suite = LmtpDeliveryBenchmark(
+        target_ip=args.target_host if args.socket is None else args.socket,
+        target_port=args.port,
+        recipients=recipients,
+        messages=args.messages,
+        recipients_per_message=args.recipients_per_message,
+        message_factory=MessageFactory(
+            sizes=SizeDistribution.parse(args.message_sizes, seed=args.seed),
+            kinds=args.message_kinds,
+            seed=args.seed,
+        ),
+        concurrency=args.concurrency,
+        seed=args.seed,
+    )
+    protocol = suite.run()
+
+    if not args.verify_delivery:
+        return
+
+    # LMTP replies after the message is stored, so all accepted mails have to
+    # be present already.
+    verify_suites: list[Any] = []
+    for rcpt, subjects in protocol.get_accepted().items():
+        if args.maildir is not None:
+            home = dovecot_passwd.get_home(rcpt) or expand_home(args.maildir, rcpt)
+            verify_suites.append(
+                MaildirVerifyMailGotDelivered(
+                    username=rcpt,
+                    maildir=os.path.join(home, "Maildir"),
+                    expected_messages=subjects,
+                    suite_name="Verify messages in Maildir Test Suite ({})".format(
+                        rcpt
+                    ),
+                )
+            )
+            continue
+
+        password = dovecot_passwd.get_plain_password(rcpt)
+        if password is None:
+            logger.error("Did not find plain text password")
+            password = ""
+        verify_suites.append(
+            VerifyMailGotDelivered(
+                target_ip=args.target_host,
+                target_port=args.pop3_port,
+                username=rcpt,
+                password=password,
+                expected_messages=subjects,
+                suite_name="Verify messages in Mailbox Test Suite ({})".format(rcpt),
+            )
+        )
+    verify_mailboxes(verify_suites, max_workers=args.concurrency)
+
+
+def benchmark_capacity(args: argparse.Namespace) -> None:
+    """Ramp concurrent sessions to find the concurrency ceilings."""
+    targets = []
+    for target in args.targets:
+        protocol, _, port = target.partition(":")
+        if protocol not in PROTOCOLS or not port.isdigit():
+            logger.error("Invalid target: '%s'", target)
+            raise ConcurrencyCeilingProbe.CapacityProbeError("Invalid target")
+        targets.append((protocol, int(port)))
+
+    baseline = None if args.baseline is None else load_curves(args.baseline)
+
+    curves: list[CapacityCurve] = []
+    for protocol, port in targets:
+        for mode in args.modes:
+            if curves:
+                # Let the server release the processes of the last probe
+                time.sleep(args.pause)
+
+            curves.append(
+                ConcurrencyCeilingProbe(
+                    target_ip=args.target_host,
+                    target_port=port,
+                    protocol=protocol,
+                    mode=mode,
+                    step=args.step,
+                    max_sessions=args.max_sessions,
+                    latency_threshold=args.latency_threshold,
+                    stall_timeout=args.stall_timeout,
+                    label=args.label,
+                ).run()
+            )
+
+    if args.output is not None:
+        save_curves(curves, args.output)
+    if baseline is not None:
+        log_curve_comparison(baseline, curves)
+
+
+if __name__ == "__main__":
+    # setup the logging module
+    logging.config.dictConfig(LOGGING_DEFAULT_CONFIG)
+
+    # find the script's path
+    my_dir = os.path.dirname(os.path.realpath(__file__))
+    test_config_dir = os.path.join(my_dir, "test_configs")
+
+    # prepare the argument parser
+    arg_parser = argparse.ArgumentParser(
+        description="Run benchmarks against a mail server setup"
+    )
+
+    # mandatory arguments (positional arguments)
+    arg_parser.add_argument(
+        "target_host", action="store", help="IP address of the system under test (SUT)"
+    )
+
+    # optional arguments (keyword arguments)
+    arg_parser.add_argument(
+        "-d", "--debug", action="store_true", help="Enable debug messages"
+    )
+    arg_parser.add_argument(
+        "-v",
+        "--verbose",
+        action="count",
+        default=0,
+        help="Be more verbose; may be specified up to two times",
+    )
+
+    benchmarks = arg_parser.add_subparsers(
+        title="benchmarks", dest="benchmark", required=True
+    )
+
+    # Benchmark: TLS cipher suites
+    bench_ciphers = benchmarks.add_parser(
+        "ciphers", help="Measure the STARTTLS handshake per cipher suite"
+    )
+    bench_ciphers.set_defaults(func=benchmark_ciphers)
+    bench_ciphers.add_argument(
+        "--postfix-main-cf",
+        action="store",
+        default=os.path.join(test_config_dir, "postfix_main.cf"),
+        help="Specify Postfix's (rendered) main.cf",
+    )
+    bench_ciphers.add_argument(
+        "--cipherlist-parameter",
+        action="store",
+        default="tls_medium_cipherlist",
+        help="The parameter of main.cf that provides the cipher list",
+    )
+    bench_ciphers.add_argument(
+        "--ports",
+        action="store",
+        default=[25, 587],
+        nargs="+",
+        type=int,
+        help="The ports to benchmark",
+    )
+    bench_ciphers.add_argument(
+        "--handshakes",
+        action="store",
+        default=20,
+        type=int,
+        help="The number of handshakes per cipher suite and port",
+    )
+
+    # Benchmark: SMTP AUTH storm
+    bench_auth = benchmarks.add_parser(
+        "auth-storm", help="Stress SMTP AUTH with concurrent logins"
+    )
+    bench_auth.set_defaults(func=benchmark_auth_storm)
+    bench_auth.add_argument(
+        "--dovecot-userdb",
+        action="store",
+        default=os.path.join(test_config_dir, "dovecot_vmail_users"),
+        help="Specify a Dovecot user database file (passwd-like file)",
+    )
+    bench_auth.add_argument(
+        "--port",
+        action="store",
+        default=587,
+        type=int,
+        help="The submission port",
+    )
+    bench_auth.add_argument(
+        "--attempts",
+        action="store",
+        default=500,
+        type=int,
+        help="The overall number of login attempts",
+    )
+    bench_auth.add_argument(
+        "--concurrency",
+        action="store",
+        default=50,
+        type=int,
+        help="The number of concurrent connections",
+    )
+    bench_auth.add_argument(
+        "--invalid-ratio",
+        action="store",
+        default=0.1,
+        type=float,
+        help="The share of invalid logins",
+    )
+    bench_auth.add_argument(
+        "--repeat-ratio",
+        action="store",
+        default=0.3,
+        type=float,
+        help="The share of repeated logins of the same account",
+    )
+    bench_auth.add_argument(
+        "--mechanism",
+        action="store",
+        default="PLAIN",
+        choices=["PLAIN", "LOGIN"],
+        help="The SASL mechanism",
+    )
+    bench_auth.add_argument(
+        "--seed",
+        action="store",
+        default=0,
+        type=int,
+        help="Seed for the generation of the login attempts",
+    )
+    bench_auth.add_argument(
+        "--no-tls-resumption",
+        action="store_true",
+        help="Perform a full TLS handshake on every connection",
+    )
+
+    # Benchmark: adaptive load
+    bench_load = benchmarks.add_parser(
+        "load", help="Send mails at a rate adapting to temporary failures"
+    )
+    bench_load.set_defaults(func=benchmark_load)
+    bench_load.add_argument(
+        "--postfix-vmailboxes",
+        action="store",
+        default=os.path.join(test_config_dir, "postfix_vmailboxes"),
+        help="Specify a Postfix virtual mailbox file",
+    )
+    bench_load.add_argument(
+        "--postfix-valiases",
+        action="store",
+        default=os.path.join(test_config_dir, "postfix_valiases"),
+        help="Specify a Postfix virtual alias file",
+    )
+    bench_load.add_argument(
+        "--port",
+        action="store",
+        default=25,
+        type=int,
+        help="The SMTP port",
+    )
+    bench_load.add_argument(
+        "--messages",
+        action="store",
+        default=1000,
+        type=int,
+        help="The number of mails to send",
+    )
+    bench_load.add_argument(
+        "--initial-rate",
+        action="store",
+        default=10.0,
+        type=float,
+        help="The initial send rate in mails per second",
+    )
+    bench_load.add_argument(
+        "--max-rate",
+        action="store",
+        default=1000.0,
+        type=float,
+        help="The maximum send rate in mails per second",
+    )
+    bench_load.add_argument(
+        "--max-retries",
+        action="store",
+        default=5,
+        type=int,
+        help="The number of retries per deferred mail",
+    )
+    bench_load.add_argument(
+        "--starttls",
+        action="store_true",
+        help="Use STARTTLS before sending",
+    )
+    bench_load.add_argument(
+        "--message-sizes",
+        action="store",
+        default="1k",
+        help="The distribution of message sizes, e.g. '1k:50,100k:30,5m:20'",
+    )
+    bench_load.add_argument(
+        "--message-kinds",
+        action="store",
+        default=[KIND_TEXT],
+        nargs="+",
+        choices=MESSAGE_KINDS,
+        help="The kinds of messages to send",
+    )
+    bench_load.add_argument(
+        "--seed",
+        action="store",
+        default=0,
+        type=int,
+        help="Seed for the message sizes and kinds",
+    )
+    bench_load.add_argument(
+        "--event-log",
+        action="store",
+        default=None,
+        help="Write the events to this file (JSON lines) instead of keeping them in memory",
+    )
+
+    # Benchmark: transfer modes
+    bench_transfer = benchmarks.add_parser(
+        "transfer", help="Compare the throughput of DATA, BDAT and 8BITMIME"
+    )
+    bench_transfer.set_defaults(func=benchmark_transfer)
+    bench_transfer.add_argument(
+        "recipient",
+        action="store",
+        help="The recipient of the mails",
+    )
+    bench_transfer.add_argument(
+        "--port",
+        action="store",
+        default=25,
+        type=int,
+        help="The SMTP port",
+    )
+    bench_transfer.add_argument(
+        "--messages",
+        action="store",
+        default=20,
+        type=int,
+        help="The number of mails per mode",
+    )
+    bench_transfer.add_argument(
+        "--message-sizes",
+        action="store",
+        default="1m",
+        help="The distribution of message sizes, e.g. '100k:50,5m:50'",
+    )
+    bench_transfer.add_argument(
+        "--message-kinds",
+        action="store",
+        default=[KIND_TEXT],
+        nargs="+",
+        choices=MESSAGE_KINDS,
+        help="The kinds of messages to send",
+    )
+    bench_transfer.add_argument(
+        "--seed",
+        action="store",
+        default=0,
+        type=int,
+        help="Seed for the message sizes and kinds",
+    )
+    bench_transfer.add_argument(
+        "--modes",
+        action="store",
+        default=list(TransferModeBenchmark.MODES),
+        nargs="+",
+        choices=TransferModeBenchmark.MODES,
+        help="The transfer modes to benchmark",
+    )
+    bench_transfer.add_argument(
+        "--chunk-sizes",
+        action="store",
+        default=["64k", "1m"],
+        nargs="+",
+        help="The BDAT chunk sizes",
+    )
+    bench_transfer.add_argument(
+        "--starttls",
+        action="store_true",
+        help="Use STARTTLS before sending",
+    )
+
+    # Benchmark: size limits
+    bench_size = benchmarks.add_parser(
+        "size-limit", help="Discover the effective message size limits"
+    )
+    bench_size.set_defaults(func=benchmark_size_limit)
+    bench_size.add_argument(
+        "recipient",
+        action="store",
+        help="The recipient of the probes",
+    )
+    bench_size.add_argument(
+        "--dovecot-userdb",
+        action="store",
+        default=os.path.join(test_config_dir, "dovecot_vmail_users"),
+        help="Specify a Dovecot user database file (passwd-like file)",
+    )
+    bench_size.add_argument(
+        "--port",
+        action="store",
+        default=25,
+        type=int,
+        help="The SMTP port",
+    )
+    bench_size.add_argument(
+        "--starttls",
+        action="store_true",
+        help="Use STARTTLS on the SMTP port",
+    )
+    bench_size.add_argument(
+        "--submission-user",
+        action="store",
+        default=None,
+        help="Probe the submission path, too, authenticating as this user",
+    )
+    bench_size.add_argument(
+        "--submission-port",
+        action="store",
+        default=587,
+        type=int,
+        help="The submission port",
+    )
+    bench_size.add_argument(
+        "--min-size",
+        action="store",
+        default="1k",
+        help="The lower bound of the search",
+    )
+    bench_size.add_argument(
+        "--max-size",
+        action="store",
+        default="64m",
+        help="The upper bound of the search",
+    )
+    bench_size.add_argument(
+        "--resolution",
+        action="store",
+        default="64k",
+        help="The precision of the search",
+    )
+    bench_size.add_argument(
+        "--no-size-declaration",
+        action="store_true",
+        help="Do not declare the message size with MAIL FROM",
+    )
+    bench_size.add_argument(
+        "--verify-delivery",
+        action="store_true",
+        help="Check the recipient's mailbox (POP3) for the accepted probes",
+    )
+    bench_size.add_argument(
+        "--pop3-port",
+        action="store",
+        default=110,
+        type=int,
+        help="The POP3 port",
+    )
+    bench_size.add_argument(
+        "--delivery-timeout",
+        action="store",
+        default=120.0,
+        type=float,
+        help="Seconds to wait for the delivery of the accepted probes",
+    )
+
+    # Benchmark: LMTP delivery
+    bench_lmtp = benchmarks.add_parser(
+        "lmtp", help="Measure Dovecot's delivery throughput, bypassing Postfix"
+    )
+    bench_lmtp.set_defaults(func=benchmark_lmtp)
+    bench_lmtp.add_argument(
+        "--dovecot-userdb",
+        action="store",
+        default=os.path.join(test_config_dir, "dovecot_vmail_users"),
+        help="Specify a Dovecot user database file (passwd-like file)",
+    )
+    bench_lmtp.add_argument(
+        "--postfix-vmailboxes",
+        action="store",
+        default=os.path.join(test_config_dir, "postfix_vmailboxes"),
+        help="Specify a Postfix virtual mailbox file",
+    )
+    bench_lmtp.add_argument(
+        "--port",
+        action="store",
+        default=LMTP_PORT,
+        type=int,
+        help="The LMTP port",
+    )
+    bench_lmtp.add_argument(
+        "--socket",
+        action="store",
+        default=None,
+        help="Connect to this UNIX socket instead of the LMTP port, "
+        "e.g. /var/spool/postfix/socket/dovecot/lmtp",
+    )
+    bench_lmtp.add_argument(
+        "--messages",
+        action="store",
+        default=1000,
+        type=int,
+        help="The number of mails to deliver",
+    )
+    bench_lmtp.add_argument(
+        "--recipients-per-message",
+        action="store",
+        default=1,
+        type=int,
+        help="The number of recipients of every mail",
+    )
+    bench_lmtp.add_argument(
+        "--concurrency",
+        action="store",
+        default=4,
+        type=int,
+        help="The number of concurrent connections",
+    )
+    bench_lmtp.add_argument(
+        "--message-sizes",
+        action="store",
+        default="1k",
+        help="The distribution of message sizes, e.g. '1k:50,100k:30,5m:20'",
+    )
+    bench_lmtp.add_argument(
+        "--message-kinds",
+        action="store",
+        default=[KIND_TEXT],
+        nargs="+",
+        choices=MESSAGE_KINDS,
+        help="The kinds of messages to send",
+    )
+    bench_lmtp.add_argument(
+        "--seed",
+        action="store",
+        default=0,
+        type=int,
+        help="Seed for the recipients, message sizes and kinds",
+    )
+    bench_lmtp.add_argument(
+        "--verify-delivery",
+        action="store_true",
+        help="Check the mailboxes (POP3) for the delivered mails",
+    )
+    bench_lmtp.add_argument(
+        "--pop3-port",
+        action="store",
+        default=110,
+        type=int,
+        help="The POP3 port",
+    )
+    bench_lmtp.add_argument(
+        "--maildir",
+        action="store",
+        nargs="?",
+        const=DEFAULT_HOME_TEMPLATE,
+        default=None,
+        metavar="HOME_TEMPLATE",
+        help="Verify the delivery by reading the Maildirs on this host instead of "
+        "using POP3 (default: {})".format(DEFAULT_HOME_TEMPLATE.replace("%", "%%")),
+    )
+
+    # Benchmark: concurrency ceilings
+    bench_capacity = benchmarks.add_parser(
+        "capacity", help="Ramp concurrent sessions to find the concurrency ceilings"
+    )
+    bench_capacity.set_defaults(func=benchmark_capacity)
+    bench_capacity.add_argument(
+        "--targets",
+        action="store",
+        default=["smtp:25", "smtp:587", "pop3:110"],
+        nargs="+",
+        help="The services to probe, as <protocol>:<port>",
+    )
+    bench_capacity.add_argument(
+        "--modes",
+        action="store",
+        default=list(MODES),
+        nargs="+",
+        choices=MODES,
+        help="The kinds of sessions",
+    )
+    bench_capacity.add_argument(
+        "--step",
+        action="store",
+        default=10,
+        type=int,
+        help="The number of sessions to add per step",
+    )
+    bench_capacity.add_argument(
+        "--max-sessions",
+        action="store",
+        default=500,
+        type=int,
+        help="The maximum number of concurrent sessions",
+    )
+    bench_capacity.add_argument(
+        "--latency-threshold",
+        action="store",
+        default=1.0,
+        type=float,
+        help="The acceptable 95th percentile of the latency in seconds",
+    )
+    bench_capacity.add_argument(
+        "--stall-timeout",
+        action="store",
+        default=10.0,
+        type=float,
+        help="Consider a session stalled after this number of seconds",
+    )
+    bench_capacity.add_argument(
+        "--pause",
+        action="store",
+        default=5.0,
+        type=float,
+        help="Seconds to wait between the probes",
+    )
+    bench_capacity.add_argument(
+        "--label",
+        action="store",
+        default="",
+        help="A label for the curves, e.g. the revision of the configuration",
+    )
+    bench_capacity.add_argument(
+        "--output",
+        action="store",
+        default=None,
+        help="Write the capacity curves to this file (JSON)",
+    )
+    bench_capacity.add_argument(
+        "--baseline",
+        action="store",
+        default=None,
+        help="Compare the ceilings with the curves of this file",
+    )
+
+    args = arg_parser.parse_args()
+
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+        logger.debug("DEBUG messages enabled")
+    elif args.verbose == 1:
+        logger.setLevel(logging.INFO)
+    elif args.verbose == 2:
+        logger.setLevel(logging.VERBOSE)  # type: ignore [attr-defined]
+        logger.verbose("Verbose logging enabled")  # type: ignore [attr-defined]
+
+    try:
+        args.func(args)
+        logger.summary("Benchmark completed successfully!")  # type: ignore [attr-defined]
+        sys.exit(0)
+    except MailsrvBaseException as e:
+        logger.critical("Execution failed!")
+        logger.debug(e, exc_info=True)  # noqa: G200
+        sys.exit(1)
@@ -7,6 +7,7 @@
 # Python imports
 import collections
 import logging
+import re
 from typing import Any, Optional, Tuple
 
 # local imports
@@ -76,6 +77,47 @@ class PasswdFileParser(GenericFileReader):
             logger.error("No entry for '%s' in userdb", username)
             raise MailsrvParserException("Missing entry in userdb")
 
+    def get_plain_password(self, username: str) -> Optional[str]:
+        """Return the plain text password for a given user.
+
+        Parameters
+        ----------
+        username : str
+            Specify the user to get the password for.
+
+        Returns
+        -------
+        str, Optional
+            The password without its ``{plain}`` scheme prefix or ``None``, if
+            the password is not stored as plain text.
+        """
+        password = self.get_password(username)
+
+        if not password.startswith("{plain}"):
+            return None
+
+        return password.removeprefix("{plain}")
+
+    def get_home(self, username: str) -> Optional[str]:
+        """Return the home directory of a given user.
+
+        Parameters
+        ----------
+        username : str
+            Specify the user to get the home directory for.
+
+        Returns
+        -------
+        str, Optional
+            The home directory or ``None``, if the field is empty (and Dovecot
+            falls back to its ``default_fields``).
+        """
+        try:
+            return self._user_db[username]["home"] or None
+        except KeyError:
+            logger.error("No entry for '%s' in userdb", username)
+            raise MailsrvParserException("Missing entry in userdb")
+
 
 class KeyParser(GenericFileReader):
     """Parse plain-text configuration files that only provide keys.
@@ -130,6 +172,68 @@ class KeyValueParser(GenericFileReader):
         return result
 
 
+class PostfixMainCfParser(GenericFileReader):
+    """Parse Postfix's ``main.cf``.
+
+    Every *parameter* is specified as ``name = value``. Lines starting with
+    whitespace continue the value of the previous parameter. As
+    ``GenericFileReader`` strips the lines, every line that does not look like
+    a parameter assignment is considered a continuation line.
+
+    The values are not expanded, so references to other parameters like
+    ``$myhostname`` are returned as they are.
+    """
+
+    _parameter = re.compile(r"^([a-z0-9_]+)\s*=\s*(.*)$")
+
+    def get_values(self) -> dict[str, str]:
+        """Return the parameters and their values.
+
+        Returns
+        -------
+        dict
+            A ``dict``, using the parameter names as keys. Values that are
+            spread over several lines are joined by a single blank.
+        """
+        result: dict[str, str] = {}
+        current = None
+        for line in self._raw_lines:
+            match = self._parameter.match(line)
+            if match is not None:
+                current = match.group(1)
+                result[current] = match.group(2)
+                continue
+
+            if current is None:
+                raise MailsrvParserException(
+                    "Continuation line without parameter: '{}'".format(line)
+                )
+            result[current] = "{} {}".format(result[current], line).strip()
+
+        return result
+
+    def get_cipherlist(self, parameter: str = "tls_medium_cipherlist") -> list[str]:
+        """Return an OpenSSL cipher list parameter as ``list`` of cipher names.
+
+        Parameters
+        ----------
+        parameter : str, optional
+            The name of the parameter (default: tls_medium_cipherlist).
+
+        Returns
+        -------
+        list
+            A ``list`` of ``str``, one item per cipher suite.
+        """
+        try:
+            value = self.get_values()[parameter]
+        except KeyError:
+            logger.error("Parameter '%s' not found in main.cf", parameter)
+            raise MailsrvParserException("Missing parameter in main.cf")
+
+        return [cipher for cipher in re.split(r"[:,\s]+", value) if cipher]
+
+
 class PostfixAliasResolver:
     """Resolve Postfix's virtual alias configuration.
 
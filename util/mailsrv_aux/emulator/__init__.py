@@ -0,0 +1,5 @@
+# SPDX-FileCopyrightText: 2022 Mischback
+# SPDX-License-Identifier: MIT
+# SPDX-FileType: SOURCE
+
+"""Provide an emulated SUT, to run the test suite without a mail server."""
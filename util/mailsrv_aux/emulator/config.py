@@ -0,0 +1,133 @@
+# SPDX-FileCopyrightText: 2022 Mischback
+# SPDX-License-Identifier: MIT
+# SPDX-FileType: SOURCE
+
+"""Provide the configuration of the emulated SUT.
+
+The emulator uses the very same configuration files as the test suite (and
+the actual SUT): Postfix's lookup maps and Dovecot's user database.
+"""
+
+# Python imports
+import logging
+from typing import Optional
+
+# local imports
+from ..common import parser
+from ..common.parser import PostfixAliasResolver
+
+# get a module-level logger
+logger = logging.getLogger(__name__)
+
+
+class SutConfig:
+    """Provide the accept / reject decisions of the emulated SUT.
+
+    Parameters
+    ----------
+    postfix_vmailboxes : list
+        The virtual mailboxes.
+    postfix_valiases : dict
+        The virtual aliases, with their (unresolved) targets.
+    postfix_vdomains : list
+        The virtual domains.
+    postfix_sendermap : dict
+        The sender addresses, with the logins that may use them.
+    passwords : dict
+        The plain text passwords of the users. Users without plain text
+        password can not log in.
+    hostname : str, optional
+        The hostname used in greetings (default: mail.sut.test).
+    message_size_limit : int, optional
+        The maximum size of a message in bytes, like Postfix's
+        ``message_size_limit`` (default: 10240000).
+    """
+
+    def __init__(
+        self,
+        postfix_vmailboxes: list[str],
+        postfix_valiases: dict[str, list[str]],
+        postfix_vdomains: list[str],
+        postfix_sendermap: dict[str, list[str]],
+        passwords: dict[str, Optional[str]],
+        hostname: str = "mail.sut.test",
+        message_size_limit: int = 10240000,
+    ) -> None:
+        self.mailboxes = set(postfix_vmailboxes)
+        self.domains = set(postfix_vdomains)
+        self.sendermap = postfix_sendermap
+        self.passwords = passwords
+        self.hostname = hostname
+        self.message_size_limit = message_size_limit
+
+        # The resolver works on the given dict, so it gets a copy
+        self.aliases, _, _ = PostfixAliasResolver(
+            postfix_vmailboxes, dict(postfix_valiases), postfix_vdomains
+        ).resolve()
+
+    @classmethod
+    def from_files(
+        cls,
+        dovecot_userdb: str,
+        postfix_vmailboxes: str,
+        postfix_valiases: str,
+        postfix_vdomains: str,
+        postfix_sendermap: str,
+        hostname: str = "mail.sut.test",
+        message_size_limit: int = 10240000,
+    ) -> "SutConfig":
+        """Create an instance from the configuration files.
+
+        Raises
+        ------
+        MailsrvIOException
+            If one of the files could not be read.
+        """
+        userdb = parser.PasswdFileParser(dovecot_userdb)
+        return cls(
+            parser.KeyParser(postfix_vmailboxes).get_values(),
+            parser.KeyValueParser(postfix_valiases).get_values(),
+            parser.KeyParser(postfix_vdomains).get_values(),
+            parser.KeyValueParser(postfix_sendermap).get_values(),
+            {
+                username: userdb.get_plain_password(username)
+                for username in userdb.get_usernames()
+            },
+            hostname=hostname,
+            message_size_limit=message_size_limit,
+        )
+
+    def is_local(self, address: str) -> bool:
+        """Return ``True``, if the address belongs to one of the domains."""
+        return address.rpartition("@")[2].lower() in self.domains
+
+    def resolve(self, address: str) -> Optional[list[str]]:
+        """Return the targets of a recipient address.
+
+        Returns
+        -------
+        list, Optional
+            The mailboxes (and external addresses of aliases) the address
+            resolves to; external addresses resolve to themselves. ``None``
+            for unknown addresses of the local domains.
+        """
+        if not self.is_local(address):
+            return [address]
+
+        if address in self.mailboxes:
+            return [address]
+
+        return self.aliases.get(address, None)
+
+    def authenticate(self, username: str, password: str) -> bool:
+        """Check the credentials of a user."""
+        expected = self.passwords.get(username, None)
+        return expected is not None and expected == password
+
+    def may_send_as(self, login: str, sender: str) -> bool:
+        """Check, if ``login`` may use ``sender`` in ``MAIL FROM``.
+
+        Like Postfix's ``reject_sender_login_mismatch``, senders that are not
+        included in the sender map are rejected aswell.
+        """
+        return login in self.sendermap.get(sender, [])
@@ -0,0 +1,12 @@
+# SPDX-FileCopyrightText: 2022 Mischback
+# SPDX-License-Identifier: MIT
+# SPDX-FileType: SOURCE
+
+"""Provide emulator-specific exceptions."""
+
+# local imports
+from ..common.exceptions import MailsrvBaseException
+
+
+class MailsrvEmulatorException(MailsrvBaseException):
+    """Base class for all emulator-related exceptions."""
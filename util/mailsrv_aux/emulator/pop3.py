@@ -0,0 +1,270 @@
+# SPDX-FileCopyrightText: 2022 Mischback
+# SPDX-License-Identifier: MIT
+# SPDX-FileType: SOURCE
+
+"""Emulate Dovecot's POP3 service (port 110).
+
+Like Dovecot with ``disable_plaintext_auth = yes``, logins are only
+accepted after ``STLS``.
+"""
+
+# Python imports
+import asyncio
+import logging
+import ssl
+from typing import Optional
+
+# local imports
+from .config import SutConfig
+from .session import EmulatorSession
+from .store import Mailstore, StoredMessage
+
+# get a module-level logger
+logger = logging.getLogger(__name__)
+
+
+class Pop3Session(EmulatorSession):
+    """Handle a single POP3 connection.
+
+    Parameters
+    ----------
+    reader : asyncio.StreamReader
+        The reading side of the connection.
+    writer : asyncio.StreamWriter
+        The writing side of the connection.
+    emulator : Pop3Emulator
+        The service, that accepted the connection.
+    """
+
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        emulator: "Pop3Emulator",
+    ) -> None:
+        super().__init__(reader, writer, command_latency=emulator.command_latency)
+
+        self.emulator = emulator
+        self.config = emulator.config
+
+        self.username: Optional[str] = None
+        self.mailbox: Optional[str] = None
+        # The messages of the mailbox, as seen at login (maildrop lock)
+        self.messages: list[StoredMessage] = []
+        self.deleted: set[int] = set()
+
+    async def handle(self) -> None:
+        """Process the commands of the client."""
+        await self.reply("+OK Dovecot ready.")
+
+        while True:
+            line = await self.readline()
+            if not line:
+                return
+
+            verb, _, argument = line.decode("utf-8", "replace").strip().partition(" ")
+            verb = verb.lower()
+            if verb == "quit":
+                if self.mailbox is not None and self.deleted:
+                    self.emulator.store.delete(
+                        self.mailbox,
+                        {self.messages[number - 1].uid for number in self.deleted},
+                    )
+                await self.reply("+OK Logging out.")
+                return
+
+            handler = getattr(self, "_pop3_{}".format(verb), None)
+            if handler is None or (
+                self.mailbox is None and verb not in ("capa", "stls", "user", "pass")
+            ):
+                await self.reply("-ERR Unknown command: {}".format(verb.upper()))
+                continue
+
+            await handler(argument.strip())
+
+    def _message(self, argument: str) -> Optional[StoredMessage]:
+        """Return the (not deleted) message with the given number."""
+        try:
+            number = int(argument.split()[0])
+        except (IndexError, ValueError):
+            return None
+        if number in self.deleted or not 0 < number <= len(self.messages):
+            return None
+        return self.messages[number - 1]
+
+    async def _send_multiline(self, first: str, lines: list[bytes]) -> None:
+        # Lines starting with the termination octet are byte-stuffed
+        await self.reply(first)
+        await self.send(
+            b"".join(
+                (b"." + line if line.startswith(b".") else line) + b"\r\n"
+                for line in lines
+            )
+            + b".\r\n"
+        )
+
+    def _listing(self) -> list[tuple[int, StoredMessage]]:
+        """Return the (not deleted) messages with their numbers."""
+        return [
+            (number, message)
+            for number, message in enumerate(self.messages, start=1)
+            if number not in self.deleted
+        ]
+
+    async def _pop3_capa(self, argument: str) -> None:
+        capabilities = ["TOP", "UIDL", "RESP-CODES", "PIPELINING"]
+        if not self.tls and self.emulator.tls_context is not None:
+            capabilities.append("STLS")
+        if self.tls:
+            capabilities.append("USER")
+        await self._send_multiline(
+            "+OK", [capability.encode() for capability in capabilities]
+        )
+
+    async def _pop3_stls(self, argument: str) -> None:
+        if self.tls or self.emulator.tls_context is None:
+            await self.reply("-ERR TLS is already active.")
+            return
+
+        await self.reply("+OK Begin TLS negotiation now.")
+        await self.start_tls(self.emulator.tls_context)
+
+    async def _pop3_user(self, argument: str) -> None:
+        if not self.tls:
+            await self.reply(
+                "-ERR [AUTH] Plaintext authentication disallowed on "
+                "non-secure (SSL/TLS) connections."
+            )
+            return
+        if self.mailbox is not None:
+            await self.reply("-ERR Already logged in.")
+            return
+
+        self.username = argument
+        await self.reply("+OK")
+
+    async def _pop3_pass(self, argument: str) -> None:
+        if self.username is None or self.mailbox is not None:
+            await self.reply("-ERR No username given.")
+            return
+
+        if not self.config.authenticate(self.username, argument):
+            self.username = None
+            await self.reply("-ERR [AUTH] Authentication failed.")
+            return
+
+        self.mailbox = self.username
+        self.messages = self.emulator.store.messages(self.mailbox)
+        await self.reply("+OK Logged in.")
+
+    async def _pop3_stat(self, argument: str) -> None:
+        sizes = [message.size for _, message in self._listing()]
+        await self.reply("+OK {} {}".format(len(sizes), sum(sizes)))
+
+    async def _list(self, argument: str, value: str) -> None:
+        if argument:
+            message = self._message(argument)
+            if message is None:
+                await self.reply("-ERR There's no message {}.".format(argument))
+                return
+            await self.reply("+OK {} {}".format(argument, getattr(message, value)))
+            return
+
+        await self._send_multiline(
+            "+OK",
+            [
+                "{} {}".format(number, getattr(message, value)).encode()
+                for number, message in self._listing()
+            ],
+        )
+
+    async def _pop3_list(self, argument: str) -> None:
+        await self._list(argument, "size")
+
+    async def _pop3_uidl(self, argument: str) -> None:
+        await self._list(argument, "uid")
+
+    async def _pop3_retr(self, argument: str) -> None:
+        message = self._message(argument)
+        if message is None:
+            await self.reply("-ERR There's no message {}.".format(argument))
+            return
+
+        await self._send_multiline(
+            "+OK {} octets".format(message.size), message.data.split(b"\r\n")[:-1]
+        )
+
+    async def _pop3_top(self, argument: str) -> None:
+        message = self._message(argument)
+        try:
+            body_lines = int(argument.split()[1])
+        except (IndexError, ValueError):
+            body_lines = -1
+        if message is None or body_lines < 0:
+            await self.reply("-ERR Invalid arguments.")
+            return
+
+        lines = message.data.split(b"\r\n")[:-1]
+        try:
+            separator = lines.index(b"")
+        except ValueError:
+            separator = len(lines)
+        await self._send_multiline("+OK", lines[: separator + 1 + body_lines])
+
+    async def _pop3_dele(self, argument: str) -> None:
+        message = self._message(argument)
+        if message is None:
+            await self.reply("-ERR There's no message {}.".format(argument))
+            return
+
+        self.deleted.add(int(argument.split()[0]))
+        await self.reply("+OK Marked to be deleted.")
+
+    async def _pop3_rset(self, argument: str) -> None:
+        self.deleted.clear()
+        await self.reply("+OK")
+
+    async def _pop3_noop(self, argument: str) -> None:
+        await self.reply("+OK")
+
+
+class Pop3Emulator:
+    """Provide the POP3 service of the emulated SUT.
+
+    Parameters
+    ----------
+    config : SutConfig
+        The configuration of the SUT.
+    store : Mailstore
+        The mailboxes.
+    tls_context : ssl.SSLContext, optional
+        The server context for ``STLS``; without context, no login is
+        possible.
+    command_latency : float, optional
+        Delay every reply by this number of seconds (default: 0).
+    """
+
+    def __init__(
+        self,
+        config: SutConfig,
+        store: Mailstore,
+        tls_context: Optional[ssl.SSLContext] = None,
+        command_latency: float = 0.0,
+    ) -> None:
+        self.config = config
+        self.store = store
+        self.tls_context = tls_context
+        self.command_latency = command_latency
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """Handle a client connection (callback of ``asyncio.start_server()``)."""
+        session = Pop3Session(reader, writer, self)
+        try:
+            await session.handle()
+        except (ConnectionError, ssl.SSLError) as e:
+            logger.debug("POP3 session aborted")
+            logger.debug(e, exc_info=True)  # noqa: G200
+        finally:
+            await session.close()
@@ -0,0 +1,123 @@
+# SPDX-FileCopyrightText: 2022 Mischback
+# SPDX-License-Identifier: MIT
+# SPDX-FileType: SOURCE
+
+"""Run the services of the emulated SUT."""
+
+# Python imports
+import asyncio
+import logging
+import ssl
+from typing import Optional
+
+# local imports
+from ..common.log import add_level
+from .config import SutConfig
+from .pop3 import Pop3Emulator
+from .smtp import LmtpEmulator, SmtpEmulator
+from .store import Mailstore
+
+# get a module-level logger
+logger = logging.getLogger(__name__)
+
+# add VERBOSE / SUMMARY log levels
+add_level("VERBOSE", logging.INFO - 1)
+add_level("SUMMARY", logging.INFO + 1)
+
+
+class SutEmulator:
+    """Emulate the SUT on the loopback interface.
+
+    The emulator provides the SMTP (``25``), submission (``587``), POP3
+    (``110``) and LMTP (``24``) services on configurable ports, sharing one
+    in-memory ``Mailstore``.
+
+    Parameters
+    ----------
+    config : SutConfig
+        The configuration of the SUT.
+    tls_context : ssl.SSLContext, optional
+        The server context for ``STARTTLS`` / ``STLS``.
+    host : str, optional
+        The address to listen on (default: 127.0.0.1).
+    smtp_port : int, optional
+        The port of the SMTP service (default: 2525).
+    submission_port : int, optional
+        The port of the submission service (default: 2587).
+    pop3_port : int, optional
+        The port of the POP3 service (default: 2110).
+    lmtp_port : int, optional
+        The port of the LMTP service (default: 2024).
+    command_latency : float, optional
+        Delay every reply by this number of seconds (default: 0).
+    delivery_delay : float, optional
+        Accepted messages show up in the mailboxes after this number of
+        seconds (default: 0).
+    """
+
+    def __init__(
+        self,
+        config: SutConfig,
+        tls_context: Optional[ssl.SSLContext] = None,
+        host: str = "127.0.0.1",
+        smtp_port: int = 2525,
+        submission_port: int = 2587,
+        pop3_port: int = 2110,
+        lmtp_port: int = 2024,
+        command_latency: float = 0.0,
+        delivery_delay: float = 0.0,
+    ) -> None:
+        self.host = host
+        self.store = Mailstore()
+
+        self.services = {
+            smtp_port: SmtpEmulator(
+                config,
+                self.store,
+                tls_context=tls_context,
+                command_latency=command_latency,
+                delivery_delay=delivery_delay,
+            ).handle,
+            submission_port: SmtpEmulator(
+                config,
+                self.store,
+                submission=True,
+                tls_context=tls_context,
+                command_latency=command_latency,
+                delivery_delay=delivery_delay,
+            ).handle,
+            pop3_port: Pop3Emulator(
+                config,
+                self.store,
+                tls_context=tls_context,
+                command_latency=command_latency,
+            ).handle,
+            lmtp_port: LmtpEmulator(
+                config,
+                self.store,
+                command_latency=command_latency,
+                delivery_delay=delivery_delay,
+            ).handle,
+        }
+
+    async def serve(self) -> None:
+        """Start the services and run until cancelled."""
+        servers = []
+        for port, handler in self.services.items():
+            servers.append(await asyncio.start_server(handler, self.host, port))
+            logger.verbose("Listening on %s:%d", self.host, port)  # type: ignore [attr-defined]
+
+        logger.summary("SUT emulator ready")  # type: ignore [attr-defined]
+        try:
+            await asyncio.gather(*(server.serve_forever() for server in servers))
+        finally:
+            for server in servers:
+                server.close()
+            logger.summary("Mailstore: %s", self.store)  # type: ignore [attr-defined]
+
+    def run(self) -> None:
+        """Run the emulator until interrupted."""
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            logger.info("Emulator stopped")
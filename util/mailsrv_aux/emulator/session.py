@@ -0,0 +1,146 @@
+# SPDX-FileCopyrightText: 2022 Mischback
+# SPDX-License-Identifier: MIT
+# SPDX-FileType: SOURCE
+
+"""Provide the common parts of the emulated protocols."""
+
+# Python imports
+import asyncio
+import logging
+import os
+import ssl
+import subprocess
+import tempfile
+from typing import Optional
+
+# local imports
+from .exceptions import MailsrvEmulatorException
+
+# get a module-level logger
+logger = logging.getLogger(__name__)
+
+
+def create_server_context(
+    cert_file: Optional[str] = None,
+    key_file: Optional[str] = None,
+    hostname: str = "mail.sut.test",
+) -> ssl.SSLContext:
+    """Return the TLS context of the emulator.
+
+    If no certificate is provided, a self-signed certificate is generated,
+    using the ``openssl`` command line tool.
+
+    Raises
+    ------
+    MailsrvEmulatorException
+        If the certificate could not be generated or loaded.
+    """
+    if cert_file is None or key_file is None:
+        cert_dir = tempfile.mkdtemp(prefix="mailsrv-emulator-")
+        cert_file = os.path.join(cert_dir, "cert.pem")
+        key_file = os.path.join(cert_dir, "key.pem")
+        try:
+            subprocess.run(
+                [
+                    "openssl",
+                    "req",
+                    "-x509",
+                    "-newkey",
+                    "rsa:2048",
+                    "-nodes",
+                    "-days",
+                    "1",
+                    "-subj",
+                    "/CN={}".format(hostname),
+                    "-keyout",
+                    key_file,
+                    "-out",
+                    cert_file,
+                ],
+                check=True,
+                capture_output=True,
+            )
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.error("Could not generate a self-signed certificate")
+            logger.debug(e, exc_info=True)  # noqa: G200
+            raise MailsrvEmulatorException("Certificate generation failed")
+
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    try:
+        context.load_cert_chain(cert_file, key_file)
+    except (OSError, ssl.SSLError) as e:
+        logger.error("Could not load certificate '%s'", cert_file)
+        logger.debug(e, exc_info=True)  # noqa: G200
+        raise MailsrvEmulatorException("Could not load certificate")
+
+    return context
+
+
+class EmulatorSession:
+    """Provide the I/O of a single client connection.
+
+    Parameters
+    ----------
+    reader : asyncio.StreamReader
+        The reading side of the connection.
+    writer : asyncio.StreamWriter
+        The writing side of the connection.
+    command_latency : float, optional
+        Delay every reply by this number of seconds (default: 0).
+    """
+
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        command_latency: float = 0.0,
+    ) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.command_latency = command_latency
+        self.tls = False
+
+    async def readline(self) -> bytes:
+        """Return the next line, or ``b""`` if the client disconnected."""
+        try:
+            return await self.reader.readline()
+        except (ConnectionError, ssl.SSLError):
+            return b""
+
+    async def reply(self, *lines: str) -> None:
+        """Send the given lines, after the injected latency."""
+        if self.command_latency > 0:
+            await asyncio.sleep(self.command_latency)
+        await self.send("".join("{}\r\n".format(line) for line in lines).encode())
+
+    async def send(self, data: bytes) -> None:
+        """Send raw data."""
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def start_tls(self, context: ssl.SSLContext) -> None:
+        """Upgrade the connection to TLS (``STARTTLS`` / ``STLS``)."""
+        start_tls = getattr(self.writer, "start_tls", None)
+        if start_tls is not None:
+            # Python 3.11+
+            await start_tls(context)
+        else:
+            # Before Python 3.11, the streams do not support the upgrade, so
+            # the new transport is attached manually.
+            loop = asyncio.get_running_loop()
+            transport = self.writer.transport
+            tls_transport = await loop.start_tls(
+                transport, transport.get_protocol(), context, server_side=True
+            )
+            self.writer._transport = tls_transport  # type: ignore [attr-defined]
+            self.reader._transport = tls_transport  # type: ignore [attr-defined]
+
+        self.tls = True
+
+    async def close(self) -> None:
+        """Close the connection."""
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, ssl.SSLError):
+            pass
@@ -0,0 +1,460 @@
+# SPDX-FileCopyrightText: 2022 Mischback
+# SPDX-License-Identifier: MIT
+# SPDX-FileType: SOURCE
+
+"""Emulate Postfix's SMTP (port 25) and submission (port 587) services.
+
+The responses follow Postfix's wording. Like Postfix with
+``smtpd_delay_reject = yes``, sender restrictions are evaluated with
+``RCPT TO``.
+
+Additionally, Dovecot's LMTP service (RFC 2033) is emulated, which accepts
+mailboxes only and replies once per recipient after the data.
+"""
+
+# Python imports
+import asyncio
+import base64
+import itertools
+import logging
+import re
+import ssl
+from typing import Optional
+
+# local imports
+from .config import SutConfig
+from .session import EmulatorSession
+from .store import Mailstore
+
+# get a module-level logger
+logger = logging.getLogger(__name__)
+
+# ``MAIL FROM:<address> [PARAM=value ...]`` / ``RCPT TO:<address> ...``
+ADDRESS_PATTERN = re.compile(r"^(?:FROM|TO):\s*<([^>]*)>\s*(.*)$", re.IGNORECASE)
+
+
+class SmtpSession(EmulatorSession):
+    """Handle a single SMTP connection.
+
+    Parameters
+    ----------
+    reader : asyncio.StreamReader
+        The reading side of the connection.
+    writer : asyncio.StreamWriter
+        The writing side of the connection.
+    emulator : SmtpEmulator
+        The service, that accepted the connection.
+    """
+
+    # Follows the hostname in the greeting
+    banner = "ESMTP Postfix"
+
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        emulator: "SmtpEmulator",
+    ) -> None:
+        super().__init__(reader, writer, command_latency=emulator.command_latency)
+
+        self.emulator = emulator
+        self.config = emulator.config
+        self.login: Optional[str] = None
+
+        self.mail_from: Optional[str] = None
+        self.recipients: list[str] = []
+
+    def _reset(self) -> None:
+        self.mail_from = None
+        self.recipients = []
+
+    async def handle(self) -> None:
+        """Process the commands of the client."""
+        await self.reply("220 {} {}".format(self.config.hostname, self.banner))
+
+        while True:
+            line = await self.readline()
+            if not line:
+                return
+
+            verb, _, argument = line.decode("utf-8", "replace").strip().partition(" ")
+            verb = verb.lower()
+            if verb == "quit":
+                await self.reply("221 2.0.0 Bye")
+                return
+
+            handler = getattr(self, "_smtp_{}".format(verb), None)
+            if handler is None:
+                await self.reply("502 5.5.2 Error: command not recognized")
+                continue
+
+            await handler(argument.strip())
+
+    async def _smtp_helo(self, argument: str) -> None:
+        self._reset()
+        await self.reply("250 {}".format(self.config.hostname))
+
+    async def _smtp_ehlo(self, argument: str) -> None:
+        self._reset()
+
+        extensions = [
+            self.config.hostname,
+            "PIPELINING",
+            "SIZE {}".format(self.config.message_size_limit),
+        ]
+        if not self.tls and self.emulator.tls_context is not None:
+            extensions.append("STARTTLS")
+        if self._auth_enabled():
+            extensions.append("AUTH PLAIN LOGIN")
+        extensions += ["ENHANCEDSTATUSCODES", "8BITMIME"]
+
+        await self.reply(
+            *["250-{}".format(line) for line in extensions[:-1]],
+            "250 {}".format(extensions[-1]),
+        )
+
+    async def _smtp_starttls(self, argument: str) -> None:
+        if self.tls or self.emulator.tls_context is None:
+            await self.reply("502 5.5.1 Error: command not implemented")
+            return
+
+        await self.reply("220 2.0.0 Ready to start TLS")
+        try:
+            await self.start_tls(self.emulator.tls_context)
+        except (ConnectionError, ssl.SSLError) as e:
+            logger.debug("TLS handshake failed")
+            logger.debug(e, exc_info=True)  # noqa: G200
+            raise
+
+        # The client has to start over (RFC 3207)
+        self._reset()
+        self.login = None
+
+    def _auth_enabled(self) -> bool:
+        return self.emulator.submission and self.tls
+
+    async def _read_auth_response(self, challenge: str) -> Optional[str]:
+        await self.reply("334 {}".format(challenge))
+        response = (await self.readline()).decode("ascii", "replace").strip()
+        if response == "*":
+            return None
+        return response
+
+    async def _smtp_auth(self, argument: str) -> None:
+        if not self._auth_enabled():
+            await self.reply("503 5.5.1 Error: authentication not enabled")
+            return
+        if self.login is not None:
+            await self.reply("503 5.5.1 Error: already authenticated")
+            return
+
+        mechanism, _, initial = argument.partition(" ")
+        mechanism = mechanism.upper()
+        try:
+            if mechanism == "PLAIN":
+                response = initial or await self._read_auth_response("")
+                if response is None:
+                    await self.reply("501 5.7.0 Authentication aborted")
+                    return
+                _, username, password = (
+                    base64.b64decode(response, validate=True).decode().split("\0")
+                )
+            elif mechanism == "LOGIN":
+                username_response = initial or await self._read_auth_response(
+                    "VXNlcm5hbWU6"
+                )
+                if username_response is None:
+                    await self.reply("501 5.7.0 Authentication aborted")
+                    return
+                password_response = await self._read_auth_response("UGFzc3dvcmQ6")
+                if password_response is None:
+                    await self.reply("501 5.7.0 Authentication aborted")
+                    return
+                username = base64.b64decode(username_response, validate=True).decode()
+                password = base64.b64decode(password_response, validate=True).decode()
+            else:
+                await self.reply(
+                    "535 5.7.8 Error: authentication failed: Invalid authentication mechanism"
+                )
+                return
+        except ValueError:
+            # includes ``binascii.Error`` and ``UnicodeDecodeError``
+            await self.reply("501 5.5.2 Syntax error in parameters")
+            return
+
+        if not self.config.authenticate(username, password):
+            await self.reply("535 5.7.8 Error: authentication failed")
+            return
+
+        self.login = username
+        await self.reply("235 2.7.0 Authentication successful")
+
+    async def _smtp_mail(self, argument: str) -> None:
+        if self.emulator.submission and not self.tls:
+            await self.reply("530 5.7.0 Must issue a STARTTLS command first")
+            return
+        if self.emulator.submission and self.login is None:
+            await self.reply("530 5.7.0 Authentication required")
+            return
+        if self.mail_from is not None:
+            await self.reply("503 5.5.1 Error: nested MAIL command")
+            return
+
+        match = ADDRESS_PATTERN.match(argument)
+        if match is None:
+            await self.reply("501 5.5.4 Syntax: MAIL FROM:<address>")
+            return
+
+        for parameter in match.group(2).split():
+            name, _, value = parameter.partition("=")
+            if (
+                name.upper() == "SIZE"
+                and value.isdigit()
+                and int(value) > self.config.message_size_limit
+            ):
+                await self.reply("552 5.3.4 Message size exceeds fixed limit")
+                return
+
+        self.mail_from = match.group(1)
+        await self.reply("250 2.1.0 Ok")
+
+    async def _smtp_rcpt(self, argument: str) -> None:
+        if self.mail_from is None:
+            await self.reply("503 5.5.1 Error: need MAIL command")
+            return
+
+        match = ADDRESS_PATTERN.match(argument)
+        if match is None:
+            await self.reply("501 5.5.4 Syntax: RCPT TO:<address>")
+            return
+        address = match.group(1)
+
+        if self.login is not None and not self.config.may_send_as(
+            self.login, self.mail_from
+        ):
+            await self.reply(
+                "553 5.7.1 <{}>: Sender address rejected: not owned by user {}".format(
+                    self.mail_from, self.login
+                )
+            )
+            return
+
+        if not self.config.is_local(address):
+            if self.login is None:
+                await self.reply("554 5.7.1 <{}>: Relay access denied".format(address))
+                return
+        elif self.config.resolve(address) is None:
+            await self.reply(
+                "550 5.1.1 <{}>: Recipient address rejected: "
+                "User unknown in virtual mailbox table".format(address)
+            )
+            return
+
+        self.recipients.append(address)
+        await self.reply("250 2.1.5 Ok")
+
+    async def _smtp_data(self, argument: str) -> None:
+        if not self.recipients:
+            await self.reply("503 5.5.1 Error: need RCPT command")
+            return
+
+        await self.reply("354 End data with <CR><LF>.<CR><LF>")
+
+        lines = []
+        size = 0
+        while True:
+            line = await self.readline()
+            if not line:
+                # The client disconnected, the message is discarded
+                return
+            if line in (b".\r\n", b".\n"):
+                break
+            if line.startswith(b"."):
+                line = line[1:]
+
+            size += len(line)
+            if size <= self.config.message_size_limit:
+                lines.append(line)
+
+        if size > self.config.message_size_limit:
+            self._reset()
+            await self.reply("552 5.3.4 Error: message file too big")
+            return
+
+        await self._queue(lines)
+
+    async def _queue(self, lines: list[bytes]) -> None:
+        """Deliver the received message and send the final reply."""
+        queue_id = self.emulator.deliver(self.mail_from or "", self.recipients, lines)
+        self._reset()
+        await self.reply("250 2.0.0 Ok: queued as {}".format(queue_id))
+
+    async def _smtp_rset(self, argument: str) -> None:
+        self._reset()
+        await self.reply("250 2.0.0 Ok")
+
+    async def _smtp_noop(self, argument: str) -> None:
+        await self.reply("250 2.0.0 Ok")
+
+    async def _smtp_vrfy(self, argument: str) -> None:
+        await self.reply("252 2.0.0 Send mail and see")
+
+
+class LmtpSession(SmtpSession):
+    """Handle a single LMTP connection, following Dovecot's wording.
+
+    Other than SMTP, only mailboxes are accepted as recipients (the aliases
+    are resolved by Postfix before) and the message is delivered to every
+    recipient separately, with a reply per recipient.
+    """
+
+    banner = "Dovecot ready."
+
+    async def _smtp_lhlo(self, argument: str) -> None:
+        self._reset()
+
+        extensions = [
+            self.config.hostname,
+            "8BITMIME",
+            "ENHANCEDSTATUSCODES",
+            "PIPELINING",
+        ]
+        await self.reply(
+            *["250-{}".format(line) for line in extensions[:-1]],
+            "250 {}".format(extensions[-1]),
+        )
+
+    async def _smtp_rcpt(self, argument: str) -> None:
+        if self.mail_from is None:
+            await self.reply("503 5.5.1 MAIL needed first")
+            return
+
+        match = ADDRESS_PATTERN.match(argument)
+        if match is None:
+            await self.reply("501 5.5.4 Invalid parameters")
+            return
+        address = match.group(1)
+
+        if address not in self.config.mailboxes:
+            await self.reply("550 5.1.1 <{0}> User doesn't exist: {0}".format(address))
+            return
+
+        self.recipients.append(address)
+        await self.reply("250 2.1.5 OK")
+
+    async def _queue(self, lines: list[bytes]) -> None:
+        replies = []
+        for recipient in self.recipients:
+            self.emulator.deliver(self.mail_from or "", [recipient], lines)
+            replies.append("250 2.0.0 <{}> Saved".format(recipient))
+        self._reset()
+        await self.reply(*replies)
+
+
+class SmtpEmulator:
+    """Provide an SMTP service of the emulated SUT.
+
+    Parameters
+    ----------
+    config : SutConfig
+        The configuration of the SUT.
+    store : Mailstore
+        The mailboxes, messages are delivered to.
+    submission : bool, optional
+        Act as submission service: require ``STARTTLS`` and ``AUTH`` and
+        accept external recipients (default: ``False``).
+    tls_context : ssl.SSLContext, optional
+        The server context for ``STARTTLS``; without context, ``STARTTLS``
+        is not offered.
+    command_latency : float, optional
+        Delay every reply by this number of seconds (default: 0).
+    delivery_delay : float, optional
+        Accepted messages show up in the mailboxes after this number of
+        seconds (default: 0).
+    """
+
+    # The class handling the connections
+    session_class: type[SmtpSession] = SmtpSession
+
+    def __init__(
+        self,
+        config: SutConfig,
+        store: Mailstore,
+        submission: bool = False,
+        tls_context: Optional[ssl.SSLContext] = None,
+        command_latency: float = 0.0,
+        delivery_delay: float = 0.0,
+    ) -> None:
+        self.config = config
+        self.store = store
+        self.submission = submission
+        self.tls_context = tls_context
+        self.command_latency = command_latency
+        self.delivery_delay = delivery_delay
+
+        self._queue_ids = itertools.count(1)
+        # Messages to external addresses are accepted, but not delivered
+        self.relayed = 0
+
+    def deliver(self, mail_from: str, recipients: list[str], lines: list[bytes]) -> str:
+        """Deliver a message to the mailboxes of its recipients.
+
+        Like Postfix, every mailbox receives a single copy, even if it is
+        reached through several recipients (or aliases).
+
+        Returns
+        -------
+        str
+            The queue ID of the message.
+        """
+        data = b"".join(
+            line if line.endswith(b"\r\n") else line.rstrip(b"\n") + b"\r\n"
+            for line in lines
+        )
+
+        mailboxes: list[str] = []
+        for recipient in recipients:
+            for target in self.config.resolve(recipient) or []:
+                if target not in self.config.mailboxes:
+                    self.relayed += 1
+                elif target not in mailboxes:
+                    mailboxes.append(target)
+
+        for mailbox in mailboxes:
+            self.store.deliver(
+                mailbox,
+                "Return-Path: <{}>\r\nDelivered-To: {}\r\n".format(
+                    mail_from, mailbox
+                ).encode()
+                + data,
+                self.delivery_delay,
+            )
+
+        queue_id = "{:010X}".format(next(self._queue_ids))
+        logger.debug(
+            "%s: %d mailbox(es), %d bytes", queue_id, len(mailboxes), len(data)
+        )
+        return queue_id
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """Handle a client connection (callback of ``asyncio.start_server()``)."""
+        session = self.session_class(reader, writer, self)
+        try:
+            await session.handle()
+        except (ConnectionError, ssl.SSLError) as e:
+            logger.debug("SMTP session aborted")
+            logger.debug(e, exc_info=True)  # noqa: G200
+        finally:
+            await session.close()
+
+
+class LmtpEmulator(SmtpEmulator):
+    """Provide Dovecot's LMTP service of the emulated SUT.
+
+    For the parameters refer to ``SmtpEmulator``; ``submission`` has no
+    effect.
+    """
+
+    session_class = LmtpSession
@@ -0,0 +1,95 @@
+# SPDX-FileCopyrightText: 2022 Mischback
+# SPDX-License-Identifier: MIT
+# SPDX-FileType: SOURCE
+
+"""Store the delivered messages of the emulated SUT in memory."""
+
+# Python imports
+import collections
+import itertools
+import time
+
+
+class StoredMessage:
+    """A delivered message.
+
+    Parameters
+    ----------
+    uid : str
+        The unique ID of the message (used for POP3's ``UIDL``).
+    data : bytes
+        The message, including its headers; lines end with ``CRLF``.
+    visible_at : float
+        The time (as returned by ``time.monotonic()``), the message shows up
+        in the mailbox.
+    """
+
+    __slots__ = ("uid", "data", "visible_at")
+
+    def __init__(self, uid: str, data: bytes, visible_at: float) -> None:
+        self.uid = uid
+        self.data = data
+        self.visible_at = visible_at
+
+    @property
+    def size(self) -> int:
+        """Return the size of the message in bytes."""
+        return len(self.data)
+
+
+class Mailstore:
+    """Keep the mailboxes of the emulated SUT.
+
+    Notes
+    -----
+    The store is not thread-safe, it is meant to be used from the event
+    loop of the emulator.
+    """
+
+    def __init__(self) -> None:
+        self._mailboxes: dict[str, list[StoredMessage]] = collections.defaultdict(list)
+        self._uids = itertools.count(1)
+
+    def deliver(self, mailbox: str, data: bytes, delay: float = 0.0) -> None:
+        """Add a message to a mailbox.
+
+        Parameters
+        ----------
+        mailbox : str
+            The mailbox.
+        data : bytes
+            The message.
+        delay : float, optional
+            The message shows up after this number of seconds (default: 0).
+        """
+        self._mailboxes[mailbox].append(
+            StoredMessage(
+                "{:08x}".format(next(self._uids)), data, time.monotonic() + delay
+            )
+        )
+
+    def messages(self, mailbox: str) -> list[StoredMessage]:
+        """Return the (visible) messages of a mailbox."""
+        now = time.monotonic()
+        return [
+            message
+            for message in self._mailboxes.get(mailbox, [])
+            if message.visible_at <= now
+        ]
+
+    def delete(self, mailbox: str, uids: set[str]) -> None:
+        """Remove messages from a mailbox."""
+        self._mailboxes[mailbox] = [
+            message for message in self._mailboxes[mailbox] if message.uid not in uids
+        ]
+
+    def __str__(self) -> str:  # noqa: D105
+        return "{} message(s), {} bytes in {} mailbox(es)".format(
+            sum(len(messages) for messages in self._mailboxes.values()),
+            sum(
+                message.size
+                for messages in self._mailboxes.values()
+                for message in messages
+            ),
+            len(self._mailboxes),
+        )
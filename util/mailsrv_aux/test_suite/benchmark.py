@@ -0,0 +1,805 @@
+# SPDX-FileCopyrightText: 2022 Mischback
+# SPDX-License-Identifier: MIT
+# SPDX-FileType: SOURCE
+
+"""Benchmarks for the SMTP-part of the mail setup.
+
+Other than the actual test suites, these suites do not primarily verify the
+behaviour of the SUT, but measure its performance.
+"""
+
+# Python imports
+import logging
+import random
+import smtplib
+import socket
+import ssl
+import threading
+import time
+from typing import Any, Optional, Sequence, Union
+
+# local imports
+from ..common.log import add_level
+from .messages import (
+    CTE_8BIT,
+    CTE_BASE64,
+    CTE_QUOTED_PRINTABLE,
+    MessageFactory,
+    SizeDistribution,
+    dot_stuff,
+    utf8_text_body,
+)
+from .metrics import LatencyRecorder
+from .parallel import run_in_pool
+from .smtp import SmtpGenericTestSuite, SubmissionTestSuite
+
+# get a module-level logger
+logger = logging.getLogger(__name__)
+
+# add VERBOSE / SUMMARY log levels
+add_level("VERBOSE", logging.INFO - 1)
+add_level("SUMMARY", logging.INFO + 1)
+
+
+class CipherBenchmarkResult:
+    """Store the measurements of a single cipher suite on a single port."""
+
+    def __init__(self, cipher: str, port: int) -> None:
+        self.cipher = cipher
+        self.port = port
+        self.latency = LatencyRecorder(cipher)
+        self.cpu_time = 0.0
+        self.failures = 0
+
+    @property
+    def handshakes_per_second(self) -> Optional[float]:
+        """Return the number of (sequential) handshakes per second."""
+        if self.latency.count == 0:
+            return None
+        return self.latency.count / self.latency.total
+
+    @property
+    def cpu_per_handshake(self) -> Optional[float]:
+        """Return the client's CPU time per handshake in seconds."""
+        if self.latency.count == 0:
+            return None
+        return self.cpu_time / self.latency.count
+
+    def __str__(self) -> str:  # noqa: D105
+        if self.latency.count == 0:
+            return "{:<32} port {:>3}: no successful handshake ({} failures)".format(
+                self.cipher, self.port, self.failures
+            )
+        return "{:<32} port {:>3}: {:7.1f} handshakes/s, {:6.2f}ms CPU/handshake, p95 {:6.2f}ms ({} failures)".format(
+            self.cipher,
+            self.port,
+            self.handshakes_per_second,  # type: ignore [str-format]
+            self.cpu_per_handshake * 1000,  # type: ignore [operator]
+            self.latency.percentile(95) * 1000,  # type: ignore [operator]
+            self.failures,
+        )
+
+
+class CipherHandshakeBenchmark(SmtpGenericTestSuite):
+    """Measure the cost of the STARTTLS handshake per cipher suite.
+
+    For every cipher suite, the given number of connections is opened
+    sequentially. Each connection sends ``EHLO`` and ``STARTTLS``, forcing the
+    cipher suite on the client side. The measured time covers the
+    ``STARTTLS`` command and the actual TLS handshake.
+
+    The cipher names are OpenSSL's names for TLS 1.2 cipher suites, as used in
+    Postfix's ``tls_medium_cipherlist``. TLS 1.3 does not allow to choose the
+    cipher suite by these names, so the benchmark limits the connection to
+    TLS 1.2.
+
+    Parameters
+    ----------
+    ciphers : list
+        A ``list`` of ``str``, the cipher suites to benchmark.
+    handshakes : int, optional
+        The number of handshakes per cipher suite (default: 20).
+    suite_name : str, optional
+        The suites verbose name (default: Cipher Handshake Benchmark).
+
+    Notes
+    -----
+    The CPU time is the CPU time of the client process, the server's CPU time
+    is not available to the benchmark. Cipher suites that can not be
+    negotiated (e.g. ECDSA suites with an RSA certificate) are reported with
+    failures only.
+
+    For a full list of parameters refer to ``SmtpGenericTestSuite``.
+    """
+
+    def __init__(
+        self,
+        *args: Any,
+        ciphers: Optional[list[str]] = None,
+        handshakes: int = 20,
+        suite_name: str = "Cipher Handshake Benchmark",
+        **kwargs: Optional[Any],
+    ) -> None:
+        super().__init__(  # type: ignore
+            *args,
+            suite_name=suite_name,
+            **kwargs,  # type: ignore
+        )
+
+        if ciphers is None:
+            raise self.SmtpOperationalError("Missing parameter: 'ciphers'")
+        self.ciphers = ciphers
+        self.handshakes = handshakes
+
+        self.results: list[CipherBenchmarkResult] = []
+
+    def _cipher_context(self, cipher: str) -> Optional[ssl.SSLContext]:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        context.maximum_version = ssl.TLSVersion.TLSv1_2
+
+        try:
+            context.set_ciphers(cipher)
+        except ssl.SSLError:
+            logger.warning("Cipher suite '%s' is not supported by the client", cipher)
+            return None
+
+        return context
+
+    def _handshake(
+        self, context: ssl.SSLContext, result: CipherBenchmarkResult
+    ) -> None:
+        smtp = None
+        try:
+            smtp = self._open_connection()
+            smtp.ehlo()
+
+            cpu_start = time.process_time()
+            start = time.perf_counter()
+            smtp.starttls(context=context)
+            duration = time.perf_counter() - start
+            cpu_time = time.process_time() - cpu_start
+
+            negotiated = smtp.sock.cipher()[0]  # type: ignore [union-attr]
+            if negotiated != result.cipher:
+                logger.error(
+                    "Negotiated '%s', expected '%s'", negotiated, result.cipher
+                )
+                result.failures += 1
+                return
+
+            result.latency.add(duration)
+            result.cpu_time += cpu_time
+            smtp.quit()
+        except (OSError, smtplib.SMTPException) as e:
+            # Includes ``ssl.SSLError``, resets, timeouts and disconnects; a
+            # single failed handshake does not abort the sweep.
+            logger.debug("Handshake failed: %s", e)  # noqa: G200
+            result.failures += 1
+        finally:
+            if smtp is not None:
+                smtp.close()
+
+    def _pre_run(self) -> None:
+        self.smtp.ehlo()
+        if not self.smtp.has_extn("starttls"):
+            logger.critical("Target does not offer STARTTLS")
+            raise self.SmtpOperationalError("STARTTLS not supported")
+
+    def _run_tests(self) -> None:
+        for cipher in self.ciphers:
+            context = self._cipher_context(cipher)
+            if context is None:
+                continue
+
+            logger.verbose("Benchmarking '%s' on port %d", cipher, self.target_port)  # type: ignore [attr-defined]
+            result = CipherBenchmarkResult(cipher, self.target_port)
+            for _ in range(self.handshakes):
+                self._handshake(context, result)
+
+            logger.summary("%s", result)  # type: ignore [attr-defined]
+            self.results.append(result)
+
+
+class AuthAttempt:
+    """Describe a single login attempt of ``AuthStormBenchmark``.
+
+    Parameters
+    ----------
+    kind : str
+        One of ``AuthAttempt.VALID``, ``AuthAttempt.INVALID`` or
+        ``AuthAttempt.REPEATED``.
+    username : str
+        The username to use.
+    password : str
+        The password to use.
+    """
+
+    VALID = "valid"
+    INVALID = "invalid"
+    REPEATED = "repeated"
+
+    KINDS = (VALID, INVALID, REPEATED)
+
+    def __init__(self, kind: str, username: str, password: str) -> None:
+        self.kind = kind
+        self.username = username
+        self.password = password
+
+    @property
+    def expect_success(self) -> bool:
+        """Return ``True`` if the login is expected to be successful."""
+        return self.kind != self.INVALID
+
+    def __repr__(self) -> str:  # noqa: D105
+        return "<{classname}: kind={kind!r}, username={username!r}>".format(
+            classname=self.__class__.__name__,
+            kind=self.kind,
+            username=self.username,
+        )
+
+
+def generate_auth_attempts(
+    credentials: dict[str, str],
+    attempts: int,
+    invalid_ratio: float = 0.1,
+    repeat_ratio: float = 0.3,
+    seed: int = 0,
+) -> list[AuthAttempt]:
+    """Generate a reproducible mix of login attempts.
+
+    *Valid* attempts cycle through all accounts, *repeated* attempts use an
+    account that was already used before (and should be served from
+    Dovecot's auth cache), *invalid* attempts use either a wrong password for
+    an existing account or an unknown account.
+
+    Parameters
+    ----------
+    credentials : dict
+        A ``dict``, mapping usernames to their plain text passwords.
+    attempts : int
+        The overall number of attempts.
+    invalid_ratio : float, optional
+        The share of invalid attempts (default: 0.1).
+    repeat_ratio : float, optional
+        The share of repeated attempts (default: 0.3).
+    seed : int, optional
+        The seed for the random generator (default: 0).
+
+    Returns
+    -------
+    list
+        A ``list`` of ``AuthAttempt`` instances.
+    """
+    rng = random.Random(seed)
+    usernames = sorted(credentials)
+    used: list[str] = []
+    result: list[AuthAttempt] = []
+
+    for i in range(attempts):
+        roll = rng.random()
+        username = usernames[i % len(usernames)]
+
+        if roll < invalid_ratio:
+            if rng.random() < 0.5:
+                result.append(
+                    AuthAttempt(AuthAttempt.INVALID, username, "not-the-password")
+                )
+            else:
+                result.append(
+                    AuthAttempt(
+                        AuthAttempt.INVALID,
+                        "unknown-{}-{}".format(i, username),
+                        credentials[username],
+                    )
+                )
+            continue
+
+        if roll < invalid_ratio + repeat_ratio and used:
+            username = rng.choice(used)
+            result.append(
+                AuthAttempt(AuthAttempt.REPEATED, username, credentials[username])
+            )
+            continue
+
+        used.append(username)
+        result.append(AuthAttempt(AuthAttempt.VALID, username, credentials[username]))
+
+    return result
+
+
+class AuthStormResult:
+    """Collect the results of ``AuthStormBenchmark``.
+
+    The latency is recorded per kind of attempt. *Unexpected* results are
+    rejected valid logins and accepted invalid logins, *temporary* failures
+    are ``4xx`` responses to ``AUTH`` and *errors* are failed connections
+    (refused, reset, ``421``, TLS failures).
+    """
+
+    def __init__(self) -> None:
+        self.latency = {kind: LatencyRecorder(kind) for kind in AuthAttempt.KINDS}
+        self.unexpected = 0
+        self.temporary = 0
+        self.errors = 0
+        self.duration = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, attempt: AuthAttempt, accepted: bool, duration: float) -> None:
+        """Record a completed ``AUTH`` exchange."""
+        self.latency[attempt.kind].add(duration)
+        if accepted != attempt.expect_success:
+            logger.debug("Unexpected result for %r", attempt)
+            with self._lock:
+                self.unexpected += 1
+
+    def record_temporary(self) -> None:
+        """Record a temporary failure."""
+        with self._lock:
+            self.temporary += 1
+
+    def record_error(self) -> None:
+        """Record a failed connection."""
+        with self._lock:
+            self.errors += 1
+
+    @property
+    def failures(self) -> int:
+        """Return the overall number of failures."""
+        return self.unexpected + self.temporary + self.errors
+
+    def __str__(self) -> str:  # noqa: D105
+        count = sum(recorder.count for recorder in self.latency.values())
+        return "AUTH storm: {} logins in {:.1f}s ({:.1f}/s); failures: {} unexpected, {} temporary, {} errors".format(
+            count,
+            self.duration,
+            count / self.duration if self.duration else 0.0,
+            self.unexpected,
+            self.temporary,
+            self.errors,
+        )
+
+
+class AuthStormBenchmark(SubmissionTestSuite):
+    """Stress the SASL authentication of the submission port.
+
+    The suite's own connection performs the regular STARTTLS and AUTH of
+    ``SubmissionTestSuite``, using the first of the given accounts. After
+    that, the login attempts are run concurrently: every attempt opens a new
+    connection, establishes TLS, authenticates and quits. No mails are sent.
+
+    Parameters
+    ----------
+    credentials : dict
+        A ``dict``, mapping usernames to their plain text passwords.
+    attempts : int, optional
+        The number of login attempts (default: 500).
+    concurrency : int, optional
+        The number of concurrent connections (default: 50).
+    invalid_ratio : float, optional
+        The share of invalid logins (default: 0.1).
+    repeat_ratio : float, optional
+        The share of repeated logins (default: 0.3).
+    mechanism : str, optional
+        The SASL mechanism, ``PLAIN`` or ``LOGIN`` (default: PLAIN).
+    seed : int, optional
+        The seed to generate the attempts (default: 0).
+    suite_name : str, optional
+        The suites verbose name (default: AUTH Storm Benchmark).
+
+    Notes
+    -----
+    Only one SASL mechanism is used per attempt; ``smtplib``'s ``login()``
+    would try all mechanisms for invalid credentials, doubling their cost.
+
+    Dovecot delays failed logins (``auth_failure_delay``), so the latency of
+    invalid attempts is expected to be high.
+
+    For a full list of parameters refer to ``SubmissionTestSuite``.
+    """
+
+    def __init__(
+        self,
+        *args: Any,
+        credentials: Optional[dict[str, str]] = None,
+        attempts: int = 500,
+        concurrency: int = 50,
+        invalid_ratio: float = 0.1,
+        repeat_ratio: float = 0.3,
+        mechanism: str = "PLAIN",
+        seed: int = 0,
+        suite_name: str = "AUTH Storm Benchmark",
+        **kwargs: Optional[Any],
+    ) -> None:
+        if not credentials:
+            raise self.SmtpOperationalError("Missing parameter: 'credentials'")
+
+        username = sorted(credentials)[0]
+        super().__init__(
+            *args,
+            username=username,
+            password=credentials[username],
+            suite_name=suite_name,
+            **kwargs,  # type: ignore
+        )
+
+        if mechanism not in ("PLAIN", "LOGIN"):
+            raise self.SmtpOperationalError(
+                "Unsupported mechanism: '{}'".format(mechanism)
+            )
+        self.mechanism = mechanism
+
+        self.concurrency = concurrency
+        self.attempts = generate_auth_attempts(
+            credentials,
+            attempts,
+            invalid_ratio=invalid_ratio,
+            repeat_ratio=repeat_ratio,
+            seed=seed,
+        )
+
+        self.result = AuthStormResult()
+
+    def _attempt(self, attempt: AuthAttempt) -> None:
+        try:
+            smtp = self._open_connection()
+        except (OSError, smtplib.SMTPException) as e:
+            logger.debug("Connection failed: %s", e)  # noqa: G200
+            self.result.record_error()
+            return
+
+        try:
+            self._starttls(smtp)
+
+            smtp.user, smtp.password = attempt.username, attempt.password
+            if self.mechanism == "PLAIN":
+                authobject = smtp.auth_plain
+            else:
+                authobject = smtp.auth_login
+
+            start = time.perf_counter()
+            try:
+                smtp.auth(self.mechanism, authobject)
+                accepted = True
+            except smtplib.SMTPAuthenticationError as e:
+                if 400 <= e.smtp_code < 500:
+                    self.result.record_temporary()
+                    return
+                accepted = False
+            self.result.record(attempt, accepted, time.perf_counter() - start)
+
+            smtp.quit()
+        except (self.SmtpOperationalError, smtplib.SMTPException, OSError) as e:
+            logger.debug("Attempt failed: %s", e)  # noqa: G200
+            self.result.record_error()
+        finally:
+            smtp.close()
+
+    def _run_tests(self) -> None:
+        logger.info(
+            "Running %d login attempts with %d concurrent connections",
+            len(self.attempts),
+            self.concurrency,
+        )
+
+        start = time.perf_counter()
+        run_in_pool(self._attempt, self.attempts, max_workers=self.concurrency)
+        self.result.duration = time.perf_counter() - start
+
+        logger.summary("%s", self.result)  # type: ignore [attr-defined]
+        for recorder in self.result.latency.values():
+            logger.summary("%s", recorder)  # type: ignore [attr-defined]
+
+
+class TransferModeResult:
+    """Store the measurements of a single transfer mode.
+
+    Parameters
+    ----------
+    mode : str
+        One of ``TransferModeBenchmark.MODES``.
+    chunk_size : int, optional
+        The size of the ``BDAT`` chunks in bytes (only for ``BDAT``).
+    """
+
+    def __init__(self, mode: str, chunk_size: Optional[int] = None) -> None:
+        self.mode = mode
+        self.chunk_size = chunk_size
+        if chunk_size is None:
+            self.name = mode.upper()
+        else:
+            self.name = "{} {}k".format(mode.upper(), chunk_size // 1024)
+
+        # From ``MAIL FROM`` to the final reply
+        self.transfer = LatencyRecorder("{} transfer".format(self.name))
+        # From the end of the message to the final reply
+        self.response = LatencyRecorder("{} response".format(self.name))
+        # From the end of a (non-final) chunk to its reply
+        self.chunk_response = LatencyRecorder("{} chunk response".format(self.name))
+        self.bytes = 0
+        self.failures = 0
+
+    @property
+    def bytes_per_second(self) -> Optional[float]:
+        """Return the throughput of the (sequential) transactions."""
+        if self.transfer.count == 0:
+            return None
+        return self.bytes / self.transfer.total
+
+    def __str__(self) -> str:  # noqa: D105
+        if self.transfer.count == 0:
+            return "{:<12}: no successful transfer ({} failures)".format(
+                self.name, self.failures
+            )
+        return "{:<12}: {:7.2f} MiB/s, transfer p50 {:7.2f}ms, response p50 {:7.2f}ms p95 {:7.2f}ms ({} failures)".format(
+            self.name,
+            self.bytes_per_second / (1024 * 1024),  # type: ignore [operator]
+            self.transfer.percentile(50) * 1000,  # type: ignore [operator]
+            self.response.percentile(50) * 1000,  # type: ignore [operator]
+            self.response.percentile(95) * 1000,  # type: ignore [operator]
+            self.failures,
+        )
+
+
+class TransferModeBenchmark(SmtpGenericTestSuite):
+    """Compare the throughput of ``DATA``, ``BDAT`` and ``8BITMIME``.
+
+    A corpus of messages is generated once and then sent in every mode,
+    sequentially, over the suite's connection:
+
+    - ``data``: the classic ``DATA`` command, the body is dot-stuffed
+    - ``bdat``: ``BDAT`` chunking (RFC 3030), once per chunk size; no
+      dot-stuffing is required
+    - ``8bitmime``: ``DATA`` with ``BODY=8BITMIME``, the message is UTF-8 text
+      with ``Content-Transfer-Encoding: 8bit``
+    - ``qp`` / ``base64``: the same UTF-8 text with ``quoted-printable`` or
+      ``base64`` encoding, using plain ``DATA``
+
+    The corpus of the ``MessageFactory`` is 7-bit, so the last three modes use
+    UTF-8 text of the same sizes instead. Their results show the cost of the
+    7-bit encodings compared to sending the text as it is.
+
+    ``smtplib.sendmail()`` does not support ``BDAT`` and hides the stages of
+    the transaction, so the suite drives the transaction itself.
+
+    Parameters
+    ----------
+    recipient : str
+        The recipient of the mails.
+    from_address : str, optional
+        The address to be used as value to ``MAIL FROM:`` (default:
+        sender@another-host.test).
+    messages : int, optional
+        The number of messages in the corpus (default: 20).
+    message_factory : MessageFactory, optional
+        Generate the corpus with this factory (default: plain text messages
+        of 1 MiB).
+    modes : list, optional
+        The modes to benchmark (default: all of ``MODES``).
+    chunk_sizes : list, optional
+        The ``BDAT`` chunk sizes in bytes (default: 64 KiB and 1 MiB).
+    starttls : bool, optional
+        Use ``STARTTLS`` before sending (default: ``False``).
+    suite_name : str, optional
+        The suites verbose name (default: Transfer Mode Benchmark).
+
+    Notes
+    -----
+    Modes that the server does not advertise (``CHUNKING``, ``8BITMIME``) are
+    skipped with a warning.
+
+    The response latency is measured after the message was handed to the
+    socket; with big messages it includes the time to drain the socket's send
+    buffer.
+
+    The bodies are dot-stuffed once, while the corpus is prepared (see
+    ``MessageBody.stuffed``); the client's cost of dot-stuffing is not
+    included in the measurements. The per-message headers never contain a
+    line starting with a dot, they are sent separately, so the bodies are
+    never copied.
+
+    For a full list of parameters refer to ``SmtpGenericTestSuite``.
+    """
+
+    MODE_DATA = "data"
+    MODE_8BITMIME = "8bitmime"
+    MODE_QP = "qp"
+    MODE_BASE64 = "base64"
+    MODE_BDAT = "bdat"
+
+    MODES = (MODE_DATA, MODE_8BITMIME, MODE_QP, MODE_BASE64, MODE_BDAT)
+
+    # The transfer encodings of the UTF-8 text modes
+    TEXT_MODES = {
+        MODE_8BITMIME: CTE_8BIT,
+        MODE_QP: CTE_QUOTED_PRINTABLE,
+        MODE_BASE64: CTE_BASE64,
+    }
+
+    def __init__(
+        self,
+        *args: Any,
+        recipient: Optional[str] = None,
+        from_address: str = "sender@another-host.test",
+        messages: int = 20,
+        message_factory: Optional[MessageFactory] = None,
+        modes: Sequence[str] = MODES,
+        chunk_sizes: Sequence[int] = (64 * 1024, 1024 * 1024),
+        starttls: bool = False,
+        suite_name: str = "Transfer Mode Benchmark",
+        **kwargs: Optional[Any],
+    ) -> None:
+        super().__init__(  # type: ignore
+            *args,
+            suite_name=suite_name,
+            **kwargs,  # type: ignore
+        )
+
+        if recipient is None:
+            raise self.SmtpOperationalError("Missing parameter: 'recipient'")
+        self._recipient = recipient
+        self._from_address = from_address
+        self._starttls_enabled = starttls
+
+        for mode in modes:
+            if mode not in self.MODES:
+                raise self.SmtpOperationalError("Unknown mode: '{}'".format(mode))
+        self.modes = list(modes)
+        self.chunk_sizes = list(chunk_sizes)
+
+        if message_factory is None:
+            message_factory = MessageFactory(SizeDistribution({1024 * 1024: 1}))
+        # The bodies as they are (for ``BDAT``) and dot-stuffed (for ``DATA``)
+        self._corpus: list[tuple[bytes, bytes]] = []
+        for _ in range(messages):
+            body = message_factory.next_body()
+            self._corpus.append((body.data, body.stuffed))
+
+        # The UTF-8 text of the text modes, one body per size of the corpus
+        self._texts: dict[str, list[tuple[bytes, bytes]]] = {}
+        for mode, encoding in self.TEXT_MODES.items():
+            if mode not in self.modes:
+                continue
+            texts: dict[int, tuple[bytes, bytes]] = {}
+            for data, _ in self._corpus:
+                if len(data) not in texts:
+                    text = utf8_text_body(len(data), encoding)
+                    texts[len(data)] = (text, dot_stuff(text))
+            self._texts[mode] = [texts[len(data)] for data, _ in self._corpus]
+
+        self.results: list[TransferModeResult] = []
+
+    def _pre_run(self) -> None:
+        # The BDAT command and its chunk are sent separately; without this,
+        # Nagle's algorithm would hold back small chunks until the command is
+        # acknowledged
+        self.smtp.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # type: ignore [union-attr]
+
+        self.smtp.ehlo()
+        if self._starttls_enabled:
+            self._starttls()
+
+    def _reply(self, recorder: LatencyRecorder) -> int:
+        """Read a reply, recording its latency."""
+        start = time.perf_counter()
+        code, _ = self.smtp.getreply()
+        recorder.add(time.perf_counter() - start)
+        return code
+
+    def _send_data(
+        self, result: TransferModeResult, headers: bytes, stuffed: bytes
+    ) -> int:
+        self.smtp.putcmd("data")
+        code, _ = self.smtp.getreply()
+        if code != 354:
+            return code
+
+        self.smtp.send(headers)
+        self.smtp.send(stuffed)
+        self.smtp.send(b".\r\n")
+        return self._reply(result.response)
+
+    def _send_bdat(
+        self, result: TransferModeResult, headers: bytes, body: bytes, chunk_size: int
+    ) -> int:
+        # Only the first chunk, including the headers, is copied
+        split = max(chunk_size - len(headers), 0)
+        chunks: list[Union[bytes, memoryview]] = [headers + body[:split]]
+        view = memoryview(body)
+        chunks.extend(
+            view[offset : offset + chunk_size]
+            for offset in range(split, len(body), chunk_size)
+        )
+
+        for index, chunk in enumerate(chunks):
+            last = index == len(chunks) - 1
+
+            command = "BDAT {}{}\r\n".format(len(chunk), " LAST" if last else "")
+            self.smtp.send(command.encode("ascii"))
+            self.smtp.send(chunk)
+
+            if last:
+                return self._reply(result.response)
+
+            code = self._reply(result.chunk_response)
+            if code != 250:
+                return code
+
+        # not reached, as the message is never empty
+        return 250
+
+    def _transaction(
+        self, result: TransferModeResult, body: tuple[bytes, bytes]
+    ) -> None:
+        subject = self._generate_subject()
+        headers = MessageFactory.build_headers(
+            self._from_address, self._recipient, subject, subject
+        )
+        data, stuffed = body
+        size = len(headers) + len(data)
+
+        mail_options = []
+        if self.smtp.has_extn("size"):
+            mail_options.append("SIZE={}".format(size))
+        if result.mode == self.MODE_8BITMIME:
+            mail_options.append("BODY=8BITMIME")
+
+        self._protocol.mail_sent(subject, self.suite_name, self.origin)
+
+        start = time.perf_counter()
+        code, resp = self.smtp.mail(self._from_address, mail_options)
+        if code == 250:
+            code, resp = self.smtp.rcpt(self._recipient)
+        if code in (250, 251):
+            if result.mode == self.MODE_BDAT:
+                code = self._send_bdat(
+                    result, headers, data, result.chunk_size  # type: ignore [arg-type]
+                )
+            else:
+                code = self._send_data(result, headers, stuffed)
+        duration = time.perf_counter() - start
+
+        if code != 250:
+            logger.debug("%s: '%s' failed with %d", result.name, subject, code)
+            self._protocol.mail_rejected(subject)
+            result.failures += 1
+            self.smtp.rset()
+            return
+
+        self._protocol.mail_queued(subject, time.time())
+        self._protocol.mail_accepted(self._recipient, subject)
+        self.bytes_sent += size
+        result.bytes += size
+        result.transfer.add(duration)
+
+    def _run_tests(self) -> None:
+        runs: list[TransferModeResult] = []
+        for mode in self.modes:
+            if mode == self.MODE_BDAT:
+                if not self.smtp.has_extn("chunking"):
+                    logger.warning("Target does not offer CHUNKING, skipping BDAT")
+                    continue
+                runs.extend(TransferModeResult(mode, size) for size in self.chunk_sizes)
+            elif mode == self.MODE_8BITMIME and not self.smtp.has_extn("8bitmime"):
+                logger.warning("Target does not offer 8BITMIME, skipping")
+            else:
+                runs.append(TransferModeResult(mode))
+
+        logger.info(
+            "Sending %d messages (%d bytes) per mode",
+            len(self._corpus),
+            sum(len(data) for data, _ in self._corpus),
+        )
+        for result in runs:
+            corpus = self._texts.get(result.mode, self._corpus)
+            logger.verbose(  # type: ignore [attr-defined]
+                "Benchmarking %s (%d bytes)",
+                result.name,
+                sum(len(data) for data, _ in corpus),
+            )
+            for body in corpus:
+                self._transaction(result, body)
+
+            logger.summary("%s", result)  # type: ignore [attr-defined]
+            self.results.append(result)
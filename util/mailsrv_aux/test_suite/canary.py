@@ -0,0 +1,670 @@
+# SPDX-FileCopyrightText: 2022 Mischback
+# SPDX-License-Identifier: MIT
+# SPDX-FileType: SOURCE
+
+"""Continuously probe the delivery paths of a production setup.
+
+The canary sends a single tagged probe per interval through every delivery
+path (another MTA to a mailbox, another MTA to an alias, submission to a
+local user), confirms the delivery with a header-only mailbox check and
+deletes the probe afterwards. The round-trip latency (from queueing until the
+probe is found) is published as rolling statistics.
+
+The canary is meant to run for months next to production, so it keeps its
+footprint small:
+
+- The SMTP connections are kept open and reused; they are only re-established
+  after the server closed them.
+- The POP3 connections can not be reused, as Dovecot shows the state of a
+  mailbox at login time. A mailbox is only checked while probes are pending.
+- Nothing grows with the runtime: there is no ``SmtpTestProtocol``, the
+  latencies are kept in ring buffers (see ``RollingWindow``) and the probes
+  are forgotten once they are delivered or lost.
+"""
+
+# Python imports
+import logging
+import poplib
+import smtplib
+import socket
+import ssl
+import time
+from typing import Any, Optional
+
+# local imports
+from ..common.log import add_level
+from .exceptions import MailsrvTestException
+from .fixture_mail import GENERIC_VALID_MAIL
+from .latency import (
+    DELIVERY_PATHS,
+    PATH_ALIAS,
+    PATH_MAILBOX,
+    PATH_SUBMISSION,
+    DeliveryPoll,
+)
+from .metrics import RollingWindow
+from .openmetrics import MetricsRegistry
+from .pop3 import Pop3GenericTestSuite, UidlCache
+from .smtp import SmtpGenericTestSuite, SubmissionTestSuite
+from .tagging import RunTagger
+
+# get a module-level logger
+logger = logging.getLogger(__name__)
+
+# add VERBOSE / SUMMARY log levels
+add_level("VERBOSE", logging.INFO - 1)
+add_level("SUMMARY", logging.INFO + 1)
+
+# The number of round trips, the rolling statistics are based on
+DEFAULT_WINDOW = 100
+
+# Log the rolling statistics every 15 minutes
+CANARY_REPORT_INTERVAL = 900
+
+# The outcomes of a probe
+OUTCOME_SENT = "sent"
+OUTCOME_DELIVERED = "delivered"
+OUTCOME_LOST = "lost"
+OUTCOME_FAILED = "failed"
+
+
+class CanaryPath:
+    """Describe how the probes of a delivery path are sent and found.
+
+    Parameters
+    ----------
+    path : str
+        The delivery path, one of ``DELIVERY_PATHS``.
+    from_address : str
+        The address to be used as value to ``MAIL FROM:``.
+    recipient : str
+        The recipient of the probes.
+    mailboxes : list
+        The mailboxes, the probes are delivered to. A probe counts as
+        delivered, when it was found in all of them.
+    username : str, optional
+        The login for submission (default: ``None``, send as another MTA).
+    password : str, optional
+        The password for submission.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        from_address: str,
+        recipient: str,
+        mailboxes: list[str],
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+    ) -> None:
+        self.path = path
+        self.from_address = from_address
+        self.recipient = recipient
+        self.mailboxes = mailboxes
+        self.username = username
+        self.password = password
+
+    def __str__(self) -> str:  # noqa: D105
+        return "{}: {} -> {} ({})".format(
+            self.path, self.from_address, self.recipient, ", ".join(self.mailboxes)
+        )
+
+
+def select_canary_paths(
+    postfix_vmailboxes: list[str],
+    resolved_aliases: dict[str, list[str]],
+    external_aliases: dict[str, set[str]],
+    logins: dict[str, list[str]],
+    local_users: list[str],
+    from_address: str = "canary@another-host.test",
+) -> list[CanaryPath]:
+    """Select a recipient for every delivery path from the configuration.
+
+    Parameters
+    ----------
+    postfix_vmailboxes : list
+        The actual mailboxes.
+    resolved_aliases : dict
+        The resolved aliases, as provided by ``PostfixAliasResolver``.
+    external_aliases : dict
+        The aliases with external targets, which are not used, as the probes
+        could not be deleted.
+    logins : dict
+        The logins with the addresses, they may send as.
+    local_users : list
+        The users, that may be checked with POP3.
+    from_address : str, optional
+        The sender of the probes from another MTA (default:
+        canary@another-host.test).
+
+    Returns
+    -------
+    list
+        The ``CanaryPath`` instances; paths without a suitable recipient are
+        skipped. Credentials for submission have to be added by the caller.
+    """
+    users = set(local_users)
+    paths = []
+
+    mailbox = next((rcpt for rcpt in postfix_vmailboxes if rcpt in users), None)
+    if mailbox is None:
+        logger.warning("No mailbox for the canary's '%s' path", PATH_MAILBOX)
+    else:
+        paths.append(CanaryPath(PATH_MAILBOX, from_address, mailbox, [mailbox]))
+
+    # The alias with the fewest targets keeps the number of checks small
+    candidates = [
+        (len(targets), alias)
+        for alias, targets in resolved_aliases.items()
+        if targets
+        and alias not in external_aliases
+        and all(target in users for target in targets)
+    ]
+    if not candidates:
+        logger.warning("No alias for the canary's '%s' path", PATH_ALIAS)
+    else:
+        alias = min(candidates)[1]
+        paths.append(
+            CanaryPath(
+                PATH_ALIAS, from_address, alias, sorted(set(resolved_aliases[alias]))
+            )
+        )
+
+    login = next((login for login in logins if login in users), None)
+    if login is None:
+        logger.warning("No account for the canary's '%s' path", PATH_SUBMISSION)
+    else:
+        paths.append(
+            CanaryPath(
+                PATH_SUBMISSION, logins[login][0], login, [login], username=login
+            )
+        )
+
+    return paths
+
+
+class CanaryProbe:
+    """Track a single probe until it is delivered or lost."""
+
+    __slots__ = ("tag", "path", "mailboxes", "queued_at")
+
+    def __init__(self, tag: str, path: str, mailboxes: set[str]) -> None:
+        self.tag = tag
+        self.path = path
+        # The mailboxes, the probe was not yet found in
+        self.mailboxes = mailboxes
+        # The time (as returned by ``time.time()``), the probe was queued
+        self.queued_at = time.time()
+
+
+class CanarySender(SmtpGenericTestSuite):
+    """Send single probes over a persistent connection.
+
+    Other than the actual test suites, the sender is not run, but opened once
+    and used for every probe. If the server closed the connection in the
+    meantime, it is re-established and the probe is sent again.
+
+    Parameters
+    ----------
+    starttls : bool, optional
+        Use ``STARTTLS`` on the connection (default: ``True``).
+    suite_name : str, optional
+        The suites verbose name (default: Canary Sender).
+
+    Notes
+    -----
+    For a full list of parameters refer to ``SmtpGenericTestSuite``.
+    """
+
+    # Only keep the recent command latencies
+    latency_samples = DEFAULT_WINDOW
+
+    def __init__(
+        self,
+        *args: Any,
+        starttls: bool = True,
+        suite_name: str = "Canary Sender",
+        **kwargs: Optional[Any],
+    ) -> None:
+        super().__init__(  # type: ignore
+            *args,
+            suite_name=suite_name,
+            **kwargs,  # type: ignore
+        )
+        self.starttls = starttls
+        self._connected = False
+
+    def _pre_run(self) -> None:
+        if self.starttls:
+            self._starttls()
+
+    def _open(self) -> None:
+        self.smtp = self._open_connection()
+        try:
+            self._pre_run()
+        except BaseException:
+            self.smtp.close()
+            raise
+        self._connected = True
+        logger.verbose("Connection to target (%s) established", self.target_ip)  # type: ignore [attr-defined]
+
+    def close(self) -> None:
+        """Close the connection, if it is open."""
+        if not self._connected:
+            return
+        self._connected = False
+        try:
+            self.smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            self.smtp.close()
+
+    def send(self, from_addr: str, to_addr: str, tag: str) -> None:
+        """Send a single probe.
+
+        Raises
+        ------
+        SmtpTestSuiteError
+            Raised if the server rejected the probe.
+        SmtpOperationalError
+            Raised if the probe could not be sent, even on a new connection.
+        """
+        msg = GENERIC_VALID_MAIL.format(
+            mail_from=from_addr, rcpt_to=to_addr, subject=tag, tracking_id=tag
+        )
+
+        for attempt in (1, 2):
+            try:
+                if not self._connected:
+                    self._open()
+                self.smtp.sendmail(from_addr, [to_addr], msg)
+                return
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException) as e:
+                logger.error("Probe '%s' rejected: %s", tag, e)  # noqa: G200
+                # The connection is still usable after a rejection
+                if not isinstance(e, smtplib.SMTPResponseException) or (
+                    e.smtp_code != 421
+                ):
+                    raise self.SmtpTestSuiteError("Probe rejected")
+                self.smtp.close()
+                self._connected = False
+            except (smtplib.SMTPException, socket.timeout, OSError) as e:
+                logger.verbose("Connection lost (%s), attempt %d", e, attempt)  # type: ignore [attr-defined]
+                if self._connected:
+                    self.smtp.close()
+                    self._connected = False
+
+        raise self.SmtpOperationalError("Could not send probe")
+
+
+class CanarySubmissionSender(CanarySender, SubmissionTestSuite):
+    """Send single probes over a persistent, authenticated connection.
+
+    Notes
+    -----
+    For a full list of parameters refer to ``CanarySender`` and
+    ``SubmissionTestSuite``.
+    """
+
+    def __init__(
+        self,
+        *args: Any,
+        suite_name: str = "Canary Submission Sender",
+        **kwargs: Optional[Any],
+    ) -> None:
+        super().__init__(*args, suite_name=suite_name, **kwargs)  # type: ignore [arg-type]
+
+    def _pre_run(self) -> None:
+        self._starttls()
+        self._login()
+
+
+class CanaryCheck(DeliveryPoll):
+    """Find the canary's probes in a mailbox and delete them.
+
+    Only the headers of unknown messages are fetched; the tags of other
+    messages are remembered in the ``uidl_cache``. After the run, ``found``
+    contains the tags of the found (and deleted) probes.
+
+    Parameters
+    ----------
+    tag_prefix : str
+        Messages with a tag starting with this prefix are probes.
+
+    Notes
+    -----
+    For a full list of parameters refer to ``DeliveryPoll``.
+    """
+
+    def __init__(
+        self,
+        *args: Any,
+        tag_prefix: str,
+        suite_name: str = "Canary Check",
+        **kwargs: Optional[Any],
+    ) -> None:
+        super().__init__(
+            *args,
+            suite_name=suite_name,
+            expected_messages=[],
+            **kwargs,
+        )
+        self.tag_prefix = tag_prefix
+        self.found: list[str] = []
+
+    def _run_tests(self) -> None:
+        self.checked_at = time.time()
+
+        known = self.uidl_cache.get_mailbox(self.username)
+        kept: dict[str, str] = {}
+        try:
+            for item in self.pop.uidl()[1]:
+                msg_num, uid = item.decode().split(" ", 1)
+
+                tag = known.get(uid)
+                if tag is None:
+                    tag = self._get_message_tag(msg_num)
+
+                if tag.startswith(self.tag_prefix):
+                    self.pop.dele(msg_num)
+                    self.found.append(tag)
+                else:
+                    kept[uid] = tag
+        except poplib.error_proto as e:
+            logger.error("Could not process '%s': %s", self.username, e)  # noqa: G200
+            raise self.Pop3OperationalError("Mailbox check failed")
+
+        # Only the messages, that are still present, are remembered
+        self.uidl_cache.set_mailbox(self.username, kept)
+
+    def _disconnect(self) -> None:
+        # Other than the verification suites, there is no ``rset()``: the
+        # deletions are committed by ``QUIT``.
+        self.pop.quit()
+
+
+class CanaryRunner:
+    """Probe the delivery paths until interrupted.
+
+    Parameters
+    ----------
+    paths : list
+        The ``CanaryPath`` instances to probe.
+    credentials : dict
+        The passwords of the mailboxes.
+    target_ip : str, optional
+        The IP to connect to (default: 127.0.0.1).
+    smtp_port : int, optional
+        The port of the SMTP service (default: 25).
+    submission_port : int, optional
+        The port of the submission service (default: 587).
+    pop3_port : int, optional
+        The port of the POP3 service (default: 110).
+    tls_context : ssl.SSLContext, optional
+        The context to be used for ``STARTTLS`` / ``STLS``.
+    timeout : float, optional
+        The timeout of every blocking operation in seconds (default: 30).
+    interval : float, optional
+        Send a probe through every path every this number of seconds
+        (default: 60).
+    probe_timeout : float, optional
+        A probe, that was not found after this number of seconds, is lost
+        (default: 300).
+    poll_interval : float, optional
+        Check the mailboxes with pending probes every this number of seconds
+        (default: 1).
+    window : int, optional
+        The number of round trips per path, the rolling statistics are based
+        on (default: 100).
+    metrics : MetricsRegistry, optional
+        Publish the probes and round trips to this registry (default:
+        ``None``).
+    metrics_file : str, optional
+        Rewrite the registry to this file after every change (default:
+        ``None``).
+    cycles : int, optional
+        Stop after this number of intervals (default: ``None``, run until
+        interrupted).
+    """
+
+    class CanaryError(MailsrvTestException):
+        """Indicate an unusable canary configuration."""
+
+    def __init__(
+        self,
+        paths: list[CanaryPath],
+        credentials: dict[str, str],
+        target_ip: str = "127.0.0.1",
+        smtp_port: int = smtplib.SMTP_PORT,
+        submission_port: int = 587,
+        pop3_port: int = 110,
+        tls_context: Optional[ssl.SSLContext] = None,
+        timeout: float = 30.0,
+        interval: float = 60.0,
+        probe_timeout: float = 300.0,
+        poll_interval: float = 1.0,
+        window: int = DEFAULT_WINDOW,
+        metrics: Optional[MetricsRegistry] = None,
+        metrics_file: Optional[str] = None,
+        cycles: Optional[int] = None,
+    ) -> None:
+        if not paths:
+            raise self.CanaryError("No delivery path to probe")
+
+        self.paths = paths
+        self.credentials = credentials
+        self.target_ip = target_ip
+        self.smtp_port = smtp_port
+        self.submission_port = submission_port
+        self.pop3_port = pop3_port
+        self.tls_context = tls_context
+        self.timeout = timeout
+        self.interval = interval
+        self.probe_timeout = probe_timeout
+        self.poll_interval = poll_interval
+        self.metrics = metrics
+        self.metrics_file = metrics_file
+        self.cycles = cycles
+
+        self._tagger = RunTagger().suite()
+        self._tag_prefix = "{}-".format(self._tagger.run_id)
+        self._uidl_cache = UidlCache()
+        self._senders: dict[Optional[str], CanarySender] = {}
+        self.pending: dict[str, CanaryProbe] = {}
+        self.round_trip = {
+            path: RollingWindow("{} round trip".format(path), size=window)
+            for path in DELIVERY_PATHS
+        }
+
+    def _sender(self, path: CanaryPath) -> CanarySender:
+        """Return the (persistent) sender of a path."""
+        sender = self._senders.get(path.username, None)
+        if sender is not None:
+            return sender
+
+        common: dict[str, Any] = {
+            "target_ip": self.target_ip,
+            "tls_context": self.tls_context,
+            "timeout": self.timeout,
+        }
+        if path.username is None:
+            sender = CanarySender(target_port=self.smtp_port, **common)
+        else:
+            sender = CanarySubmissionSender(
+                target_port=self.submission_port,
+                username=path.username,
+                password=path.password,
+                **common,
+            )
+        self._senders[path.username] = sender
+        return sender
+
+    def _count(self, path: str, outcome: str) -> None:
+        if self.metrics is not None:
+            self.metrics.inc(
+                "canary_probes",
+                "Canary probes by delivery path and outcome.",
+                path=path,
+                outcome=outcome,
+            )
+
+    def _send_probes(self) -> None:
+        for path in self.paths:
+            tag = self._tagger.next_tag()
+            try:
+                self._sender(path).send(path.from_address, path.recipient, tag)
+            except SmtpGenericTestSuite.SmtpGenericException as e:
+                logger.error("Sending '%s' failed: %s", path.path, e)  # noqa: G200
+                self._count(path.path, OUTCOME_FAILED)
+                continue
+
+            self.pending[tag] = CanaryProbe(tag, path.path, set(path.mailboxes))
+            self._count(path.path, OUTCOME_SENT)
+            logger.debug("Probe '%s' sent through '%s'", tag, path.path)
+
+    def _delivered(self, probe: CanaryProbe, seconds: float) -> None:
+        logger.info(
+            "Probe '%s' (%s) delivered after %.3fs", probe.tag, probe.path, seconds
+        )
+        window = self.round_trip[probe.path]
+        window.add(seconds)
+        self._count(probe.path, OUTCOME_DELIVERED)
+
+        if self.metrics is None:
+            return
+        self.metrics.observe_value(
+            "canary_round_trip_seconds",
+            "Time from queueing until the probe was found.",
+            seconds,
+            path=probe.path,
+        )
+        for quantile in (50, 95, 100):
+            self.metrics.set(
+                "canary_round_trip_rolling_seconds",
+                "Round trip of the recent probes.",
+                window.percentile(quantile),  # type: ignore [arg-type]
+                path=probe.path,
+                quantile=str(quantile / 100),
+            )
+        self.metrics.set(
+            "canary_last_delivery_timestamp_seconds",
+            "The time, the last probe was found (Unix time).",
+            time.time(),
+            path=probe.path,
+        )
+
+    def _check(self) -> None:
+        """Check the mailboxes with pending probes."""
+        mailboxes = {
+            mailbox for probe in self.pending.values() for mailbox in probe.mailboxes
+        }
+        for mailbox in sorted(mailboxes):
+            check = CanaryCheck(
+                target_ip=self.target_ip,
+                target_port=self.pop3_port,
+                username=mailbox,
+                password=self.credentials[mailbox],
+                tag_prefix=self._tag_prefix,
+                uidl_cache=self._uidl_cache,
+                tls_context=self.tls_context,
+                timeout=self.timeout,
+            )
+            try:
+                check.run()
+            except (Pop3GenericTestSuite.Pop3GenericException, OSError) as e:
+                logger.warning("Could not check '%s': %s", mailbox, e)  # noqa: G200
+                continue
+
+            for tag in check.found:
+                probe = self.pending.get(tag, None)
+                if probe is None:
+                    # A lost probe, that showed up eventually
+                    logger.warning("Late probe '%s' removed from '%s'", tag, mailbox)
+                    continue
+
+                probe.mailboxes.discard(mailbox)
+                if not probe.mailboxes:
+                    del self.pending[tag]
+                    self._delivered(probe, check.checked_at - probe.queued_at)  # type: ignore [operator]
+
+    def _expire(self) -> None:
+        """Give up on probes, that were not found in time."""
+        deadline = time.time() - self.probe_timeout
+        for tag in [t for t, p in self.pending.items() if p.queued_at < deadline]:
+            probe = self.pending.pop(tag)
+            logger.error(
+                "Probe '%s' (%s) not found in %s after %.0fs",
+                tag,
+                probe.path,
+                ", ".join(sorted(probe.mailboxes)),
+                self.probe_timeout,
+            )
+            self._count(probe.path, OUTCOME_LOST)
+
+    def _publish(self) -> None:
+        if self.metrics is not None and self.metrics_file is not None:
+            self.metrics.set(
+                "canary_pending_probes",
+                "Probes, that were not found yet.",
+                len(self.pending),
+            )
+            self.metrics.write_textfile(self.metrics_file)
+
+    def report(self) -> None:
+        """Log the rolling statistics."""
+        logger.summary(  # type: ignore [attr-defined]
+            "Canary: %d probe(s) pending", len(self.pending)
+        )
+        for path in self.paths:
+            logger.summary("%s", self.round_trip[path.path])  # type: ignore [attr-defined]
+
+    def run(self) -> None:
+        """Probe the paths until interrupted (or ``cycles`` are done)."""
+        logger.summary(  # type: ignore [attr-defined]
+            "Running canary (run ID: %s), a probe every %.0fs through:",
+            self._tagger.run_id,
+            self.interval,
+        )
+        for path in self.paths:
+            logger.summary("  %s", path)  # type: ignore [attr-defined]
+
+        cycle = 0
+        next_send = time.monotonic()
+        next_report = next_send + CANARY_REPORT_INTERVAL
+        try:
+            while True:
+                now = time.monotonic()
+                cycles_done = self.cycles is not None and cycle >= self.cycles
+                if now >= next_send and not cycles_done:
+                    cycle += 1
+                    self._send_probes()
+                    # Skip the missed intervals of a stalled server
+                    next_send = max(next_send + self.interval, now)
+                    cycles_done = self.cycles is not None and cycle >= self.cycles
+
+                if self.pending:
+                    self._check()
+                    self._expire()
+                self._publish()
+
+                if now >= next_report:
+                    self.report()
+                    next_report = now + CANARY_REPORT_INTERVAL
+
+                # After the last cycle, only the pending probes are checked
+                if cycles_done:
+                    if not self.pending:
+                        break
+                    delay = self.poll_interval
+                else:
+                    delay = next_send - time.monotonic()
+                    if self.pending:
+                        delay = min(delay, self.poll_interval)
+                if delay > 0:
+                    time.sleep(delay)
+        except KeyboardInterrupt:
+            logger.summary("Canary interrupted")  # type: ignore [attr-defined]
+        finally:
+            for sender in self._senders.values():
+                sender.close()
+
+        self.report()
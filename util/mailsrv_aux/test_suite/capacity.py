@@ -0,0 +1,484 @@
+# SPDX-FileCopyrightText: 2022 Mischback
+# SPDX-License-Identifier: MIT
+# SPDX-FileType: SOURCE
+
+"""Discover the number of concurrent sessions the SUT is able to serve.
+
+Postfix limits the number of ``smtpd`` processes per service (``master.cf``,
+``default_process_limit``), Dovecot the number of login processes and their
+clients. Beyond these limits, new connections are queued (the greeting
+stalls), refused or closed.
+
+``ConcurrencyCeilingProbe`` ramps the number of concurrent sessions in steps
+and keeps all sessions open. *Idle* sessions only wait after the greeting,
+*active* sessions send a command on every step. The probe stops at the first
+step, where a connection is refused, reset or stalls, or the latency exceeds
+a threshold. The measurements of all steps form a ``CapacityCurve``, which
+may be saved to compare different configurations.
+
+The sessions use plain sockets instead of ``smtplib`` / ``poplib``, as these
+do not allow to control the timeouts of the individual stages.
+"""
+
+# Python imports
+import collections
+import json
+import logging
+import socket
+import time
+from typing import Any, Callable, Optional
+
+# local imports
+from ..common.exceptions import MailsrvIOException
+from ..common.log import add_level
+from .exceptions import MailsrvTestException
+from .metrics import LatencyRecorder
+from .parallel import run_in_pool
+
+# get a module-level logger
+logger = logging.getLogger(__name__)
+
+# add VERBOSE / SUMMARY log levels
+add_level("VERBOSE", logging.INFO - 1)
+add_level("SUMMARY", logging.INFO + 1)
+
+# The supported protocols
+PROTOCOL_SMTP = "smtp"
+PROTOCOL_POP3 = "pop3"
+PROTOCOLS = (PROTOCOL_SMTP, PROTOCOL_POP3)
+
+# The kinds of sessions
+MODE_IDLE = "idle"
+MODE_ACTIVE = "active"
+MODES = (MODE_IDLE, MODE_ACTIVE)
+
+# The outcomes of a session's operation
+OUTCOME_OK = "ok"
+OUTCOME_REFUSED = "refused"
+OUTCOME_RESET = "reset"
+OUTCOME_STALLED = "stalled"
+# The step's latency exceeded the threshold
+OUTCOME_SLOW = "slow"
+
+
+class ProbeSession:
+    """A single session of ``ConcurrencyCeilingProbe``.
+
+    Parameters
+    ----------
+    target_ip : str
+        The IP to connect to.
+    target_port : int
+        The port to connect to.
+    protocol : str
+        One of ``PROTOCOLS``.
+    timeout : float
+        Consider the session *stalled*, if the server does not respond within
+        this number of seconds.
+    local_hostname : str, optional
+        The hostname to be used in SMTP's ``EHLO`` (default:
+        mail.another-host.test).
+    """
+
+    def __init__(
+        self,
+        target_ip: str,
+        target_port: int,
+        protocol: str,
+        timeout: float,
+        local_hostname: str = "mail.another-host.test",
+    ) -> None:
+        self.target_ip = target_ip
+        self.target_port = target_port
+        self.protocol = protocol
+        self.timeout = timeout
+        self.local_hostname = local_hostname
+
+        self._sock: Optional[socket.socket] = None
+        self._file: Any = None
+
+    def _read_response(self) -> bool:
+        """Read a (possibly multi-line) response and return its success."""
+        line: bytes = self._file.readline()
+        if not line:
+            raise ConnectionResetError("Connection closed by server")
+
+        if self.protocol == PROTOCOL_POP3:
+            return line.startswith(b"+OK")
+
+        # SMTP: continuation lines have a ``-`` after the code
+        while line[3:4] == b"-":
+            line = self._file.readline()
+            if not line:
+                raise ConnectionResetError("Connection closed by server")
+        return line[:1] == b"2"
+
+    def _run(self, func: Callable[[], bool]) -> tuple[str, float]:
+        start = time.perf_counter()
+        try:
+            ok = func()
+        except socket.timeout:
+            return OUTCOME_STALLED, time.perf_counter() - start
+        except ConnectionRefusedError:
+            return OUTCOME_REFUSED, time.perf_counter() - start
+        except OSError as e:
+            logger.debug("Session failed: %s", e)  # noqa: G200
+            return OUTCOME_RESET, time.perf_counter() - start
+
+        if not ok:
+            # e.g. ``421`` or ``-ERR`` as greeting
+            return OUTCOME_REFUSED, time.perf_counter() - start
+        return OUTCOME_OK, time.perf_counter() - start
+
+    def _open(self) -> bool:
+        self._sock = socket.create_connection(
+            (self.target_ip, self.target_port), timeout=self.timeout
+        )
+        self._file = self._sock.makefile("rb")
+        return self._read_response()
+
+    def _exchange(self) -> bool:
+        if self.protocol == PROTOCOL_POP3:
+            # ``NOOP`` is not available before authentication
+            self._sock.sendall(b"CAPA\r\n")  # type: ignore [union-attr]
+            if not self._read_response():
+                return False
+            while self._file.readline() not in (b".\r\n", b""):
+                pass
+            return True
+
+        self._sock.sendall(  # type: ignore [union-attr]
+            "EHLO {}\r\n".format(self.local_hostname).encode("ascii")
+        )
+        return self._read_response()
+
+    def open(self) -> tuple[str, float]:
+        """Connect and wait for the greeting.
+
+        Returns
+        -------
+        tuple
+            The outcome (one of the ``OUTCOME_*`` constants) and the latency
+            in seconds.
+        """
+        return self._run(self._open)
+
+    def exchange(self) -> tuple[str, float]:
+        """Send a command and wait for the response, see ``open()``."""
+        return self._run(self._exchange)
+
+    def close(self) -> None:
+        """Close the session, without a proper ``QUIT``."""
+        if self._file is not None:
+            self._file.close()
+        if self._sock is not None:
+            self._sock.close()
+
+
+class CapacityPoint:
+    """Store the measurements of a single step of the ramp.
+
+    Parameters
+    ----------
+    level : int
+        The targeted number of concurrent sessions.
+    """
+
+    def __init__(self, level: int) -> None:
+        self.level = level
+        # The number of sessions, that were actually open after the step
+        self.sessions = 0
+        # The latency of the greetings of the sessions opened during the step
+        self.connect = LatencyRecorder("connect")
+        # The latency of the commands of all sessions (active sessions only)
+        self.command = LatencyRecorder("command")
+        self.failures: collections.Counter[str] = collections.Counter()
+
+    def breach(self, latency_threshold: float) -> Optional[str]:
+        """Return the reason, why the step exceeded the capacity, if any."""
+        for outcome in (OUTCOME_REFUSED, OUTCOME_RESET, OUTCOME_STALLED):
+            if self.failures[outcome]:
+                return outcome
+
+        for recorder in (self.connect, self.command):
+            p95 = recorder.percentile(95)
+            if p95 is not None and p95 > latency_threshold:
+                return OUTCOME_SLOW
+
+        return None
+
+    def to_dict(self) -> dict[str, Any]:
+        """Return the measurements as ``dict``, suitable for JSON."""
+        result: dict[str, Any] = {
+            "level": self.level,
+            "sessions": self.sessions,
+            "failures": dict(self.failures),
+        }
+        for recorder in (self.connect, self.command):
+            result[recorder.name] = {
+                "p50": recorder.percentile(50),
+                "p95": recorder.percentile(95),
+            }
+        return result
+
+    def __str__(self) -> str:  # noqa: D105
+        return "{:>5} sessions ({} open): {}; {}; failures: {}".format(
+            self.level,
+            self.sessions,
+            self.connect,
+            self.command,
+            dict(self.failures) or "none",
+        )
+
+
+class CapacityCurve:
+    """Store the outcome of a ``ConcurrencyCeilingProbe``.
+
+    Parameters
+    ----------
+    protocol : str
+        The probed protocol.
+    target_port : int
+        The probed port.
+    mode : str
+        The kind of sessions, one of ``MODES``.
+    label : str, optional
+        A label to identify the curve, e.g. the revision of the configuration
+        (default: empty).
+    """
+
+    def __init__(
+        self, protocol: str, target_port: int, mode: str, label: str = ""
+    ) -> None:
+        self.protocol = protocol
+        self.target_port = target_port
+        self.mode = mode
+        self.label = label
+
+        self.points: list[CapacityPoint] = []
+        # The first level, that exceeded the capacity, and the reason
+        self.ceiling: Optional[int] = None
+        self.reason: Optional[str] = None
+
+    def to_dict(self) -> dict[str, Any]:
+        """Return the curve as ``dict``, suitable for JSON."""
+        return {
+            "label": self.label,
+            "protocol": self.protocol,
+            "port": self.target_port,
+            "mode": self.mode,
+            "ceiling": self.ceiling,
+            "reason": self.reason,
+            "points": [point.to_dict() for point in self.points],
+        }
+
+    def __str__(self) -> str:  # noqa: D105
+        if self.ceiling is None:
+            last = self.points[-1].sessions if self.points else 0
+            return "{} port {} ({}): no ceiling up to {} sessions".format(
+                self.protocol, self.target_port, self.mode, last
+            )
+        return "{} port {} ({}): ceiling at {} sessions ({})".format(
+            self.protocol, self.target_port, self.mode, self.ceiling, self.reason
+        )
+
+
+def save_curves(curves: list[CapacityCurve], file_path: str) -> None:
+    """Write the curves to a JSON file.
+
+    Raises
+    ------
+    MailsrvIOException
+        Any ``OSError`` will be catched and converted to an
+        ``MailsrvIOException``.
+    """
+    try:
+        with open(file_path, "w") as f:
+            json.dump([curve.to_dict() for curve in curves], f, indent=2)
+    except OSError as e:
+        logger.error("Could not write '%s'", file_path)
+        logger.debug(e, exc_info=True)  # noqa: G200
+        raise MailsrvIOException("Could not write '{}'".format(file_path))
+
+
+def load_curves(file_path: str) -> list[dict[str, Any]]:
+    """Read curves, written by ``save_curves()``.
+
+    Raises
+    ------
+    MailsrvIOException
+        Any ``OSError`` or invalid content will be converted to an
+        ``MailsrvIOException``.
+    """
+    try:
+        with open(file_path, "r") as f:
+            return list(json.load(f))
+    except (OSError, ValueError) as e:
+        logger.error("Could not read '%s'", file_path)
+        logger.debug(e, exc_info=True)  # noqa: G200
+        raise MailsrvIOException("Could not read '{}'".format(file_path))
+
+
+def log_curve_comparison(
+    baseline: list[dict[str, Any]], curves: list[CapacityCurve]
+) -> None:
+    """Log the ceilings of ``curves`` next to the ones of a saved baseline.
+
+    Curves are matched by protocol, port and mode.
+    """
+    known = {(c["protocol"], c["port"], c["mode"]): c for c in baseline}
+    for curve in curves:
+        previous = known.get((curve.protocol, curve.target_port, curve.mode), None)
+        if previous is None:
+            logger.summary("%s; no baseline", curve)  # type: ignore [attr-defined]
+            continue
+
+        logger.summary(  # type: ignore [attr-defined]
+            "%s; baseline '%s': %s",
+            curve,
+            previous["label"],
+            "no ceiling"
+            if previous["ceiling"] is None
+            else "ceiling at {} sessions ({})".format(
+                previous["ceiling"], previous["reason"]
+            ),
+        )
+
+
+class ConcurrencyCeilingProbe:
+    """Ramp the number of concurrent sessions until the server pushes back.
+
+    Parameters
+    ----------
+    target_ip : str, optional
+        The IP to connect to (default: 127.0.0.1).
+    target_port : int, optional
+        The port to connect to (default: 25).
+    protocol : str, optional
+        One of ``PROTOCOLS`` (default: smtp).
+    mode : str, optional
+        One of ``MODES``. Active sessions send a command (SMTP: ``EHLO``,
+        POP3: ``CAPA``) on every step (default: idle).
+    step : int, optional
+        The number of sessions to add per step (default: 10).
+    max_sessions : int, optional
+        Stop the ramp at this number of sessions (default: 500).
+    latency_threshold : float, optional
+        Consider the capacity exceeded, if the 95th percentile of the latency
+        of a step exceeds this number of seconds (default: 1).
+    stall_timeout : float, optional
+        Consider a session stalled, if the server does not respond within this
+        number of seconds (default: 10).
+    max_workers : int, optional
+        The maximum number of threads to open sessions and send commands
+        (default: 64).
+    label : str, optional
+        The label of the resulting curve (default: empty).
+
+    Notes
+    -----
+    The sessions are closed without ``QUIT`` after the ramp. The server may
+    take a moment to release the processes, so consecutive probes against
+    the same service should be separated by a pause.
+    """
+
+    class CapacityProbeError(MailsrvTestException):
+        """Indicate operational errors of the probe."""
+
+    def __init__(
+        self,
+        target_ip: str = "127.0.0.1",
+        target_port: int = 25,
+        protocol: str = PROTOCOL_SMTP,
+        mode: str = MODE_IDLE,
+        step: int = 10,
+        max_sessions: int = 500,
+        latency_threshold: float = 1.0,
+        stall_timeout: float = 10.0,
+        max_workers: int = 64,
+        label: str = "",
+    ) -> None:
+        if protocol not in PROTOCOLS:
+            raise self.CapacityProbeError("Unknown protocol: '{}'".format(protocol))
+        if mode not in MODES:
+            raise self.CapacityProbeError("Unknown mode: '{}'".format(mode))
+
+        self.target_ip = target_ip
+        self.target_port = target_port
+        self.protocol = protocol
+        self.mode = mode
+        self.step = max(step, 1)
+        self.max_sessions = max_sessions
+        self.latency_threshold = latency_threshold
+        self.stall_timeout = stall_timeout
+        self.max_workers = max_workers
+        self.label = label
+
+    def _new_session(self) -> ProbeSession:
+        return ProbeSession(
+            self.target_ip, self.target_port, self.protocol, self.stall_timeout
+        )
+
+    def _ramp_step(self, sessions: list[ProbeSession], level: int) -> CapacityPoint:
+        """Add sessions up to ``level`` and measure the step."""
+        point = CapacityPoint(level)
+
+        new = [self._new_session() for _ in range(level - len(sessions))]
+        outcomes = run_in_pool(ProbeSession.open, new, max_workers=self.max_workers)
+        for session, (outcome, latency) in zip(new, outcomes):
+            if outcome == OUTCOME_OK:
+                point.connect.add(latency)
+                sessions.append(session)
+            else:
+                point.failures[outcome] += 1
+                session.close()
+
+        if self.mode == MODE_ACTIVE:
+            outcomes = run_in_pool(
+                ProbeSession.exchange, sessions, max_workers=self.max_workers
+            )
+            for session, (outcome, latency) in list(zip(sessions, outcomes)):
+                if outcome == OUTCOME_OK:
+                    point.command.add(latency)
+                else:
+                    point.failures[outcome] += 1
+                    session.close()
+                    sessions.remove(session)
+
+        point.sessions = len(sessions)
+        return point
+
+    def run(self) -> CapacityCurve:
+        """Ramp the sessions and return the capacity curve."""
+        logger.summary(  # type: ignore [attr-defined]
+            "Probing the concurrency of %s port %d (%s sessions)",
+            self.protocol,
+            self.target_port,
+            self.mode,
+        )
+
+        curve = CapacityCurve(self.protocol, self.target_port, self.mode, self.label)
+        sessions: list[ProbeSession] = []
+        try:
+            level = 0
+            while level < self.max_sessions:
+                level = min(level + self.step, self.max_sessions)
+                point = self._ramp_step(sessions, level)
+                curve.points.append(point)
+                logger.verbose("%s", point)  # type: ignore [attr-defined]
+
+                if point.connect.count == 0 and not sessions:
+                    logger.critical("Target (%s) accepts no sessions", self.target_ip)
+                    raise self.CapacityProbeError("No session established")
+
+                reason = point.breach(self.latency_threshold)
+                if reason is not None:
+                    curve.ceiling = level
+                    curve.reason = reason
+                    break
+        finally:
+            for session in sessions:
+                session.close()
+
+        logger.summary("%s", curve)  # type: ignore [attr-defined]
+        return curve
@@ -0,0 +1,319 @@
+# SPDX-FileCopyrightText: 2022 Mischback
+# SPDX-License-Identifier: MIT
+# SPDX-FileType: SOURCE
+
+"""Remove the test mails of a run from the mailboxes.
+
+The verification suites have no side effects, so every run leaves its mails
+behind. Repeated runs make the mailboxes grow, slowing down every later
+verification and moving the accounts towards their quota. The suites of this
+module delete the messages, that carry the tag of a given run (see
+``mailsrv_aux.test_suite.tagging``); all other messages are left untouched.
+
+- POP3: the messages are identified by ``UIDL`` and the ``TRACKING_HEADER``
+  (using the ``UidlCache``) and deleted with ``DELE``. If the server
+  announces ``PIPELINING`` (RFC 2449), the ``DELE`` commands are sent in
+  batches without waiting for the single responses.
+- IMAP: the messages are located with ``UID SEARCH``, flagged with
+  ``UID STORE`` and removed with ``UID EXPUNGE`` (RFC 4315, ``UIDPLUS``).
+"""
+
+# Python imports
+import imaplib
+import logging
+import poplib
+from typing import Any, Optional, Sequence, Union
+
+# local imports
+from ..common.log import add_level
+from .exceptions import MailsrvTestException
+from .imap import ImapVerifyMailGotDelivered
+from .parallel import run_in_pool
+from .pop3 import VerifyMailGotDelivered
+from .tagging import tag_run_id
+from .tls import TlsSessionContext
+
+# get a module-level logger
+logger = logging.getLogger(__name__)
+
+# add VERBOSE / SUMMARY log levels
+add_level("VERBOSE", logging.INFO - 1)
+add_level("SUMMARY", logging.INFO + 1)
+
+# The number of messages deleted with a single batch of commands
+CLEANUP_BATCH_SIZE = 100
+
+
+def _batches(items: list[Any], size: int = CLEANUP_BATCH_SIZE) -> list[list[Any]]:
+    """Split ``items`` into lists of at most ``size`` elements."""
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+class Pop3CleanupMailbox(VerifyMailGotDelivered):
+    """Delete the messages of the given runs from a mailbox, using POP3.
+
+    Parameters
+    ----------
+    run_ids : list
+        The IDs of the runs, whose messages are deleted.
+
+    Notes
+    -----
+    After the run, ``deleted_messages`` contains the number of deleted
+    messages and ``reclaimed_bytes`` their size, as reported by ``LIST``.
+
+    For a full list of parameters refer to ``VerifyMailGotDelivered``.
+    """
+
+    def __init__(
+        self,
+        *args: Any,
+        run_ids: Sequence[str],
+        suite_name: str = "Cleanup Mailbox Test Suite",
+        **kwargs: Optional[Any],
+    ) -> None:
+        super().__init__(
+            *args,
+            suite_name=suite_name,
+            expected_messages=[],
+            **kwargs,
+        )
+        self.run_ids = set(run_ids)
+
+        self.deleted_messages = 0
+        self.reclaimed_bytes = 0
+
+    def _pipelining(self) -> bool:
+        """Return ``True``, if the server announces ``PIPELINING``."""
+        try:
+            return "PIPELINING" in self.pop.capa()
+        except poplib.error_proto:
+            # CAPA is not supported
+            return False
+
+    def _delete(self, msg_nums: list[str], pipelining: bool) -> None:
+        """Mark a batch of messages as deleted."""
+        if not pipelining:
+            for msg_num in msg_nums:
+                self.pop.dele(msg_num)
+            return
+
+        for msg_num in msg_nums:
+            self.pop._putcmd("DELE {}".format(msg_num))  # type: ignore [attr-defined]
+
+        # All responses have to be read, before an error may be raised
+        errors = []
+        for msg_num in msg_nums:
+            try:
+                self.pop._getresp()  # type: ignore [attr-defined]
+            except poplib.error_proto as e:
+                errors.append("{}: {}".format(msg_num, e))
+        if errors:
+            raise poplib.error_proto("DELE failed for {}".format(errors))
+
+    def _run_tests(self) -> None:
+        pipelining = self._pipelining()
+
+        known = self.uidl_cache.get_mailbox(self.username)
+        kept: dict[str, str] = {}
+        deleted: list[str] = []
+        try:
+            sizes = dict(item.decode().split(" ", 1) for item in self.pop.list()[1])
+
+            for item in self.pop.uidl()[1]:
+                msg_num, uid = item.decode().split(" ", 1)
+
+                tag = known.get(uid)
+                if tag is None:
+                    tag = self._get_message_tag(msg_num)
+
+                if tag_run_id(tag) in self.run_ids:
+                    deleted.append(msg_num)
+                else:
+                    kept[uid] = tag
+
+            for batch in _batches(deleted):
+                self._delete(batch, pipelining)
+        except poplib.error_proto as e:
+            logger.error("Could not clean up '%s': %s", self.username, e)  # noqa: G200
+            raise self.Pop3OperationalError("Cleanup failed")
+
+        # Only the messages, that are kept, are remembered
+        self.uidl_cache.set_mailbox(self.username, kept)
+
+        self.deleted_messages = len(deleted)
+        self.reclaimed_bytes = sum(int(sizes.get(msg_num, 0)) for msg_num in deleted)
+        logger.verbose(  # type: ignore [attr-defined]
+            "%d message(s), %d bytes deleted from '%s'",
+            self.deleted_messages,
+            self.reclaimed_bytes,
+            self.username,
+        )
+
+    def _disconnect(self) -> None:
+        # Other than the verification suites, there is no ``rset()``: the
+        # deletions are committed by ``QUIT``.
+        self.pop.quit()
+
+
+class ImapCleanupMailbox(ImapVerifyMailGotDelivered):
+    """Delete the messages of the given runs from a mailbox, using IMAP.
+
+    Parameters
+    ----------
+    run_ids : list
+        The IDs of the runs, whose messages are deleted.
+
+    Notes
+    -----
+    Without ``UIDPLUS``, a plain ``EXPUNGE`` is used, which removes *all*
+    messages flagged as ``Deleted``, not only the ones of the runs.
+
+    After the run, ``deleted_messages`` contains the number of deleted
+    messages and ``reclaimed_bytes`` their size (``RFC822.SIZE``).
+
+    For a full list of parameters refer to ``ImapVerifyMailGotDelivered``.
+    """
+
+    def __init__(
+        self,
+        *args: Any,
+        run_ids: Sequence[str],
+        suite_name: str = "Cleanup Mailbox Test Suite (IMAP)",
+        **kwargs: Optional[Any],
+    ) -> None:
+        super().__init__(
+            *args,
+            suite_name=suite_name,
+            expected_messages=[],
+            **kwargs,  # type: ignore [arg-type]
+        )
+        self.run_ids = set(run_ids)
+
+        self.deleted_messages = 0
+        self.reclaimed_bytes = 0
+
+    def _select(self) -> None:
+        """Open the mailbox read-write, so messages may be deleted."""
+        typ, data = self.imap.select(self.mailbox)
+        if typ != "OK":
+            logger.critical("Could not open '%s': %r", self.mailbox, data)
+            raise self.ImapOperationalError("SELECT failed")
+
+    def _pre_run(self) -> None:
+        self._starttls()
+        self._auth()
+
+        if isinstance(self.tls_context, TlsSessionContext):
+            self.tls_context.remember_session(self.imap.sock)
+
+        self._select()
+
+    def _delete(self, uids: list[bytes]) -> None:
+        """Flag a batch of messages as deleted and expunge them."""
+        uid_set = b",".join(uids).decode()
+        try:
+            typ, data = self.imap.uid("STORE", uid_set, "+FLAGS.SILENT", r"(\Deleted)")
+            if typ == "OK":
+                if "UIDPLUS" in self.imap.capabilities:
+                    # ``imaplib`` does not know ``UID EXPUNGE``
+                    typ, data = self.imap._simple_command("UID", "EXPUNGE", uid_set)
+                else:
+                    typ, data = self.imap.expunge()
+        except imaplib.IMAP4.error as e:
+            logger.critical("Deletion failed: %s", e)  # noqa: G200
+            raise self.ImapOperationalError("Cleanup failed")
+
+        if typ != "OK":
+            logger.critical("Deletion failed: %r", data)
+            raise self.ImapOperationalError("Cleanup failed")
+
+    def _run_tests(self) -> None:
+        if "UIDPLUS" not in self.imap.capabilities:
+            logger.warning(
+                "'%s' does not support UIDPLUS, using EXPUNGE", self.target_ip
+            )
+
+        for run_id in sorted(self.run_ids):
+            # All tags of a run start with the run ID, followed by a dash
+            uids = self._search("{}-".format(run_id))
+            for batch in _batches(uids):
+                found = self._fetch_sizes(batch)
+                self._delete(batch)
+                self.deleted_messages += len(found)
+                self.reclaimed_bytes += sum(size for _, size in found)
+
+        logger.verbose(  # type: ignore [attr-defined]
+            "%d message(s), %d bytes deleted from '%s'",
+            self.deleted_messages,
+            self.reclaimed_bytes,
+            self.username,
+        )
+
+
+TCleanupSuite = Union[Pop3CleanupMailbox, ImapCleanupMailbox]
+
+
+def _cleanup_mailbox(suite: TCleanupSuite) -> Optional[str]:
+    """Run a single cleanup suite and return an error, if any.
+
+    No exception is propagated, so a failing mailbox does not cancel the
+    cleanup of the others.
+    """
+    try:
+        suite.run()
+    except MailsrvTestException as e:
+        return str(e)
+    except Exception as e:
+        logger.debug(e, exc_info=True)  # noqa: G200
+        return str(e) or type(e).__name__
+
+    return None
+
+
+def cleanup_mailboxes(
+    suites: Sequence[TCleanupSuite], max_workers: int = 8
+) -> tuple[int, int]:
+    """Clean up several mailboxes concurrently.
+
+    A failing mailbox does not stop the cleanup of the others.
+
+    Parameters
+    ----------
+    suites : list
+        The cleanup suites (POP3 or IMAP), one per mailbox.
+    max_workers : int, optional
+        The maximum number of concurrent connections (default: 8).
+
+    Returns
+    -------
+    tuple
+        The number of deleted messages and the reclaimed bytes.
+
+    Raises
+    ------
+    MailsrvTestException
+        Raised after all mailboxes were processed, if at least one mailbox
+        could not be cleaned up.
+    """
+    logger.verbose("Cleaning up %d mailboxes with up to %d workers", len(suites), max_workers)  # type: ignore [attr-defined]
+    errors = run_in_pool(_cleanup_mailbox, suites, max_workers=max_workers)
+
+    messages = sum(suite.deleted_messages for suite in suites)
+    reclaimed = sum(suite.reclaimed_bytes for suite in suites)
+    logger.summary(  # type: ignore [attr-defined]
+        "Cleanup: %d message(s) deleted, %d bytes reclaimed in %d mailboxes",
+        messages,
+        reclaimed,
+        len(suites),
+    )
+
+    failed = {suite.username: error for suite, error in zip(suites, errors) if error}
+    for username, error in failed.items():
+        logger.error("Could not clean up '%s': %s", username, error)
+    if failed:
+        raise MailsrvTestException(
+            "Cleanup failed for {} of {} mailboxes".format(len(failed), len(suites))
+        )
+
+    return messages, reclaimed
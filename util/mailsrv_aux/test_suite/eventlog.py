@@ -0,0 +1,134 @@
+# SPDX-FileCopyrightText: 2022 Mischback
+# SPDX-License-Identifier: MIT
+# SPDX-FileType: SOURCE
+
+"""Provide an append-only log for the events of SMTP test suites.
+
+Long running tests may send millions of mails. Instead of keeping every event
+in memory, ``SmtpTestProtocol`` may stream its events to an ``EventLog``: one
+JSON object per line. Lines are written in batches and the file is ``fsync``'d
+after every batch, so a crash loses at most one batch. A log may be replayed to
+rebuild the protocol, e.g. to resume the verification of a run.
+"""
+
+# Python imports
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Iterator
+
+# local imports
+from ..common.exceptions import MailsrvIOException
+
+# get a module-level logger
+logger = logging.getLogger(__name__)
+
+
+class EventLog:
+    """Append events to a JSONL file, syncing the file in batches.
+
+    Parameters
+    ----------
+    file_path : str
+        The path of the log file. Events are appended, if the file exists.
+    batch_size : int, optional
+        Write and ``fsync`` the pending events after this number of events
+        (default: 1000).
+    batch_interval : float, optional
+        Write and ``fsync`` the pending events, if the last sync is longer ago
+        than this number of seconds (default: 1).
+
+    Raises
+    ------
+    MailsrvIOException
+        Any ``OSError`` will be catched and converted to an
+        ``MailsrvIOException``.
+
+    Notes
+    -----
+    The log may be shared between suites running in different threads.
+    """
+
+    def __init__(
+        self, file_path: str, batch_size: int = 1000, batch_interval: float = 1.0
+    ) -> None:
+        self.file_path = file_path
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+
+        self._pending: list[str] = []
+        self._last_sync = time.monotonic()
+        self._lock = threading.Lock()
+
+        try:
+            self._file = open(file_path, "a")
+        except OSError as e:
+            logger.error("Could not open '%s'", file_path)
+            logger.debug(e, exc_info=True)  # noqa: G200
+            raise MailsrvIOException("Could not open '{}'".format(file_path))
+
+    def append(self, event: dict[str, Any]) -> None:
+        """Add an event to the log."""
+        line = json.dumps(event, separators=(",", ":"))
+        with self._lock:
+            self._pending.append(line)
+            if (
+                len(self._pending) >= self.batch_size
+                or time.monotonic() - self._last_sync >= self.batch_interval
+            ):
+                self._sync()
+
+    def flush(self) -> None:
+        """Write and ``fsync`` all pending events."""
+        with self._lock:
+            self._sync()
+
+    def close(self) -> None:
+        """Write all pending events and close the file."""
+        with self._lock:
+            self._sync()
+            if not self._file.closed:
+                self._file.close()
+
+    def _sync(self) -> None:
+        # The caller has to hold the lock
+        self._last_sync = time.monotonic()
+        if not self._pending or self._file.closed:
+            return
+
+        try:
+            self._file.write("\n".join(self._pending) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except OSError as e:
+            logger.error("Error while writing '%s'", self.file_path)
+            logger.debug(e, exc_info=True)  # noqa: G200
+            raise MailsrvIOException("Error while writing '{}'".format(self.file_path))
+
+        self._pending = []
+
+
+def read_events(file_path: str) -> Iterator[dict[str, Any]]:
+    """Read the events of a log file.
+
+    A truncated last line (e.g. after a crash) is skipped with a warning.
+
+    Raises
+    ------
+    MailsrvIOException
+        Any ``OSError`` will be catched and converted to an
+        ``MailsrvIOException``.
+    """
+    try:
+        with open(file_path, "r") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    logger.warning("Skipping incomplete event in '%s'", file_path)
+    except OSError as e:
+        logger.error("Could not read '%s'", file_path)
+        logger.debug(e, exc_info=True)  # noqa: G200
+        raise MailsrvIOException("Could not read '{}'".format(file_path))
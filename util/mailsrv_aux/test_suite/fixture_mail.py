@@ -6,6 +6,7 @@
 
 GENERIC_VALID_MAIL = (
     "Subject: {subject}\r\n"
+    "X-Mailsrv-Test-Id: {tracking_id}\r\n"
     "From: {mail_from}\r\n"
     "To: {rcpt_to}\r\n"
     "\r\n"
@@ -0,0 +1,372 @@
+# SPDX-FileCopyrightText: 2022 Mischback
+# SPDX-License-Identifier: MIT
+# SPDX-FileType: SOURCE
+
+"""Test suite using IMAP.
+
+Other than POP3, IMAP lets the server do the matching: the expected messages
+are located with ``UID SEARCH``, which is answered from Dovecot's indexes. Only
+the UIDs and sizes of the matching messages are fetched, so even big mailboxes
+may be verified cheaply.
+"""
+
+# Python imports
+import collections
+import imaplib
+import logging
+import re
+import socket
+import ssl
+import time
+from typing import Any, Optional
+
+# local imports
+from ..common.log import add_level
+from .exceptions import MailsrvTestException
+from .metrics import LatencyRecorder, LatencySlo, check_slos
+from .tagging import TRACKING_HEADER
+from .tls import TlsSessionContext
+
+# get a module-level logger
+logger = logging.getLogger(__name__)
+
+# add VERBOSE / SUMMARY log levels
+add_level("VERBOSE", logging.INFO - 1)
+add_level("SUMMARY", logging.INFO + 1)
+
+# Extract UID and size from a ``FETCH`` response
+FETCH_UID_SIZE = re.compile(rb"UID (\d+)|RFC822\.SIZE (\d+)")
+
+
+class ImapGenericTestSuite:
+    """Provide the IMAP protocol abstraction for actual test suites.
+
+    Parameters
+    ----------
+    target_ip : str, optional
+        The IP to connect to (default: 127.0.0.1).
+    target_port : int, optional
+        The port to use for the connection (default: 143).
+    suite_name : str, optional
+        The name of the test suite. Should be set to distinguish several suites
+        (default: Generic IMAP Suite).
+    username : str
+        The username to use during IMAP's login. This is marked as *optional*
+        for Python's typing, but a default value of ``None`` is provided which
+        results in a ``ImapOperationalError`` if not overwritten.
+    password : str
+        The password to use during IMAP's login. This is marked as *optional*
+        for Python's typing, but a default value of ``None`` is provided which
+        results in a ``ImapOperationalError`` if not overwritten.
+    tls_context : ssl.SSLContext, optional
+        The context to be used for ``STARTTLS``. Provide a shared
+        ``TlsSessionContext`` to resume TLS sessions across suites (default:
+        ``None``, meaning ``imaplib``'s default context).
+    mailbox : str, optional
+        The IMAP folder to examine (default: INBOX).
+    timeout : float, optional
+        The timeout of every blocking operation in seconds (default: 30).
+    slos : list, optional
+        The ``LatencySlo`` instances to check the measured latencies against,
+        e.g. ``p95 SEARCH < 50ms``. A violation fails the suite (default: no
+        SLOs).
+    """
+
+    class ImapGenericException(MailsrvTestException):
+        """Base class for all exceptions of IMAP test suites."""
+
+    class ImapOperationalError(ImapGenericException):
+        """Indicate operational errors, most likely while using ``imaplib``."""
+
+    class ImapTestSuiteError(ImapGenericException):
+        """Indicate an actual test failure."""
+
+    class ImapSloViolation(ImapTestSuiteError):
+        """Indicate that the measured latencies violate the suite's SLOs."""
+
+    def __init__(
+        self,
+        target_ip: str = "127.0.0.1",
+        target_port: int = 143,
+        suite_name: str = "Generic IMAP Suite",
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        tls_context: Optional[ssl.SSLContext] = None,
+        mailbox: str = "INBOX",
+        timeout: float = 30.0,
+        slos: Optional[list[LatencySlo]] = None,
+    ) -> None:
+        self.target_ip = target_ip
+        self.target_port = target_port
+        self.suite_name = suite_name
+        self.tls_context = tls_context
+        self.mailbox = mailbox
+        self.timeout = timeout
+        self.slos = slos or []
+
+        if username is None:
+            logger.critical("Missing parameter: 'username'")
+            raise self.ImapOperationalError("Missing parameter: 'username'")
+        self.username = username
+
+        if password is None:
+            logger.critical("Missing parameter: 'password'")
+            raise self.ImapOperationalError("Missing parameter: 'password'")
+        self.password = password
+
+    def _connect(self) -> None:
+        try:
+            self.imap = imaplib.IMAP4(
+                self.target_ip, port=self.target_port, timeout=self.timeout
+            )
+        except ConnectionRefusedError:
+            logger.critical("Target (%s) refused the connection", self.target_ip)
+            raise self.ImapOperationalError("Connection refused")
+        except socket.timeout:
+            logger.critical(
+                "Target (%s) did not answer within %.1fs", self.target_ip, self.timeout
+            )
+            raise self.ImapOperationalError("Timeout")
+        except imaplib.IMAP4.error as e:
+            logger.critical("Unexpected greeting: %s", e)  # noqa: G200
+            raise self.ImapOperationalError("Connection failed")
+        except OSError as e:
+            logger.critical(  # noqa: G200
+                "Could not connect to target (%s): %s", self.target_ip, e
+            )
+            raise self.ImapOperationalError("Connection failed")
+
+        logger.info("Connection to target (%s) established", self.target_ip)
+
+    def _auth(self) -> None:
+        try:
+            self.imap.login(self.username, self.password)
+        except imaplib.IMAP4.error as e:
+            logger.critical("Authentication failed: %s", e)  # noqa: G200
+            raise self.ImapOperationalError("Authentication failed")
+
+    def _starttls(self) -> None:
+        try:
+            self.imap.starttls(ssl_context=self.tls_context)
+        except imaplib.IMAP4.error as e:
+            logger.critical("STARTTLS failed: %s", e)  # noqa: G200
+            raise self.ImapOperationalError("TLS failure")
+
+    def _examine(self) -> None:
+        """Open the mailbox read-only, so the run has no side effects."""
+        typ, data = self.imap.select(self.mailbox, readonly=True)
+        if typ != "OK":
+            logger.critical("Could not open '%s': %r", self.mailbox, data)
+            raise self.ImapOperationalError("EXAMINE failed")
+
+    def _pre_connect(self) -> None:
+        pass
+
+    def _pre_run(self) -> None:
+        pass
+
+    def _post_run(self) -> None:
+        pass
+
+    def _disconnect(self) -> None:
+        try:
+            self.imap.logout()
+        except (imaplib.IMAP4.error, OSError):
+            # The connection might already be gone
+            pass
+        logger.verbose("Connection to target (%s) terminated", self.target_ip)  # type: ignore [attr-defined]
+
+    def _run_tests(self) -> None:
+        raise NotImplementedError("Has to be implemented in real test suite")
+
+    def _latencies(self) -> dict[str, LatencyRecorder]:
+        """Return the measured latencies by operation, to be checked by SLOs."""
+        return {}
+
+    def _check_slos(self) -> None:
+        """Check the measured latencies against the suite's SLOs.
+
+        Raises
+        ------
+        ImapSloViolation
+            Raised if at least one SLO is violated.
+        """
+        violations = check_slos(self.slos, self._latencies())
+        for violation in violations:
+            logger.error("SLO violated: %s", violation)
+        if violations:
+            raise self.ImapSloViolation(
+                "{} SLO violation(s) in {}".format(len(violations), self.suite_name)
+            )
+
+    def run(self) -> None:
+        """Run the test suite."""
+        logger.summary("Running %s", self.suite_name)  # type: ignore [attr-defined]
+        self._pre_connect()
+        self._connect()
+        try:
+            self._pre_run()
+            try:
+                self._run_tests()
+                self._post_run()
+            finally:
+                self._disconnect()
+        except socket.timeout:
+            logger.critical(
+                "Target (%s) did not answer within %.1fs", self.target_ip, self.timeout
+            )
+            raise self.ImapOperationalError("Timeout")
+        except (imaplib.IMAP4.abort, OSError) as e:
+            logger.critical(  # noqa: G200
+                "Connection to target (%s) failed: %s", self.target_ip, e
+            )
+            raise self.ImapOperationalError("Connection failed")
+
+        self._check_slos()
+
+        logger.summary("%s finished successfully", self.suite_name)  # type: ignore [attr-defined]
+
+
+class ImapVerifyMailGotDelivered(ImapGenericTestSuite):
+    """Check the mailbox of a given user for expected mails, using IMAP.
+
+    Every expected subject is located with ``UID SEARCH HEADER``; the server
+    does the matching. Only the UIDs and the sizes of the matching messages
+    are fetched.
+
+    Parameters
+    ----------
+    expected_messages : list
+        A ``list`` of ``str``, representing the subjects of the messages,
+        expected to be present in the mailbox. A subject may be included
+        several times, if several messages with that subject are expected.
+    search_header : str, optional
+        The header to search for the expected values (default:
+        ``TRACKING_HEADER``, carrying the tag that is also used as subject).
+
+    Notes
+    -----
+    ``SEARCH HEADER`` matches substrings, so a subject that is part of
+    another subject may produce false positives. The tags of the SMTP suites
+    are not affected, as all of them have the same length.
+
+    After the run, ``missing_messages`` contains the subjects that could not
+    be found, ``found_messages`` the UIDs and sizes of the found messages and
+    ``search_latency`` the duration of the searches.
+
+    For a full list of parameters refer to ``ImapGenericTestSuite``.
+    """
+
+    def __init__(
+        self,
+        *args: Any,
+        suite_name: str = "Verify messages in Mailbox Test Suite (IMAP)",
+        expected_messages: Optional[list[str]] = None,
+        search_header: str = TRACKING_HEADER,
+        **kwargs: Optional[Any],
+    ) -> None:
+        super().__init__(  # type: ignore
+            *args,
+            suite_name=suite_name,
+            **kwargs,  # type: ignore [arg-type]
+        )
+
+        if expected_messages is None:
+            raise self.ImapOperationalError("Missing parameter: 'expected_mails'")
+        self.expected_messages = expected_messages
+        self.search_header = search_header
+
+        self.missing_messages: list[str] = []
+        self.found_messages: dict[str, list[tuple[int, int]]] = {}
+        self.search_latency = LatencyRecorder("IMAP search")
+
+    def _pre_run(self) -> None:
+        self._starttls()
+        self._auth()
+
+        if isinstance(self.tls_context, TlsSessionContext):
+            self.tls_context.remember_session(self.imap.sock)
+
+        self._examine()
+
+    def _search(self, value: str) -> list[bytes]:
+        """Return the UIDs of the messages with ``value`` in the search header."""
+        quoted = '"{}"'.format(value.replace("\\", "\\\\").replace('"', '\\"'))
+
+        start = time.perf_counter()
+        try:
+            typ, data = self.imap.uid("SEARCH", "HEADER", self.search_header, quoted)
+        except imaplib.IMAP4.error as e:
+            logger.critical("Search failed: %s", e)  # noqa: G200
+            raise self.ImapOperationalError("SEARCH failed")
+        self.search_latency.add(time.perf_counter() - start)
+
+        if typ != "OK":
+            logger.critical("Search failed: %r", data)
+            raise self.ImapOperationalError("SEARCH failed")
+
+        return b" ".join(item for item in data if item).split()
+
+    def _latencies(self) -> dict[str, LatencyRecorder]:
+        return {"SEARCH": self.search_latency}
+
+    def _fetch_sizes(self, uids: list[bytes]) -> list[tuple[int, int]]:
+        """Return the UIDs and sizes of the given messages."""
+        try:
+            typ, data = self.imap.uid(
+                "FETCH", b",".join(uids).decode(), "(RFC822.SIZE)"
+            )
+        except imaplib.IMAP4.error as e:
+            logger.critical("Fetch failed: %s", e)  # noqa: G200
+            raise self.ImapOperationalError("FETCH failed")
+
+        if typ != "OK":
+            logger.critical("Fetch failed: %r", data)
+            raise self.ImapOperationalError("FETCH failed")
+
+        result = []
+        for item in data:
+            if not isinstance(item, bytes):
+                continue
+            uid = size = None
+            for match in FETCH_UID_SIZE.finditer(item):
+                if match.group(1) is not None:
+                    uid = int(match.group(1))
+                else:
+                    size = int(match.group(2))
+            if uid is not None and size is not None:
+                result.append((uid, size))
+
+        return result
+
+    def _run_tests(self) -> None:
+        expected = collections.Counter(self.expected_messages)
+
+        for subject, count in expected.items():
+            uids = self._search(subject)
+            if not uids:
+                continue
+
+            found = self._fetch_sizes(uids)
+            logger.debug("Found '%s': %r", subject, found)
+            self.found_messages[subject] = found
+            expected[subject] = max(count - len(found), 0)
+
+        logger.verbose(  # type: ignore [attr-defined]
+            "%d message(s), %d bytes found in '%s'; %s",
+            sum(len(found) for found in self.found_messages.values()),
+            sum(size for found in self.found_messages.values() for _, size in found),
+            self.mailbox,
+            self.search_latency,
+        )
+
+        self.missing_messages = list(expected.elements())
+        if self.missing_messages:
+            logger.error(
+                "Could not find expected message(s): %s", self.missing_messages
+            )
+            raise self.ImapTestSuiteError(
+                "At least one expected message could not be found"
+            )
+
+        logger.info("All expected messages found")
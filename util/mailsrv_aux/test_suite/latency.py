@@ -0,0 +1,379 @@
+# SPDX-FileCopyrightText: 2022 Mischback
+# SPDX-License-Identifier: MIT
+# SPDX-FileType: SOURCE
+
+"""Measure the end-to-end delivery latency of queued mails.
+
+The SMTP suites record the time, the server accepted a mail, in the
+protocol's correlation index (see ``SmtpTestProtocol.lookup()``). The
+mailboxes are then polled with an increasing interval until every expected
+message showed up or a timeout is reached. The latency of a message is the
+time between its acceptance by the server and the first poll that found it in
+the mailbox.
+
+Only the headers of new messages are fetched while polling (see
+``VerifyMailGotDelivered``), so the polls are cheap. As the latency is
+observed by polling, it is an upper bound, with a resolution of the current
+poll interval.
+
+The measured latencies may be checked against SLOs on the operations
+``delivery`` (all messages) and ``<path>-delivery``, e.g.
+``p95 alias-delivery < 5s``.
+"""
+
+# Python imports
+import collections
+import logging
+import poplib
+import socket
+import ssl
+import time
+from typing import Any, Optional
+
+# local imports
+from ..common.log import add_level
+from .metrics import LatencyRecorder, LatencySlo, check_slos
+from .parallel import run_in_pool
+from .planner import DeliveryPlanner
+from .pop3 import Pop3GenericTestSuite, UidlCache, VerifyMailGotDelivered
+from .protocols import SmtpTestProtocol
+
+# get a module-level logger
+logger = logging.getLogger(__name__)
+
+# add VERBOSE / SUMMARY log levels
+add_level("VERBOSE", logging.INFO - 1)
+add_level("SUMMARY", logging.INFO + 1)
+
+# The paths a mail may take into a mailbox
+PATH_MAILBOX = "mailbox"
+PATH_ALIAS = "alias"
+PATH_SUBMISSION = "submission"
+DELIVERY_PATHS = (PATH_MAILBOX, PATH_ALIAS, PATH_SUBMISSION)
+
+
+def map_deliveries(
+    smtp_protocol: SmtpTestProtocol,
+    postfix_vmailboxes: list[str],
+    resolved_aliases: dict[str, list[str]],
+) -> dict[str, list[tuple[str, str]]]:
+    """Map the accepted mails to mailboxes, including their delivery path.
+
+    Parameters
+    ----------
+    smtp_protocol : SmtpTestProtocol
+        The protocol of the SMTP suites.
+    postfix_vmailboxes : list
+        The actual mailboxes.
+    resolved_aliases : dict
+        The resolved aliases, as provided by ``PostfixAliasResolver``.
+
+    Returns
+    -------
+    dict
+        The mailboxes (as keys) with a ``list`` of ``(subject, path)`` tuples.
+        Mails from the submission suites have the path ``"submission"``, all
+        other mails ``"mailbox"`` or ``"alias"``, depending on their recipient.
+    """
+    planner = DeliveryPlanner(postfix_vmailboxes, resolved_aliases)
+    result: dict[str, list[tuple[str, str]]] = collections.defaultdict(list)
+
+    deliveries = list(planner.deliveries(smtp_protocol))
+    records = smtp_protocol.lookup_many(subject for _, subject, _ in deliveries)
+
+    for mailbox, subject, rcpt in deliveries:
+        record = records.get(subject, None)
+        if record is not None and record.origin == PATH_SUBMISSION:
+            path = PATH_SUBMISSION
+        elif planner.is_alias(rcpt):
+            path = PATH_ALIAS
+        else:
+            path = PATH_MAILBOX
+        result[mailbox].append((subject, path))
+
+    return dict(result)
+
+
+class DeliveryPoll(VerifyMailGotDelivered):
+    """Check a mailbox once, without treating missing messages as failure.
+
+    After the run, ``missing_messages`` contains the subjects that could not
+    be found and ``checked_at`` the time (as returned by ``time.time()``), the
+    mailbox's content was listed.
+
+    Notes
+    -----
+    For a full list of parameters refer to ``VerifyMailGotDelivered``.
+    """
+
+    def __init__(
+        self,
+        *args: Any,
+        suite_name: str = "Delivery Poll",
+        **kwargs: Optional[Any],
+    ) -> None:
+        super().__init__(*args, suite_name=suite_name, **kwargs)
+
+        self.checked_at: Optional[float] = None
+
+    def _run_tests(self) -> None:
+        self.checked_at = time.time()
+        self.missing_messages = self._find_expected()
+
+    def run(self) -> None:
+        """Poll the mailbox.
+
+        Other than the actual test suites, the poll is not logged, as it is
+        repeated several times.
+        """
+        self._pre_connect()
+        self._connect()
+        try:
+            self._pre_run()
+            try:
+                self._run_tests()
+            finally:
+                self._disconnect()
+        except socket.timeout:
+            raise self.Pop3OperationalError("Timeout")
+        except (poplib.error_proto, OSError) as e:
+            raise self.Pop3OperationalError("Connection failed: {}".format(e))
+
+
+class DeliveryLatencyReport:
+    """Store the delivery latencies, per delivery path."""
+
+    def __init__(self) -> None:
+        self.latency = {
+            path: LatencyRecorder("{} delivery".format(path)) for path in DELIVERY_PATHS
+        }
+        self.overall = LatencyRecorder("delivery")
+        self.polls = 0
+
+        # The messages, that did not show up before the timeout
+        self.missing: dict[str, list[str]] = {}
+        # The mailboxes, that could not be checked during the last poll
+        self.failed: dict[str, str] = {}
+
+    def record(self, path: str, seconds: float) -> None:
+        """Record the latency of a single message."""
+        self.latency[path].add(seconds)
+        self.overall.add(seconds)
+
+    @property
+    def complete(self) -> bool:
+        """Return ``True``, if all expected messages were found."""
+        return not self.missing and not self.failed
+
+    def check_slos(self, slos: list[LatencySlo]) -> list[str]:
+        """Check the latencies against ``slos`` and return the violations."""
+        recorders = {"delivery": self.overall}
+        for path in DELIVERY_PATHS:
+            recorders["{}-delivery".format(path)] = self.latency[path]
+
+        return check_slos(slos, recorders)
+
+    def __str__(self) -> str:  # noqa: D105
+        return "{} message(s) delivered, {} missing, after {} poll(s)".format(
+            self.overall.count,
+            sum(len(subjects) for subjects in self.missing.values()),
+            self.polls,
+        )
+
+
+class DeliveryLatencyPoller:
+    """Poll mailboxes until all expected messages are delivered.
+
+    Every poll checks all mailboxes with outstanding messages concurrently.
+    The interval between polls starts with ``initial_interval`` and is
+    multiplied by ``backoff`` after every poll, up to ``max_interval``.
+
+    Parameters
+    ----------
+    deliveries : dict
+        The mailboxes (as keys) with their expected messages as ``list`` of
+        ``(subject, path)`` tuples, see ``map_deliveries()``.
+    smtp_protocol : SmtpTestProtocol
+        The protocol of the SMTP suites, providing the queue times.
+    credentials : dict
+        The passwords of the mailboxes.
+    target_ip : str, optional
+        The IP to connect to (default: 127.0.0.1).
+    target_port : int, optional
+        The POP3 port (default: 110, from ``poplib.POP3_PORT``).
+    tls_context : ssl.SSLContext, optional
+        The context to be used for ``STLS`` (default: ``None``).
+    uidl_cache : UidlCache, optional
+        The cache of already known subjects (default: a new in-memory cache).
+    timeout : float, optional
+        Stop polling after this number of seconds (default: 300).
+    initial_interval : float, optional
+        The initial interval between polls in seconds (default: 0.25).
+    max_interval : float, optional
+        The upper bound of the interval in seconds (default: 5).
+    backoff : float, optional
+        The factor to increase the interval with (default: 1.5).
+    max_workers : int, optional
+        The maximum number of concurrent POP3 connections (default: 8).
+    pop3_timeout : float, optional
+        The timeout of every blocking POP3 operation in seconds (default: 30).
+    """
+
+    def __init__(
+        self,
+        deliveries: dict[str, list[tuple[str, str]]],
+        smtp_protocol: SmtpTestProtocol,
+        credentials: dict[str, str],
+        target_ip: str = "127.0.0.1",
+        target_port: int = poplib.POP3_PORT,
+        tls_context: Optional[ssl.SSLContext] = None,
+        uidl_cache: Optional[UidlCache] = None,
+        timeout: float = 300.0,
+        initial_interval: float = 0.25,
+        max_interval: float = 5.0,
+        backoff: float = 1.5,
+        max_workers: int = 8,
+        pop3_timeout: float = 30.0,
+    ) -> None:
+        self.deliveries = deliveries
+        self.smtp_protocol = smtp_protocol
+        self.credentials = credentials
+        self.target_ip = target_ip
+        self.target_port = target_port
+        self.tls_context = tls_context
+        self.timeout = timeout
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.max_workers = max_workers
+        self.pop3_timeout = pop3_timeout
+
+        if uidl_cache is None:
+            self.uidl_cache = UidlCache()
+        else:
+            self.uidl_cache = uidl_cache
+
+        # The queue times of the expected messages, set by ``run()``
+        self._queued_at: dict[str, Optional[float]] = {}
+
+    def _poll(self, suite: DeliveryPoll) -> Optional[str]:
+        """Run a single poll and return an error, if any.
+
+        A failed poll is repeated with the next poll of the mailbox.
+        """
+        try:
+            suite.run()
+        except (Pop3GenericTestSuite.Pop3GenericException, OSError) as e:
+            return str(e)
+
+        return None
+
+    def _collect(
+        self,
+        suite: DeliveryPoll,
+        outstanding: dict[str, list[tuple[str, str]]],
+        report: DeliveryLatencyReport,
+    ) -> None:
+        """Record the latencies of the found messages of a poll."""
+        missing = collections.Counter(suite.missing_messages)
+        remaining = []
+
+        for subject, path in outstanding[suite.username]:
+            if missing[subject] > 0:
+                missing[subject] -= 1
+                remaining.append((subject, path))
+                continue
+
+            queued_at = self._queued_at.get(subject, None)
+            if queued_at is None or suite.checked_at is None:
+                logger.debug("No queue time for '%s'", subject)
+                continue
+
+            latency = suite.checked_at - queued_at
+            logger.debug(
+                "'%s' delivered to '%s' (%s) after %.3fs",
+                subject,
+                suite.username,
+                path,
+                latency,
+            )
+            report.record(path, latency)
+
+        if remaining:
+            outstanding[suite.username] = remaining
+        else:
+            del outstanding[suite.username]
+
+    def run(self) -> DeliveryLatencyReport:
+        """Poll the mailboxes and return the measured latencies."""
+        report = DeliveryLatencyReport()
+        outstanding = {
+            mailbox: list(expected)
+            for mailbox, expected in self.deliveries.items()
+            if expected
+        }
+
+        # The queue times are looked up at once, reading an event log only once
+        self._queued_at = {
+            tag: record.queued_at
+            for tag, record in self.smtp_protocol.lookup_many(
+                subject for expected in outstanding.values() for subject, _ in expected
+            ).items()
+        }
+
+        interval = self.initial_interval
+        deadline = time.time() + self.timeout
+        while outstanding:
+            suites = [
+                DeliveryPoll(
+                    target_ip=self.target_ip,
+                    target_port=self.target_port,
+                    username=mailbox,
+                    password=self.credentials[mailbox],
+                    expected_messages=[subject for subject, _ in expected],
+                    uidl_cache=self.uidl_cache,
+                    tls_context=self.tls_context,
+                    timeout=self.pop3_timeout,
+                )
+                for mailbox, expected in outstanding.items()
+            ]
+            errors = run_in_pool(self._poll, suites, max_workers=self.max_workers)
+            report.polls += 1
+
+            report.failed = {}
+            for suite, error in zip(suites, errors):
+                if error:
+                    report.failed[suite.username] = error
+                    continue
+                self._collect(suite, outstanding, report)
+
+            if not outstanding or time.time() + interval > deadline:
+                break
+
+            logger.verbose(  # type: ignore [attr-defined]
+                "%d message(s) outstanding in %d mailbox(es), next poll in %.2fs",
+                sum(len(expected) for expected in outstanding.values()),
+                len(outstanding),
+                interval,
+            )
+            time.sleep(interval)
+            interval = min(self.max_interval, interval * self.backoff)
+
+        report.missing = {
+            mailbox: [subject for subject, _ in expected]
+            for mailbox, expected in outstanding.items()
+        }
+        return report
+
+
+def log_latency_report(report: DeliveryLatencyReport) -> None:
+    """Log the latencies and the missing messages of a report."""
+    logger.summary("%s", report)  # type: ignore [attr-defined]
+    logger.summary("%s", report.overall)  # type: ignore [attr-defined]
+    for path in DELIVERY_PATHS:
+        logger.summary("%s", report.latency[path])  # type: ignore [attr-defined]
+
+    for mailbox, subjects in report.missing.items():
+        logger.error("Missing in '%s': %r", mailbox, subjects)
+    for mailbox, error in report.failed.items():
+        logger.error("Could not check '%s': %s", mailbox, error)
@@ -0,0 +1,336 @@
+# SPDX-FileCopyrightText: 2022 Mischback
+# SPDX-License-Identifier: MIT
+# SPDX-FileType: SOURCE
+
+"""Discover the effective message size limits of the SUT.
+
+Postfix limits the size of messages (``message_size_limit``) and Dovecot the
+size of mailboxes (``MAILSRV_MAILBOX_QUOTA``, checked by Postfix through the
+``quota-status`` policy service and again during LMTP delivery). The probe of
+this module binary-searches the largest message the server accepts and
+reports the stage that enforced the limit:
+
+- ``size``: ``MAIL FROM`` was rejected, because of the declared ``SIZE``
+- ``rcpt``: ``RCPT TO`` was rejected, e.g. by the quota policy service
+- ``data``: the message was rejected after its data was transferred
+- ``delivery``: the message was accepted, but never showed up in the mailbox
+  (LMTP / quota), see ``SizeLimitResult.apply_delivery()``
+
+The messages are generated while they are sent (see ``StreamedBody``), so
+the client never holds a message in memory.
+"""
+
+# Python imports
+import logging
+import smtplib
+import time
+from typing import Any, Optional
+
+# local imports
+from ..common.log import add_level
+from .messages import MessageFactory, StreamedBody
+from .smtp import SmtpGenericTestSuite, SubmissionTestSuite
+
+# get a module-level logger
+logger = logging.getLogger(__name__)
+
+# add VERBOSE / SUMMARY log levels
+add_level("VERBOSE", logging.INFO - 1)
+add_level("SUMMARY", logging.INFO + 1)
+
+# The stages, that may enforce a limit
+STAGE_SIZE = "size"
+STAGE_RCPT = "rcpt"
+STAGE_DATA = "data"
+STAGE_DELIVERY = "delivery"
+
+# Responses to ``RCPT TO``, that indicate a size-related rejection
+# (``552``: exceeded storage allocation, ``452``: insufficient storage)
+SIZE_RELATED_RCPT_CODES = (452, 552)
+
+
+class SizeLimitResult:
+    """Store the outcome of a ``SizeLimitProbe``.
+
+    Parameters
+    ----------
+    path : str
+        The path of the probed mails, e.g. ``"mta"`` or ``"submission"``.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+        # The largest accepted and the smallest rejected size (in bytes)
+        self.accepted_size: Optional[int] = None
+        self.rejected_size: Optional[int] = None
+        # The stage, that rejected the smallest rejected size
+        self.stage: Optional[str] = None
+
+        # The tags of the accepted probes, with their sizes
+        self.accepted: dict[str, int] = {}
+        # The probed sizes, with the rejecting stage (``None`` if accepted)
+        self.probes: list[tuple[int, Optional[str]]] = []
+
+    def record(self, size: int, stage: Optional[str], tag: str) -> None:
+        """Record the outcome of a single probe."""
+        self.probes.append((size, stage))
+
+        if stage is None:
+            self.accepted[tag] = size
+            if self.accepted_size is None or size > self.accepted_size:
+                self.accepted_size = size
+        elif self.rejected_size is None or size < self.rejected_size:
+            self.rejected_size = size
+            self.stage = stage
+
+    def apply_delivery(self, missing: list[str]) -> None:
+        """Take the delivery of the accepted probes into account.
+
+        Accepted probes, that did not show up in the mailbox, move the limit
+        below the smallest of them; the limit is then enforced during
+        delivery. The resolution is limited to the accepted sizes.
+
+        Parameters
+        ----------
+        missing : list
+            The tags of the accepted probes, that were not delivered.
+        """
+        undelivered = [
+            self.accepted.pop(tag) for tag in missing if tag in self.accepted
+        ]
+        if not undelivered:
+            return
+
+        self.rejected_size = min(undelivered)
+        self.stage = STAGE_DELIVERY
+
+        delivered = [
+            size for size in self.accepted.values() if size < self.rejected_size
+        ]
+        self.accepted_size = max(delivered) if delivered else None
+
+    def __str__(self) -> str:  # noqa: D105
+        if self.rejected_size is None:
+            return "{}: no limit up to {} bytes".format(self.path, self.accepted_size)
+        if self.accepted_size is None:
+            return "{}: all probes rejected, smallest at {} bytes ({})".format(
+                self.path, self.rejected_size, self.stage
+            )
+        return "{}: limit between {} and {} bytes, enforced at '{}'".format(
+            self.path, self.accepted_size, self.rejected_size, self.stage
+        )
+
+
+class SizeLimitProbe(SmtpGenericTestSuite):
+    """Binary-search the largest message the server accepts.
+
+    The probe starts with ``max_size``; if that is rejected, the limit is
+    searched between ``min_size`` and ``max_size`` until the interval is
+    smaller than ``resolution``. All probes are sent to ``recipient``.
+
+    Parameters
+    ----------
+    recipient : str
+        The recipient of the probes.
+    from_address : str, optional
+        The address to be used as value to ``MAIL FROM:`` (default:
+        sender@another-host.test).
+    min_size : int, optional
+        The lower bound of the search in bytes, expected to be accepted
+        (default: 1 KiB).
+    max_size : int, optional
+        The upper bound of the search in bytes (default: 64 MiB).
+    resolution : int, optional
+        Stop the search, if the limit is known with this precision in bytes
+        (default: 64 KiB).
+    declare_size : bool, optional
+        Declare the message size with ``MAIL FROM`` (``SIZE=``), if the
+        server supports it. Without declaration, the limit can only be
+        enforced after the data was transferred (default: ``True``).
+    chunk_size : int, optional
+        The size of the chunks, the messages are generated and sent in
+        (default: 64 KiB).
+    starttls : bool, optional
+        Use ``STARTTLS`` before sending (default: ``False``).
+    suite_name : str, optional
+        The suites verbose name (default: Size Limit Probe).
+
+    Notes
+    -----
+    The accepted probes are actually delivered and count towards the quota of
+    the recipient's mailbox. Thus, the probes may cause the rejection of
+    later probes (or other mails), if the quota is smaller than the sum of the
+    accepted sizes.
+
+    After the run, ``result`` provides the outcome.
+
+    For a full list of parameters refer to ``SmtpGenericTestSuite``.
+    """
+
+    def __init__(
+        self,
+        *args: Any,
+        recipient: Optional[str] = None,
+        from_address: str = "sender@another-host.test",
+        min_size: int = 1024,
+        max_size: int = 64 * 1024 * 1024,
+        resolution: int = 64 * 1024,
+        declare_size: bool = True,
+        chunk_size: int = 64 * 1024,
+        starttls: bool = False,
+        suite_name: str = "Size Limit Probe",
+        **kwargs: Optional[Any],
+    ) -> None:
+        super().__init__(  # type: ignore
+            *args,
+            suite_name=suite_name,
+            **kwargs,  # type: ignore
+        )
+
+        if recipient is None:
+            raise self.SmtpOperationalError("Missing parameter: 'recipient'")
+        self._recipient = recipient
+        self._from_address = from_address
+        self._starttls_enabled = starttls
+
+        if not 0 < min_size < max_size:
+            raise self.SmtpOperationalError("Invalid size range")
+        self.min_size = min_size
+        self.max_size = max_size
+        self.resolution = max(resolution, 1)
+        self.declare_size = declare_size
+        self.chunk_size = chunk_size
+
+        self.result = SizeLimitResult(self.origin)
+
+    def _pre_run(self) -> None:
+        super()._pre_run()
+        if self._starttls_enabled:
+            self._starttls()
+
+        # The extensions (``SIZE``) have to be known before the first probe
+        self.smtp.ehlo_or_helo_if_needed()
+
+    def _reject(self, subject: str, stage: str, code: int, resp: bytes) -> str:
+        logger.debug("'%s' rejected at '%s': %d %r", subject, stage, code, resp)
+        self._protocol.mail_rejected(subject)
+        if stage != STAGE_DATA:
+            self.smtp.rset()
+        return stage
+
+    def _probe(self, size: int, subject: str) -> Optional[str]:
+        """Send a message of ``size`` bytes.
+
+        Returns
+        -------
+        str, optional
+            The stage that rejected the message or ``None`` if it was
+            accepted.
+        """
+        headers = MessageFactory.build_headers(
+            self._from_address, self._recipient, subject, subject
+        )
+        body = StreamedBody(size - len(headers), chunk_size=self.chunk_size)
+        actual_size = len(headers) + body.size
+
+        mail_options = []
+        if self.declare_size and self.smtp.has_extn("size"):
+            mail_options.append("SIZE={}".format(actual_size))
+
+        self._protocol.mail_sent(subject, self.suite_name, self.origin)
+
+        code, resp = self.smtp.mail(self._from_address, mail_options)
+        if code != 250:
+            if not mail_options:
+                logger.critical("MAIL FROM rejected: %d %r", code, resp)
+                raise self.SmtpOperationalError("MAIL FROM rejected")
+            return self._reject(subject, STAGE_SIZE, code, resp)
+
+        code, resp = self.smtp.rcpt(self._recipient)
+        if code not in (250, 251):
+            if code not in SIZE_RELATED_RCPT_CODES:
+                logger.critical("RCPT TO rejected: %d %r", code, resp)
+                raise self.SmtpOperationalError("RCPT TO rejected")
+            return self._reject(subject, STAGE_RCPT, code, resp)
+
+        code, resp = self.smtp.docmd("data")
+        if code != 354:
+            logger.critical("DATA rejected: %d %r", code, resp)
+            raise self.SmtpOperationalError("DATA rejected")
+
+        try:
+            self.smtp.send(headers)
+            for chunk in body:
+                self.smtp.send(chunk)
+            self.smtp.send(b".\r\n")
+            code, resp = self.smtp.getreply()
+        except smtplib.SMTPServerDisconnected:
+            # The server may drop the connection instead of reading the
+            # complete message
+            logger.verbose("Connection dropped during DATA, reconnecting")  # type: ignore [attr-defined]
+            self._reconnect()
+            code, resp = -1, b"connection dropped"
+
+        if code != 250:
+            return self._reject(subject, STAGE_DATA, code, resp)
+
+        self._protocol.mail_queued(subject, time.time())
+        self._protocol.mail_accepted(self._recipient, subject)
+        self.bytes_sent += actual_size
+        return None
+
+    def _check(self, size: int) -> Optional[str]:
+        """Probe ``size`` and record the outcome."""
+        subject = self._generate_subject()
+        stage = self._probe(size, subject)
+        self.result.record(size, stage, subject)
+        logger.verbose(  # type: ignore [attr-defined]
+            "%d bytes: %s", size, "accepted" if stage is None else stage
+        )
+        return stage
+
+    def _run_tests(self) -> None:
+        logger.info(
+            "Searching the size limit between %d and %d bytes",
+            self.min_size,
+            self.max_size,
+        )
+
+        if self._check(self.max_size) is None:
+            logger.summary("%s", self.result)  # type: ignore [attr-defined]
+            return
+
+        if self._check(self.min_size) is not None:
+            logger.error("Smallest probe of %d bytes got rejected", self.min_size)
+            raise self.SmtpTestSuiteError("Smallest probe got rejected")
+
+        low, high = self.min_size, self.max_size
+        while high - low > self.resolution:
+            middle = (low + high) // 2
+            if self._check(middle) is None:
+                low = middle
+            else:
+                high = middle
+
+        logger.summary("%s", self.result)  # type: ignore [attr-defined]
+
+
+class SubmissionSizeLimitProbe(SizeLimitProbe, SubmissionTestSuite):
+    """Binary-search the largest message a user may submit.
+
+    The probe uses the submission port and authenticates (see
+    ``SubmissionTestSuite``); ``from_address`` has to be a valid sender of the
+    given user.
+
+    For a full list of parameters refer to ``SizeLimitProbe`` and
+    ``SubmissionTestSuite``.
+    """
+
+    def __init__(
+        self,
+        *args: Any,
+        suite_name: str = "Size Limit Probe (Submission)",
+        **kwargs: Optional[Any],
+    ) -> None:
+        super().__init__(*args, suite_name=suite_name, **kwargs)  # type: ignore [arg-type]
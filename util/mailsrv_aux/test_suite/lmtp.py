@@ -0,0 +1,349 @@
+# SPDX-FileCopyrightText: 2022 Mischback
+# SPDX-License-Identifier: MIT
+# SPDX-FileType: SOURCE
+
+"""Deliver mails to Dovecot using LMTP, bypassing Postfix.
+
+Postfix hands every mail to Dovecot's LMTP service
+(``virtual_transport = lmtp:unix:socket/dovecot/lmtp``), so an end-to-end run
+can not tell, whether Postfix or Dovecot limits the throughput. The benchmark
+of this module talks to the LMTP service directly, either using its UNIX
+socket (on the mail host) or a TCP listener.
+
+LMTP (RFC 2033) differs from SMTP in two ways, that matter here:
+
+- Only mailboxes are valid recipients, as the aliases are resolved by Postfix.
+- After the end of the data, the server replies once per accepted recipient,
+  after the message was stored in that recipient's mailbox. The time until
+  each reply is the *per-recipient latency*, the time between two replies the
+  cost of a single delivery, including the quota update of the quota plugin.
+
+With ``lmtp_rcpt_check_quota = yes``, Dovecot checks the quota during
+``RCPT`` already; the cost shows up in the ``RCPT`` latency and full
+mailboxes are rejected with ``4.2.2`` / ``5.2.2``. Comparing runs with and
+without the quota plugin shows its cost.
+"""
+
+# Python imports
+import logging
+import random
+import smtplib
+import socket
+import threading
+import time
+from typing import Any, Optional
+
+# local imports
+from ..common.log import add_level
+from .messages import MessageFactory
+from .metrics import LatencyRecorder
+from .parallel import run_in_pool
+from .protocols import SmtpTestProtocol
+from .smtp import SmtpGenericTestSuite, TimedSMTP, is_transient
+
+# get a module-level logger
+logger = logging.getLogger(__name__)
+
+# add VERBOSE / SUMMARY log levels
+add_level("VERBOSE", logging.INFO - 1)
+add_level("SUMMARY", logging.INFO + 1)
+
+# Dovecot's ``inet_listener lmtp`` usually listens on this port
+LMTP_PORT = 24
+
+# The enhanced status codes of a full mailbox (RFC 3463)
+QUOTA_STATUS_CODES = (b"4.2.2", b"5.2.2")
+
+
+def is_quota_reply(code: int, msg: bytes) -> bool:
+    """Return ``True`` if the reply rejects a recipient because of its quota."""
+    return msg[:5] in QUOTA_STATUS_CODES or code == 552
+
+
+class TimedLMTP(TimedSMTP):
+    """Measure the latencies of an LMTP connection.
+
+    If ``host`` starts with a slash, it is the path of a UNIX socket, just like
+    with ``smtplib.LMTP``.
+
+    For the parameters refer to ``TimedSMTP``.
+    """
+
+    ehlo_msg = "lhlo"
+    protocol_name = "LMTP"
+
+    def connect(  # noqa: D102
+        self,
+        host: str = "localhost",
+        port: int = 0,
+        source_address: Any = None,
+    ) -> tuple[int, bytes]:
+        if host[:1] != "/":
+            return super().connect(host, port, source_address)
+
+        self._pending = ("CONNECT", time.perf_counter())
+        try:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:  # type: ignore [attr-defined]
+                self.sock.settimeout(self.timeout)
+            self.file = None
+            self.sock.connect(host)
+        except OSError:
+            if self.sock:
+                self.sock.close()
+            self.sock = None
+            raise
+        return self.getreply()
+
+
+class LmtpDeliveryResult:
+    """Collect the results of ``LmtpDeliveryBenchmark``.
+
+    A *delivery* is a message stored for a single recipient. Recipients are
+    *rejected* during ``RCPT`` or after the data; rejections because of the
+    quota are counted separately, as are temporary failures (``4xx``).
+    """
+
+    def __init__(self) -> None:
+        # From the end of the data to the recipient's reply
+        self.recipient = LatencyRecorder("LMTP recipient")
+        # From the previous reply (or the end of the data) to the reply
+        self.delivery = LatencyRecorder("LMTP delivery")
+        self.deliveries = 0
+        self.rejected = 0
+        self.over_quota = 0
+        self.temporary = 0
+        self.duration = 0.0
+        self._lock = threading.Lock()
+
+    def record_delivery(self, since_data: float, since_previous: float) -> None:
+        """Record a successful delivery."""
+        self.recipient.add(since_data)
+        self.delivery.add(since_previous)
+        with self._lock:
+            self.deliveries += 1
+
+    def record_rejection(self, code: int, msg: bytes) -> None:
+        """Record a rejected recipient."""
+        with self._lock:
+            self.rejected += 1
+            if is_quota_reply(code, msg):
+                self.over_quota += 1
+            if is_transient(code):
+                self.temporary += 1
+
+    @property
+    def deliveries_per_second(self) -> Optional[float]:
+        """Return the overall number of deliveries per second."""
+        if not self.duration:
+            return None
+        return self.deliveries / self.duration
+
+    def __str__(self) -> str:  # noqa: D105
+        return "LMTP: {} deliveries in {:.1f}s ({:.1f}/s); rejected: {} ({} over quota, {} temporary)".format(
+            self.deliveries,
+            self.duration,
+            self.deliveries_per_second or 0.0,
+            self.rejected,
+            self.over_quota,
+            self.temporary,
+        )
+
+
+class LmtpDeliveryBenchmark(SmtpGenericTestSuite):
+    """Measure the delivery throughput of Dovecot's LMTP service.
+
+    A corpus of tagged messages is generated once, every message addressed to
+    ``recipients_per_message`` mailboxes, chosen randomly. The messages are
+    split between ``concurrency`` connections, each delivering its share
+    sequentially. The suite's own connection is only used to check the
+    service.
+
+    The accepted recipients are included in the suite's protocol, so the
+    deliveries may be verified using the verification suites (POP3, IMAP or
+    Maildir).
+
+    Parameters
+    ----------
+    recipients : list
+        The mailboxes, messages are delivered to.
+    from_address : str, optional
+        The address to be used as value to ``MAIL FROM:`` (default:
+        sender@another-host.test).
+    messages : int, optional
+        The number of messages in the corpus (default: 100).
+    recipients_per_message : int, optional
+        The number of recipients of every message (default: 1).
+    message_factory : MessageFactory, optional
+        Generate the corpus with this factory (default: plain text messages
+        of 1k).
+    concurrency : int, optional
+        The number of concurrent connections (default: 4).
+    seed : int, optional
+        The seed for the choice of the recipients (default: 0).
+    suite_name : str, optional
+        The suites verbose name (default: LMTP Delivery Benchmark).
+
+    Notes
+    -----
+    ``target_ip`` may be the path of the LMTP socket,
+    ``/var/spool/postfix/socket/dovecot/lmtp`` (see ``10-master.conf``);
+    ``target_port`` is ignored then. The socket is only accessible by
+    ``postfix``, so the process has to run as that user. A TCP listener has
+    to be added to Dovecot's ``service lmtp`` explicitly.
+
+    For a full list of parameters refer to ``SmtpGenericTestSuite``.
+    """
+
+    origin = "lmtp"
+
+    def __init__(
+        self,
+        *args: Any,
+        recipients: Optional[list[str]] = None,
+        from_address: str = "sender@another-host.test",
+        messages: int = 100,
+        recipients_per_message: int = 1,
+        message_factory: Optional[MessageFactory] = None,
+        concurrency: int = 4,
+        seed: int = 0,
+        target_port: int = LMTP_PORT,
+        suite_name: str = "LMTP Delivery Benchmark",
+        **kwargs: Optional[Any],
+    ) -> None:
+        super().__init__(  # type: ignore
+            *args,
+            target_port=target_port,
+            suite_name=suite_name,
+            **kwargs,  # type: ignore
+        )
+
+        if not recipients:
+            raise self.SmtpOperationalError("Missing parameter: 'recipients'")
+        self._from_address = from_address
+        self.concurrency = max(concurrency, 1)
+
+        if message_factory is None:
+            message_factory = MessageFactory()
+        rnd = random.Random(seed)
+        count = min(max(recipients_per_message, 1), len(recipients))
+        # The bodies are dot-stuffed once, see ``MessageBody.stuffed``
+        self._corpus = [
+            (rnd.sample(recipients, count), message_factory.next_body().stuffed)
+            for _ in range(messages)
+        ]
+
+        self.result = LmtpDeliveryResult()
+
+    def _open_connection(self) -> smtplib.SMTP:
+        return TimedLMTP(
+            host=self.target_ip,
+            port=self.target_port,
+            local_hostname=self.local_hostname,
+            timeout=self.timeout,
+            recorders=self.command_latency,
+            max_samples=self.latency_samples,
+        )
+
+    def _pre_run(self) -> None:
+        self.smtp.ehlo()
+
+    def _transaction(
+        self,
+        lmtp: smtplib.SMTP,
+        protocol: SmtpTestProtocol,
+        recipients: list[str],
+        body: bytes,
+    ) -> None:
+        subject = self._generate_subject()
+        headers = MessageFactory.build_headers(
+            self._from_address, ", ".join(recipients), subject, subject
+        )
+
+        protocol.mail_sent(subject, self.suite_name, self.origin)
+
+        code, msg = lmtp.mail(self._from_address)
+        accepted = []
+        if code == 250:
+            for rcpt in recipients:
+                code, msg = lmtp.rcpt(rcpt)
+                if code in (250, 251):
+                    accepted.append(rcpt)
+                else:
+                    logger.debug(
+                        "'%s': %s rejected with %d %r", subject, rcpt, code, msg
+                    )
+                    self.result.record_rejection(code, msg)
+
+        if accepted:
+            lmtp.putcmd("data")
+            code, msg = lmtp.getreply()
+        if not accepted or code != 354:
+            logger.debug("'%s' failed with %d %r", subject, code, msg)
+            protocol.mail_rejected(subject)
+            lmtp.rset()
+            return
+
+        # The headers never contain a line starting with a dot
+        lmtp.send(headers)
+        lmtp.send(body)
+        lmtp.send(b".\r\n")
+        end_of_data = previous = time.perf_counter()
+
+        # One reply per accepted recipient, in the order of the recipients
+        delivered = []
+        for rcpt in accepted:
+            code, msg = lmtp.getreply()
+            now = time.perf_counter()
+            if code == 250:
+                delivered.append(rcpt)
+                self.result.record_delivery(now - end_of_data, now - previous)
+            else:
+                logger.debug("'%s': %s failed with %d %r", subject, rcpt, code, msg)
+                self.result.record_rejection(code, msg)
+            previous = now
+
+        if not delivered:
+            protocol.mail_rejected(subject)
+            return
+
+        protocol.mail_queued(subject, time.time())
+        for rcpt in delivered:
+            protocol.mail_accepted(rcpt, subject)
+
+    def _deliver(self, corpus: list[tuple[list[str], bytes]]) -> SmtpTestProtocol:
+        """Deliver a share of the corpus over a new connection."""
+        protocol = SmtpTestProtocol()
+        try:
+            with self._open_connection() as lmtp:
+                lmtp.ehlo()
+                for recipients, body in corpus:
+                    self._transaction(lmtp, protocol, recipients, body)
+                lmtp.quit()
+        except (smtplib.SMTPException, OSError) as e:
+            logger.critical("LMTP connection failed: '%s'", e)  # noqa: G200
+            raise self.SmtpOperationalError("LMTP connection failed")
+
+        return protocol
+
+    def _run_tests(self) -> None:
+        logger.info(
+            "Delivering %d messages (%d recipients) with %d concurrent connections",
+            len(self._corpus),
+            sum(len(recipients) for recipients, _ in self._corpus),
+            self.concurrency,
+        )
+
+        shares = [self._corpus[i :: self.concurrency] for i in range(self.concurrency)]
+        start = time.perf_counter()
+        protocols = run_in_pool(self._deliver, shares, max_workers=self.concurrency)
+        self.result.duration = time.perf_counter() - start
+
+        for protocol in protocols:
+            self._protocol += protocol
+
+        logger.summary("%s", self.result)  # type: ignore [attr-defined]
+        logger.summary("%s", self.result.recipient)  # type: ignore [attr-defined]
+        logger.summary("%s", self.result.delivery)  # type: ignore [attr-defined]
+        if "RCPT" in self.command_latency:
+            logger.summary("%s", self.command_latency["RCPT"])  # type: ignore [attr-defined]
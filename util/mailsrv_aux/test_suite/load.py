@@ -0,0 +1,284 @@
+# SPDX-FileCopyrightText: 2022 Mischback
+# SPDX-License-Identifier: MIT
+# SPDX-FileType: SOURCE
+
+"""Load runs, adapting the send rate to the server's temporary failures.
+
+When Postfix is under pressure, it responds with temporary failures (``421``,
+``451``, ``452``). The functional test suites treat these as errors, while the
+load suite of this module backs off: the send rate is controlled by an
+*additive-increase / multiplicative-decrease* (AIMD) scheme and deferred mails
+are retried with an exponential backoff. The rates at which the server started
+to push back provide an estimate of the sustainable throughput.
+"""
+
+# Python imports
+import heapq
+import logging
+import random
+import time
+from typing import Any, Optional, Union
+
+# local imports
+from ..common.log import add_level
+from .fixture_mail import GENERIC_VALID_MAIL
+from .messages import MessageFactory
+from .smtp import SmtpGenericTestSuite
+
+# get a module-level logger
+logger = logging.getLogger(__name__)
+
+# add VERBOSE / SUMMARY log levels
+add_level("VERBOSE", logging.INFO - 1)
+add_level("SUMMARY", logging.INFO + 1)
+
+
+class AimdRateController:
+    """Control the send rate using additive-increase/multiplicative-decrease.
+
+    Every successful mail increases the rate by ``increase / rate``, which
+    results in an increase of roughly ``increase`` mails per second for every
+    second of successful sending. Every temporary failure multiplies the rate
+    by ``decrease``.
+
+    Parameters
+    ----------
+    initial_rate : float, optional
+        The initial rate in mails per second (default: 10).
+    min_rate : float, optional
+        The lower bound of the rate (default: 0.5).
+    max_rate : float, optional
+        The upper bound of the rate (default: 1000).
+    increase : float, optional
+        The additive increase, see above (default: 1).
+    decrease : float, optional
+        The multiplicative decrease, ``0 < decrease < 1`` (default: 0.5).
+    """
+
+    def __init__(
+        self,
+        initial_rate: float = 10.0,
+        min_rate: float = 0.5,
+        max_rate: float = 1000.0,
+        increase: float = 1.0,
+        decrease: float = 0.5,
+    ) -> None:
+        self.rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+
+        # The rates at which the server responded with temporary failures
+        self.peaks: list[float] = []
+        self._next_slot = time.perf_counter()
+
+    def wait(self) -> None:
+        """Block until the next mail may be sent."""
+        now = time.perf_counter()
+        if self._next_slot > now:
+            time.sleep(self._next_slot - now)
+        self._next_slot = max(self._next_slot, now) + 1 / self.rate
+
+    def on_success(self) -> None:
+        """Increase the rate after a successfully sent mail."""
+        self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def on_transient(self) -> None:
+        """Decrease the rate after a temporary failure."""
+        self.peaks.append(self.rate)
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        logger.verbose("Temporary failure, reducing rate to %.1f/s", self.rate)  # type: ignore [attr-defined]
+
+    @property
+    def ceiling(self) -> Optional[float]:
+        """Return the estimated sustainable rate in mails per second.
+
+        This is the mean of the rates at which the server responded with
+        temporary failures, or ``None`` if there were no failures.
+        """
+        if not self.peaks:
+            return None
+        return sum(self.peaks) / len(self.peaks)
+
+    def __str__(self) -> str:  # noqa: D105
+        ceiling = self.ceiling
+        return "rate {:.1f}/s, {} decreases, ceiling: {}".format(
+            self.rate,
+            len(self.peaks),
+            "not reached" if ceiling is None else "{:.1f}/s".format(ceiling),
+        )
+
+
+class AdaptiveLoadTestSuite(SmtpGenericTestSuite):
+    """Send mails at an adaptive rate to find the sustainable throughput.
+
+    The suite cycles through the given recipients, sending one mail per
+    recipient. Temporary failures reduce the send rate (see
+    ``AimdRateController``) and the affected mails are retried with an
+    exponential backoff, using the same subject. If the server closes the
+    connection (``421``), the suite reconnects.
+
+    Rejected mails (``5xx``) are counted, but do not stop the run.
+
+    Parameters
+    ----------
+    recipients : list
+        A ``list`` of ``str``, the recipients of the mails.
+    from_address : str, optional
+        The address to be used as value to ``MAIL FROM:`` (default:
+        sender@another-host.test).
+    messages : int, optional
+        The number of mails to send (default: 1000).
+    starttls : bool, optional
+        Use ``STARTTLS`` before sending (default: ``False``).
+    controller : AimdRateController, optional
+        The rate controller (default: an ``AimdRateController`` with its
+        default settings).
+    max_retries : int, optional
+        The number of retries per deferred mail (default: 5).
+    backoff : float, optional
+        The initial backoff in seconds, doubled with every retry (default: 1).
+    max_backoff : float, optional
+        The upper bound of the backoff in seconds (default: 60).
+    message_factory : MessageFactory, optional
+        Generate the mails with this factory (default: ``None``, meaning
+        ``GENERIC_VALID_MAIL``).
+    suite_name : str, optional
+        The suites verbose name (default: Adaptive Load Test Suite).
+
+    Notes
+    -----
+    For a full list of parameters refer to ``SmtpGenericTestSuite``.
+    """
+
+    raise_on_transient = True
+
+    def __init__(
+        self,
+        *args: Any,
+        recipients: Optional[list[str]] = None,
+        from_address: str = "sender@another-host.test",
+        messages: int = 1000,
+        starttls: bool = False,
+        controller: Optional[AimdRateController] = None,
+        max_retries: int = 5,
+        backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        message_factory: Optional[MessageFactory] = None,
+        suite_name: str = "Adaptive Load Test Suite",
+        **kwargs: Optional[Any],
+    ) -> None:
+        super().__init__(  # type: ignore
+            *args,
+            suite_name=suite_name,
+            **kwargs,  # type: ignore
+        )
+
+        if not recipients:
+            raise self.SmtpOperationalError("Missing parameter: 'recipients'")
+        self._recipients = recipients
+        self._from_address = from_address
+        self._messages = messages
+        self._starttls_enabled = starttls
+
+        if controller is None:
+            self.controller = AimdRateController()
+        else:
+            self.controller = controller
+
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+
+        self._message: Union[str, MessageFactory]
+        if message_factory is None:
+            self._message = GENERIC_VALID_MAIL
+        else:
+            self._message = message_factory
+
+        self.gave_up = 0
+
+    def _pre_run(self) -> None:
+        if self._starttls_enabled:
+            self._starttls()
+
+    def _retry_delay(self, attempt: int) -> float:
+        delay = min(self._max_backoff, self._backoff * 2**attempt)
+        # apply some jitter to not let retries arrive in bursts
+        return float(delay * random.uniform(0.5, 1.0))
+
+    def _ensure_connection(self) -> None:
+        attempt = 0
+        while self.smtp.sock is None:
+            try:
+                self._reconnect()
+            except self.SmtpOperationalError:
+                if attempt >= self._max_retries:
+                    raise
+                time.sleep(self._retry_delay(attempt))
+                attempt += 1
+
+    def _run_tests(self) -> None:
+        logger.info("Sending %d mails at an adaptive rate", self._messages)
+
+        # The retry queue is a heap of (due time, sequence, subject,
+        # recipients, attempt); the sequence keeps the ordering stable.
+        retries: list[tuple[float, int, str, list[str], int]] = []
+        sequence = 0
+        next_new = 0
+
+        start = time.perf_counter()
+        while next_new < self._messages or retries:
+            now = time.perf_counter()
+            subject: Optional[str]
+            if retries and retries[0][0] <= now:
+                _, _, subject, to_addrs, attempt = heapq.heappop(retries)
+            elif next_new < self._messages:
+                subject = None
+                to_addrs = [self._recipients[next_new % len(self._recipients)]]
+                attempt = 0
+                next_new += 1
+            else:
+                time.sleep(retries[0][0] - now)
+                continue
+
+            self.controller.wait()
+            self._ensure_connection()
+            try:
+                self._sendmail(
+                    self._from_address, to_addrs, self._message, subject=subject
+                )
+                self.controller.on_success()
+            except self.SmtpTransientError as e:
+                self.controller.on_transient()
+                if attempt >= self._max_retries:
+                    logger.warning("Giving up on deferred mail '%s'", e.subject)
+                    self._protocol.mail_rejected(e.subject)
+                    self.gave_up += 1
+                    continue
+
+                sequence += 1
+                heapq.heappush(
+                    retries,
+                    (
+                        time.perf_counter() + self._retry_delay(attempt),
+                        sequence,
+                        e.subject,
+                        e.recipients,
+                        attempt + 1,
+                    ),
+                )
+        duration = time.perf_counter() - start
+
+        # ``run()`` expects an established connection to send ``QUIT``
+        self._ensure_connection()
+
+        logger.summary(  # type: ignore [attr-defined]
+            "%s; %.1f mails/s, %.2f MiB/s, %d given up",
+            self._protocol,
+            self._protocol.get_mail_count() / duration,
+            self.bytes_sent / duration / (1024 * 1024),
+            self.gave_up,
+        )
+        logger.summary("Rate control: %s", self.controller)  # type: ignore [attr-defined]
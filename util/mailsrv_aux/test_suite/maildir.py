@@ -0,0 +1,241 @@
+# SPDX-FileCopyrightText: 2022 Mischback
+# SPDX-License-Identifier: MIT
+# SPDX-FileType: SOURCE
+
+"""Verify the delivered mails by reading the Maildirs directly.
+
+When the test runner is executed on the mail host itself, there is no need to
+log in to every mailbox: Dovecot stores the mails with
+``mail_location = maildir:~/Maildir`` below the users' homes (``/var/vmail/%u``,
+see ``auth-passwdfile.conf.ext``).
+
+The ``new/`` and ``cur/`` directories are listed with ``os.scandir()`` and only
+the headers of unknown messages are read, up to the blank line. The tags of
+known messages are kept in an ``UidlCache``, keyed by the *unique* part of the
+Maildir filename (everything before the ``:2,`` info suffix, which changes
+with the flags), so a message is recognised after it was moved from ``new/``
+to ``cur/``.
+
+The process needs read access to the Maildirs, e.g. by running as ``vmail``.
+"""
+
+# Python imports
+import collections
+import logging
+import os
+import re
+from typing import Optional
+
+# local imports
+from ..common.log import add_level
+from .exceptions import MailsrvTestException
+from .pop3 import UidlCache
+from .tagging import TRACKING_HEADER
+
+# get a module-level logger
+logger = logging.getLogger(__name__)
+
+# add VERBOSE / SUMMARY log levels
+add_level("VERBOSE", logging.INFO - 1)
+add_level("SUMMARY", logging.INFO + 1)
+
+# The home directories of the virtual users, see ``auth-passwdfile.conf.ext``
+DEFAULT_HOME_TEMPLATE = "/var/vmail/%u"
+
+# The subdirectories of a Maildir, that contain messages
+MAILDIR_SUBDIRS = ("new", "cur")
+
+# The (lower-case) field name of the ``TRACKING_HEADER``
+_TRACKING_FIELD = TRACKING_HEADER.lower().encode()
+
+# The end of the header section and the size of the reads to find it
+_HEADER_END = re.compile(rb"\n\r?\n")
+_CHUNK_SIZE = 8192
+
+
+def expand_home(template: str, username: str) -> str:
+    """Expand Dovecot's ``%u``, ``%n`` and ``%d`` variables in ``template``."""
+    local_part, _, domain = username.partition("@")
+    return (
+        template.replace("%u", username).replace("%n", local_part).replace("%d", domain)
+    )
+
+
+def read_header_bytes(path: str) -> bytes:
+    """Return the header section of a message, up to (excluding) the blank line.
+
+    The message is read in chunks, so usually a single ``read()`` is
+    sufficient and the body is never read.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        data = b""
+        while True:
+            chunk = os.read(fd, _CHUNK_SIZE)
+            data += chunk
+            end = _HEADER_END.search(data)
+            if end is not None:
+                return data[: end.start() + 1]
+            if not chunk:
+                return data
+    finally:
+        os.close(fd)
+
+
+def read_tag(path: str) -> str:
+    """Read the headers of a message and return its tag.
+
+    The tag is read from the ``TRACKING_HEADER``; for messages without that
+    header, the subject is used. The headers are not decoded (the tags are
+    plain ASCII), which is much cheaper than using ``email.parser``.
+    """
+    fields: dict[bytes, bytes] = {}
+    name = None
+    for line in read_header_bytes(path).split(b"\n"):
+        line = line.rstrip(b"\r")
+        if line[:1] in (b" ", b"\t"):
+            # A folded line continues the previous field
+            if name is not None:
+                fields[name] += b" " + line.strip()
+            continue
+
+        field, _, value = line.partition(b":")
+        name = field.strip().lower()
+        if name in (_TRACKING_FIELD, b"subject") and name not in fields:
+            fields[name] = value.strip()
+        else:
+            name = None
+
+    value = fields.get(_TRACKING_FIELD, None) or fields.get(b"subject", b"")
+    return value.decode("utf-8", "replace")
+
+
+class MaildirVerifyMailGotDelivered:
+    """Check the Maildir of a given user for expected mails.
+
+    Parameters
+    ----------
+    username : str
+        The user owning the Maildir. Used as key of the ``index``.
+    maildir : str
+        The path of the Maildir, e.g. ``/var/vmail/<user>/Maildir``.
+    expected_messages : list
+        A ``list`` of ``str``, representing the subjects of the messages,
+        expected to be present in the Maildir. A subject may be included
+        several times, if several messages with that subject are expected.
+    index : UidlCache, optional
+        The tags of already known messages, by Maildir filename (default: a
+        new in-memory cache).
+    suite_name : str, optional
+        The name of the test suite (default: Verify messages in Maildir Test
+        Suite).
+
+    Notes
+    -----
+    After the run, ``missing_messages`` contains the subjects that could not
+    be found and ``scanned_messages`` the number of messages in the Maildir.
+    """
+
+    class MaildirGenericException(MailsrvTestException):
+        """Base class for all exceptions of Maildir test suites."""
+
+    class MaildirOperationalError(MaildirGenericException):
+        """Indicate operational errors, most likely while accessing the Maildir."""
+
+    class MaildirTestSuiteError(MaildirGenericException):
+        """Indicate an actual test failure."""
+
+    def __init__(
+        self,
+        username: str,
+        maildir: str,
+        expected_messages: list[str],
+        index: Optional[UidlCache] = None,
+        suite_name: str = "Verify messages in Maildir Test Suite",
+    ) -> None:
+        self.username = username
+        self.maildir = maildir
+        self.expected_messages = expected_messages
+        self.suite_name = suite_name
+
+        if index is None:
+            self.index = UidlCache()
+        else:
+            self.index = index
+
+        self.missing_messages: list[str] = []
+        self.scanned_messages = 0
+
+    def _list_messages(self) -> dict[str, str]:
+        """Return the paths of all messages, by the unique part of their name."""
+        messages = {}
+        for subdir in MAILDIR_SUBDIRS:
+            with os.scandir(os.path.join(self.maildir, subdir)) as entries:
+                for entry in entries:
+                    if entry.name.startswith(".") or not entry.is_file():
+                        continue
+                    messages[entry.name.split(":", 1)[0]] = entry.path
+        return messages
+
+    def _find_expected(self) -> list[str]:
+        """Search the Maildir and return the subjects of missing messages."""
+        expected = collections.Counter(self.expected_messages)
+        remaining = sum(expected.values())
+
+        known = self.index.get_mailbox(self.username)
+        seen: dict[str, str] = {}
+
+        messages = self._list_messages()
+        self.scanned_messages = len(messages)
+
+        # Known messages are processed first, as they do not need any reads
+        for name in sorted(messages, key=lambda name: name not in known):
+            subject = known.get(name)
+            if subject is None:
+                try:
+                    subject = read_tag(messages[name])
+                except FileNotFoundError:
+                    # Moved from ``new/`` to ``cur/`` in the meantime
+                    continue
+            seen[name] = subject
+
+            if expected[subject] > 0:
+                logger.debug("Found '%s' (%s)", subject, name)
+                expected[subject] -= 1
+                remaining -= 1
+                if remaining == 0:
+                    break
+
+        # Keep the cached entries of messages that were not processed, but
+        # only if they are still present in the Maildir.
+        seen.update(
+            {
+                name: known[name]
+                for name in (known.keys() & messages.keys()) - seen.keys()
+            }
+        )
+        self.index.set_mailbox(self.username, seen)
+
+        return list(expected.elements())
+
+    def run(self) -> None:
+        """Run the test suite."""
+        logger.summary("Running %s", self.suite_name)  # type: ignore [attr-defined]
+        try:
+            self.missing_messages = self._find_expected()
+        except OSError as e:
+            logger.critical("Could not read '%s': %s", self.maildir, e)  # noqa: G200
+            raise self.MaildirOperationalError("Maildir not accessible")
+
+        logger.verbose(  # type: ignore [attr-defined]
+            "%d message(s) in '%s'", self.scanned_messages, self.maildir
+        )
+        if self.missing_messages:
+            logger.error(
+                "Could not find expected message(s): %s", self.missing_messages
+            )
+            raise self.MaildirTestSuiteError(
+                "At least one expected message could not be found"
+            )
+
+        logger.summary("%s finished successfully", self.suite_name)  # type: ignore [attr-defined]
@@ -0,0 +1,390 @@
+# SPDX-FileCopyrightText: 2022 Mischback
+# SPDX-License-Identifier: MIT
+# SPDX-FileType: SOURCE
+
+"""Generate test mails of configurable size and structure.
+
+``fixture_mail.GENERIC_VALID_MAIL`` is a tiny plain text template. To measure
+the throughput as a function of the message size (and to stress Postfix's
+``message_size_limit`` / ``mailbox_size_limit`` and Dovecot's quota), the
+``MessageFactory`` provides MIME messages (plain text, HTML or with an
+attachment), following a ``SizeDistribution``.
+
+The bodies are generated, encoded and dot-stuffed only once per kind and size;
+every mail re-uses the same ``bytes`` object. Only the per-message headers
+(``From``, ``To``, ``Subject`` and the ``TRACKING_HEADER``) are rendered for
+every mail and sent separately, so the body is never copied.
+"""
+
+# Python imports
+import email.policy
+import logging
+import random
+import re
+import threading
+from email.message import EmailMessage, Message
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from typing import Iterator, Optional, Sequence
+
+# local imports
+from ..common.exceptions import MailsrvParserException
+from .tagging import TRACKING_HEADER
+
+# get a module-level logger
+logger = logging.getLogger(__name__)
+
+# The kinds of messages the factory is able to generate
+KIND_TEXT = "text"
+KIND_HTML = "html"
+KIND_ATTACHMENT = "attachment"
+MESSAGE_KINDS = (KIND_TEXT, KIND_HTML, KIND_ATTACHMENT)
+
+# Lines starting with a dot, that have to be dot-stuffed for ``DATA``
+_DOT_LINE = re.compile(rb"^\.", re.MULTILINE)
+
+# The per-message headers
+HEADER_TEMPLATE = (
+    "Subject: {subject}\r\n"
+    "{tracking_header}: {tracking_id}\r\n"
+    "From: {mail_from}\r\n"
+    "To: {rcpt_to}\r\n"
+)
+
+# A line of filler text, including the line break (72 bytes)
+_FILLER_LINE = (
+    "This is filler text for a test mail of the mail server test suite.....\r\n"
+)
+
+# A line of UTF-8 filler text, including the line break (72 bytes, encoded)
+_UTF8_FILLER_LINE = "Füllung für eine Testmail: Grüße, Äpfel, Übermaß, 10 € …...\r\n"
+
+# The transfer encodings of ``utf8_text_body()``
+CTE_8BIT = "8bit"
+CTE_QUOTED_PRINTABLE = "quoted-printable"
+CTE_BASE64 = "base64"
+TEXT_ENCODINGS = (CTE_8BIT, CTE_QUOTED_PRINTABLE, CTE_BASE64)
+
+_SIZE_PATTERN = re.compile(r"^(\d+)([kKmM]?)$")
+_SIZE_UNITS = {"": 1, "k": 1024, "m": 1024 * 1024}
+
+
+def parse_size(value: str) -> int:
+    """Parse a size in bytes, optionally with a unit (``k`` or ``m``).
+
+    Raises
+    ------
+    MailsrvParserException
+        If the value is not a valid size.
+    """
+    match = _SIZE_PATTERN.match(value.strip())
+    if match is None:
+        raise MailsrvParserException("Invalid size: '{}'".format(value))
+
+    return int(match.group(1)) * _SIZE_UNITS[match.group(2).lower()]
+
+
+def dot_stuff(data: bytes) -> bytes:
+    """Prepare a message for ``DATA``: dot-stuff it and terminate the last line.
+
+    If no line starts with a dot and the message ends with a line break,
+    ``data`` itself is returned, without a copy.
+    """
+    if _DOT_LINE.search(data) is not None:
+        data = _DOT_LINE.sub(b"..", data)
+    if not data.endswith(b"\r\n"):
+        data += b"\r\n"
+    return data
+
+
+def utf8_text_body(size: int, encoding: str) -> bytes:
+    """Return a plain text body of UTF-8 text in the given transfer encoding.
+
+    The text is the same for every encoding, so the bodies show the overhead
+    of the 7-bit encodings compared to sending the text as it is (``8bit``,
+    which requires ``BODY=8BITMIME``). Like ``MessageBody.data``, the body
+    includes the MIME headers and the separating empty line.
+
+    Parameters
+    ----------
+    size : int
+        The (approximate) size of the *unencoded* text in bytes.
+    encoding : str
+        The ``Content-Transfer-Encoding``, one of ``TEXT_ENCODINGS``.
+    """
+    if encoding not in TEXT_ENCODINGS:
+        raise MailsrvParserException("Unknown transfer encoding: '{}'".format(encoding))
+
+    count = max(size // len(_UTF8_FILLER_LINE.encode("utf-8")), 1)
+    message = EmailMessage()
+    message.set_content(
+        _UTF8_FILLER_LINE * count, subtype="plain", charset="utf-8", cte=encoding
+    )
+    return message.as_bytes(policy=email.policy.SMTP)
+
+
+class SizeDistribution:
+    """Provide message sizes, following a discrete distribution.
+
+    Parameters
+    ----------
+    weights : dict
+        The message sizes in bytes (as keys) with their relative weights.
+    seed : int, optional
+        The seed of the random number generator (default: 0).
+    """
+
+    def __init__(self, weights: dict[int, float], seed: int = 0) -> None:
+        if not weights:
+            raise MailsrvParserException("Empty size distribution")
+
+        self.sizes = list(weights.keys())
+        self.weights = list(weights.values())
+        self._random = random.Random(seed)
+
+    @classmethod
+    def parse(cls, spec: str, seed: int = 0) -> "SizeDistribution":
+        """Create an instance from a specification like ``1k:50,100k:30,5m:20``.
+
+        The weight may be omitted, it defaults to ``1``.
+        """
+        weights: dict[int, float] = {}
+        for item in spec.split(","):
+            size, _, weight = item.partition(":")
+            try:
+                weights[parse_size(size)] = float(weight) if weight else 1.0
+            except ValueError:
+                raise MailsrvParserException("Invalid weight: '{}'".format(item))
+
+        return cls(weights, seed=seed)
+
+    def sample(self) -> int:
+        """Return the size of the next message."""
+        return self._random.choices(self.sizes, self.weights)[0]
+
+
+class MessageBody:
+    """An encoded message body, ready to be appended to per-message headers.
+
+    The body includes the MIME headers (``MIME-Version``, ``Content-Type``,
+    ...), the separating empty line and the actual content. Line endings are
+    ``CRLF``.
+
+    ``data`` is the body as it is; ``stuffed`` is the body prepared for
+    ``DATA``: dot-stuffed and terminated by a line break. If no line starts
+    with a dot, both are the same object.
+
+    Parameters
+    ----------
+    kind : str
+        The kind of the message, one of ``MESSAGE_KINDS``.
+    size : int
+        The (approximate) target size of the message in bytes.
+    seed : int, optional
+        The seed for the content of attachments (default: 0).
+    """
+
+    def __init__(self, kind: str, size: int, seed: int = 0) -> None:
+        self.kind = kind
+        self.target_size = size
+
+        message = self._build(kind, size, random.Random(seed))
+        self.data = message.as_bytes(policy=email.policy.SMTP)
+        self.stuffed = dot_stuff(self.data)
+
+    @property
+    def size(self) -> int:
+        """Return the actual size of the encoded body."""
+        return len(self.data)
+
+    @staticmethod
+    def _filler(size: int) -> str:
+        count = max(size // len(_FILLER_LINE), 1)
+        return _FILLER_LINE * count
+
+    def _build(self, kind: str, size: int, rnd: random.Random) -> Message:
+        if kind == KIND_TEXT:
+            return MIMEText(self._filler(size), "plain", "us-ascii")
+
+        if kind == KIND_HTML:
+            # Both alternatives share the size
+            text = self._filler(size // 2)
+            html = "<html><body><pre>\r\n{}</pre></body></html>\r\n".format(
+                self._filler(size // 2)
+            )
+            message = MIMEMultipart("alternative")
+            message.attach(MIMEText(text, "plain", "us-ascii"))
+            message.attach(MIMEText(html, "html", "us-ascii"))
+            return message
+
+        if kind == KIND_ATTACHMENT:
+            # Base64 encoding adds a third to the size of the attachment
+            length = size * 3 // 4
+            attachment = MIMEApplication(
+                rnd.getrandbits(length * 8).to_bytes(length, "little")
+            )
+            attachment.add_header(
+                "Content-Disposition", "attachment", filename="attachment.bin"
+            )
+            message = MIMEMultipart("mixed")
+            message.attach(MIMEText(_FILLER_LINE, "plain", "us-ascii"))
+            message.attach(attachment)
+            return message
+
+        raise MailsrvParserException("Unknown message kind: '{}'".format(kind))
+
+
+class StreamedBody:
+    """A plain text body, generated chunk by chunk while it is sent.
+
+    Other than ``MessageBody``, the body is never held in memory as a whole,
+    so it is suitable for messages of (almost) arbitrary size. Like
+    ``MessageBody.data``, it includes the MIME headers and the separating empty
+    line. No line starts with a dot, so no dot-stuffing is required.
+
+    Parameters
+    ----------
+    size : int
+        The (approximate) target size of the body in bytes.
+    chunk_size : int, optional
+        The (approximate) size of the chunks in bytes (default: 64 KiB).
+    """
+
+    MIME_HEADERS = (
+        b"MIME-Version: 1.0\r\n"
+        b'Content-Type: text/plain; charset="us-ascii"\r\n'
+        b"Content-Transfer-Encoding: 7bit\r\n"
+        b"\r\n"
+    )
+
+    def __init__(self, size: int, chunk_size: int = 64 * 1024) -> None:
+        line_length = len(_FILLER_LINE)
+        self.lines = max((size - len(self.MIME_HEADERS)) // line_length, 1)
+
+        self._lines_per_chunk = max(chunk_size // line_length, 1)
+        self._chunk = (_FILLER_LINE * self._lines_per_chunk).encode("ascii")
+
+    @property
+    def size(self) -> int:
+        """Return the actual size of the body."""
+        return len(self.MIME_HEADERS) + self.lines * len(_FILLER_LINE)
+
+    def __iter__(self) -> Iterator[bytes]:  # noqa: D105
+        yield self.MIME_HEADERS
+
+        full, rest = divmod(self.lines, self._lines_per_chunk)
+        for _ in range(full):
+            yield self._chunk
+        if rest:
+            yield self._chunk[: rest * len(_FILLER_LINE)]
+
+
+class MessageFactory:
+    """Generate test mails, following a size distribution.
+
+    The factory may be passed to the SMTP suites instead of a message
+    template. The bodies are created on first use and cached per kind and
+    size.
+
+    Parameters
+    ----------
+    sizes : SizeDistribution, optional
+        The distribution of the message sizes (default: all messages 1k).
+    kinds : list, optional
+        The kinds of messages to generate, chosen randomly with equal weights
+        (default: plain text only).
+    seed : int, optional
+        The seed for the choice of the message kind and the content of the
+        attachments (default: 0).
+
+    Notes
+    -----
+    The factory may be shared between suites running in different threads.
+    """
+
+    def __init__(
+        self,
+        sizes: Optional[SizeDistribution] = None,
+        kinds: Sequence[str] = (KIND_TEXT,),
+        seed: int = 0,
+    ) -> None:
+        if sizes is None:
+            self.sizes = SizeDistribution({1024: 1})
+        else:
+            self.sizes = sizes
+
+        for kind in kinds:
+            if kind not in MESSAGE_KINDS:
+                raise MailsrvParserException("Unknown message kind: '{}'".format(kind))
+        self.kinds = list(kinds)
+
+        self._seed = seed
+        self._random = random.Random(seed)
+        self._bodies: dict[tuple[str, int], MessageBody] = {}
+        self._lock = threading.Lock()
+
+    def get_body(self, kind: str, size: int) -> MessageBody:
+        """Return the (cached) body for the given kind and size."""
+        key = (kind, size)
+        with self._lock:
+            body = self._bodies.get(key, None)
+            if body is None:
+                body = MessageBody(kind, size, seed=self._seed)
+                logger.debug(
+                    "Created %s body of %d bytes (target: %d)", kind, body.size, size
+                )
+                self._bodies[key] = body
+
+        return body
+
+    def next_body(self) -> MessageBody:
+        """Return the body for the next message."""
+        with self._lock:
+            kind = self._random.choice(self.kinds)
+            size = self.sizes.sample()
+
+        return self.get_body(kind, size)
+
+    @staticmethod
+    def build_headers(
+        mail_from: str, rcpt_to: str, subject: str, tracking_id: str
+    ) -> bytes:
+        """Return the per-message headers.
+
+        Parameters
+        ----------
+        mail_from : str
+            The value of the ``From`` header.
+        rcpt_to : str
+            The value of the ``To`` header.
+        subject : str
+            The value of the ``Subject`` header.
+        tracking_id : str
+            The value of the ``TRACKING_HEADER``.
+        """
+        headers = HEADER_TEMPLATE.format(
+            subject=subject,
+            tracking_header=TRACKING_HEADER,
+            tracking_id=tracking_id,
+            mail_from=mail_from,
+            rcpt_to=rcpt_to,
+        )
+        return headers.encode("ascii")
+
+    def build_parts(
+        self, mail_from: str, rcpt_to: str, subject: str, tracking_id: str
+    ) -> tuple[bytes, bytes]:
+        """Return the per-message headers and the (shared) body of the next message.
+
+        See ``build_headers()`` for the parameters.
+        """
+        headers = self.build_headers(mail_from, rcpt_to, subject, tracking_id)
+        return headers, self.next_body().data
+
+    def build(
+        self, mail_from: str, rcpt_to: str, subject: str, tracking_id: str
+    ) -> bytes:
+        """Return the next message as a whole, see ``build_parts()``."""
+        headers, body = self.build_parts(mail_from, rcpt_to, subject, tracking_id)
+        return headers + body
@@ -0,0 +1,366 @@
+# SPDX-FileCopyrightText: 2022 Mischback
+# SPDX-License-Identifier: MIT
+# SPDX-FileType: SOURCE
+
+"""Provide measurement helpers for the test suites."""
+
+# Python imports
+import bisect
+import collections
+import math
+import random
+import re
+import threading
+from typing import Callable, Optional
+
+# local imports
+from ..common.exceptions import MailsrvParserException
+
+# An SLO like ``p99 RCPT < 200ms``: statistic, operation, threshold and unit
+SLO_PATTERN = re.compile(
+    r"^(p\d+(?:\.\d+)?|mean|max)\s+(\S+)\s*<\s*(\d+(?:\.\d+)?)\s*(ms|s)$",
+    re.IGNORECASE,
+)
+
+# The upper bounds (in seconds) of the fixed histogram buckets, from single
+# SMTP commands up to the delivery of a mail
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+    300.0,
+)
+
+
+def nearest_rank(samples: list[float], p: float) -> Optional[float]:
+    """Return the ``p``-th percentile of sorted ``samples`` (*nearest rank*)."""
+    if not samples:
+        return None
+    rank = max(math.ceil(p / 100 * len(samples)), 1)
+    return samples[rank - 1]
+
+
+def format_latency(
+    name: str,
+    count: int,
+    mean: Optional[float],
+    percentile: Callable[[float], Optional[float]],
+) -> str:
+    """Return the textual summary of latency statistics."""
+    if mean is None:
+        return "{}: no samples".format(name)
+    return "{}: n={} mean={:.1f}ms p50={:.1f}ms p95={:.1f}ms p99={:.1f}ms".format(
+        name,
+        count,
+        mean * 1000,
+        percentile(50) * 1000,  # type: ignore [operator]
+        percentile(95) * 1000,  # type: ignore [operator]
+        percentile(99) * 1000,  # type: ignore [operator]
+    )
+
+
+class LatencyRecorder:
+    """Collect latency samples and provide basic statistics.
+
+    The recorder may be shared between several threads, all modifications are
+    guarded by a lock.
+
+    Parameters
+    ----------
+    name : str, optional
+        A verbose name, used in the string representation (default: latency).
+    max_samples : int, optional
+        Keep at most this number of samples, chosen by reservoir sampling.
+        Count, total and mean stay exact, the percentiles are estimated from
+        the kept samples. Limits the memory of long runs (default: ``None``,
+        meaning all samples are kept).
+    buckets : tuple, optional
+        The upper bounds of the histogram buckets in seconds, in ascending
+        order. The histogram counts every sample, independent of
+        ``max_samples`` (default: ``DEFAULT_BUCKETS``).
+    """
+
+    def __init__(
+        self,
+        name: str = "latency",
+        max_samples: Optional[int] = None,
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        self.name = name
+        self.max_samples = max_samples
+        self.buckets = buckets
+        self._samples: list[float] = []
+        # The last bucket counts the samples above the highest bound
+        self._bucket_counts = [0] * (len(buckets) + 1)
+        self._seen = 0
+        self._total = 0.0
+        self._random = random.Random(0)
+        self._lock = threading.Lock()
+
+    def _keep(self, seconds: float) -> None:
+        """Keep a sample, replacing a random one if the reservoir is full."""
+        self._seen += 1
+        if self.max_samples is None or len(self._samples) < self.max_samples:
+            self._samples.append(seconds)
+            return
+
+        index = self._random.randrange(self._seen)
+        if index < self.max_samples:
+            self._samples[index] = seconds
+
+    def add(self, seconds: float) -> None:
+        """Add a single sample, provided in seconds."""
+        with self._lock:
+            self._keep(seconds)
+            self._total += seconds
+            self._bucket_counts[bisect.bisect_left(self.buckets, seconds)] += 1
+
+    def merge(self, other: "LatencyRecorder") -> None:
+        """Add all samples of ``other`` to this recorder.
+
+        Raises
+        ------
+        ValueError
+            Raised if the recorders use different histogram buckets.
+        """
+        if other.buckets != self.buckets:
+            raise ValueError("Can not merge recorders with different buckets")
+
+        with other._lock:
+            samples = list(other._samples)
+            seen = other._seen
+            total = other._total
+            bucket_counts = list(other._bucket_counts)
+        with self._lock:
+            for sample in samples:
+                self._keep(sample)
+            self._seen += seen - len(samples)
+            self._total += total
+            for index, count in enumerate(bucket_counts):
+                self._bucket_counts[index] += count
+
+    @property
+    def count(self) -> int:
+        """Return the number of recorded samples."""
+        return self._seen
+
+    @property
+    def total(self) -> float:
+        """Return the sum of all recorded samples."""
+        return self._total
+
+    def histogram(self) -> list[tuple[float, int]]:
+        """Return the cumulative histogram of all samples.
+
+        Returns
+        -------
+        list
+            Tuples of upper bound and the number of samples less than or equal
+            to that bound, ending with ``math.inf`` and the total count.
+        """
+        with self._lock:
+            bucket_counts = list(self._bucket_counts)
+
+        result = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), bucket_counts):
+            cumulative += count
+            result.append((bound, cumulative))
+        return result
+
+    def mean(self) -> Optional[float]:
+        """Return the arithmetic mean of the samples or ``None``."""
+        if not self._seen:
+            return None
+        return self.total / self.count
+
+    def percentile(self, p: float) -> Optional[float]:
+        """Return the ``p``-th percentile, using the *nearest rank* method.
+
+        Parameters
+        ----------
+        p : float
+            The percentile to calculate, ``0 < p <= 100``.
+
+        Returns
+        -------
+        float, Optional
+            The sample representing the percentile or ``None`` if there are
+            no samples.
+        """
+        with self._lock:
+            samples = sorted(self._samples)
+        return nearest_rank(samples, p)
+
+    def __str__(self) -> str:  # noqa: D105
+        if not self._samples:
+            return "{}: no samples".format(self.name)
+        return format_latency(self.name, self.count, self.mean(), self.percentile)
+
+
+class RollingWindow:
+    """Keep the latest latency samples in a ring buffer.
+
+    Other than ``LatencyRecorder``, the statistics describe only the recent
+    samples and the memory stays constant, no matter how long the recording
+    runs.
+
+    Parameters
+    ----------
+    name : str, optional
+        A verbose name, used in the string representation (default: latency).
+    size : int, optional
+        The number of samples to keep (default: 100).
+    """
+
+    def __init__(self, name: str = "latency", size: int = 100) -> None:
+        self.name = name
+        self._samples: collections.deque[float] = collections.deque(maxlen=size)
+
+    def add(self, seconds: float) -> None:
+        """Add a single sample, provided in seconds, dropping the oldest one."""
+        self._samples.append(seconds)
+
+    @property
+    def count(self) -> int:
+        """Return the number of samples in the window."""
+        return len(self._samples)
+
+    def mean(self) -> Optional[float]:
+        """Return the arithmetic mean of the window or ``None``."""
+        if not self._samples:
+            return None
+        return sum(self._samples) / len(self._samples)
+
+    def percentile(self, p: float) -> Optional[float]:
+        """Return the ``p``-th percentile of the window, see ``LatencyRecorder``."""
+        return nearest_rank(sorted(self._samples), p)
+
+    def __str__(self) -> str:  # noqa: D105
+        return format_latency(self.name, self.count, self.mean(), self.percentile)
+
+
+class LatencySlo:
+    """A service level objective on the latency of an operation.
+
+    Parameters
+    ----------
+    statistic : str
+        The statistic to check: ``p<N>`` for a percentile, ``mean`` or
+        ``max``.
+    operation : str
+        The name of the measured operation, e.g. an SMTP command like
+        ``RCPT`` or ``delivery``. Matched case-insensitive.
+    threshold : float
+        The statistic has to stay below this number of seconds.
+    """
+
+    def __init__(self, statistic: str, operation: str, threshold: float) -> None:
+        self.statistic = statistic.lower()
+        self.operation = operation.upper()
+        self.threshold = threshold
+        # Set by ``check_slos()``, if the operation was measured at all
+        self.checked = False
+
+    @classmethod
+    def parse(cls, spec: str) -> "LatencySlo":
+        """Create an SLO from its textual form, e.g. ``p95 delivery < 5s``.
+
+        Raises
+        ------
+        MailsrvParserException
+            Raised if ``spec`` is not a valid SLO.
+        """
+        match = SLO_PATTERN.match(spec.strip())
+        if match is None:
+            raise MailsrvParserException("Invalid SLO: '{}'".format(spec))
+
+        statistic, operation, value, unit = match.groups()
+        threshold = float(value)
+        if unit.lower() == "ms":
+            threshold /= 1000
+
+        if statistic.lower().startswith("p") and not 0 < float(statistic[1:]) <= 100:
+            raise MailsrvParserException("Invalid percentile: '{}'".format(spec))
+
+        return cls(statistic, operation, threshold)
+
+    def applies_to(self, operation: str) -> bool:
+        """Return ``True``, if the SLO is declared for ``operation``."""
+        return self.operation == operation.upper()
+
+    def measure(self, recorder: LatencyRecorder) -> Optional[float]:
+        """Return the statistic of ``recorder`` or ``None`` without samples."""
+        if self.statistic == "mean":
+            return recorder.mean()
+        if self.statistic == "max":
+            return recorder.percentile(100)
+        return recorder.percentile(float(self.statistic[1:]))
+
+    def check(self, recorder: LatencyRecorder) -> Optional[str]:
+        """Check the samples of ``recorder`` against the SLO.
+
+        Returns
+        -------
+        str, Optional
+            A description of the violation or ``None``, if the SLO is met.
+            An operation without samples does not violate the SLO.
+        """
+        value = self.measure(recorder)
+        if value is None or value < self.threshold:
+            return None
+
+        return "{} is {:.1f}ms (n={}), violating '{}'".format(
+            self.statistic, value * 1000, recorder.count, self
+        )
+
+    def __str__(self) -> str:  # noqa: D105
+        return "{} {} < {:g}ms".format(
+            self.statistic, self.operation, self.threshold * 1000
+        )
+
+
+def check_slos(
+    slos: list[LatencySlo], recorders: dict[str, LatencyRecorder]
+) -> list[str]:
+    """Check several SLOs against the recorders of the measured operations.
+
+    Parameters
+    ----------
+    slos : list
+        The SLOs to check. SLOs on operations, that are not included in
+        ``recorders``, are ignored here; the others are marked as
+        ``checked``, so SLOs on operations that were never measured (e.g.
+        because of a typo) may be reported after the run.
+    recorders : dict
+        The recorders with the (case-insensitive) operation as key.
+
+    Returns
+    -------
+    list
+        The descriptions of all violations.
+    """
+    violations = []
+    for operation, recorder in recorders.items():
+        for slo in slos:
+            if not slo.applies_to(operation):
+                continue
+            slo.checked = True
+            violation = slo.check(recorder)
+            if violation is not None:
+                violations.append("{}: {}".format(operation, violation))
+
+    return violations
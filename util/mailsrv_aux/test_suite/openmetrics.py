@@ -0,0 +1,481 @@
+# SPDX-FileCopyrightText: 2022 Mischback
+# SPDX-License-Identifier: MIT
+# SPDX-FileType: SOURCE
+
+"""Export the metrics of a test run in the OpenMetrics text format.
+
+The ``MetricsRegistry`` collects counters of the sent, accepted, rejected and
+deferred messages and histograms of the measured latencies, labelled by suite
+and target. The histograms use the fixed buckets of the ``LatencyRecorder``
+instances, so the registry does not keep any samples.
+
+The metrics may be written to a file for the *textfile collector* of the
+Prometheus node exporter (see ``write_textfile()``) or be served by a local
+HTTP endpoint (see ``serve()``).
+"""
+
+# Python imports
+import bisect
+import http.server
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Optional, Union
+
+# local imports
+from ..common.exceptions import MailsrvIOException
+from ..common.log import add_level
+from .imap import ImapVerifyMailGotDelivered
+from .latency import DELIVERY_PATHS, DeliveryLatencyReport
+from .metrics import DEFAULT_BUCKETS, LatencyRecorder
+from .pop3 import Pop3GenericTestSuite
+from .protocols import SmtpTestProtocol
+from .smtp import SmtpGenericTestSuite
+from .tls import TlsHandshakeStats
+
+# get a module-level logger
+logger = logging.getLogger(__name__)
+
+# add VERBOSE / SUMMARY log levels
+add_level("VERBOSE", logging.INFO - 1)
+add_level("SUMMARY", logging.INFO + 1)
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+# The commands, that are exported as authentication latency
+AUTH_COMMANDS = frozenset(("AUTH", "PASS", "APOP"))
+
+# Typing stuff
+TLabels = tuple[tuple[str, str], ...]
+
+
+def escape_label_value(value: str) -> str:
+    """Escape a label value, as required by the text format."""
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value: float) -> str:
+    """Format a sample value or bucket bound."""
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class Histogram:
+    """A histogram with fixed buckets.
+
+    Parameters
+    ----------
+    buckets : tuple, optional
+        The upper bounds of the buckets in seconds (default:
+        ``DEFAULT_BUCKETS``).
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, seconds: float) -> None:
+        """Add a single sample, provided in seconds."""
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def add_recorder(self, recorder: LatencyRecorder) -> None:
+        """Add the histogram of a recorder, which has to use the same buckets."""
+        if recorder.buckets != self.buckets:
+            raise ValueError("Can not add a recorder with different buckets")
+
+        previous = 0
+        for index, (_, cumulative) in enumerate(recorder.histogram()):
+            self.counts[index] += cumulative - previous
+            previous = cumulative
+        self.count += recorder.count
+        self.sum += recorder.total
+
+    def cumulative(self) -> list[tuple[float, int]]:
+        """Return the cumulative counts by upper bound, ending with ``+Inf``."""
+        result = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            cumulative += count
+            result.append((bound, cumulative))
+        return result
+
+
+class MetricFamily:
+    """All samples of a metric, by their labels.
+
+    Parameters
+    ----------
+    name : str
+        The name of the metric, without the ``_total`` suffix of counters.
+    kind : str
+        The type of the metric: ``counter``, ``gauge`` or ``histogram``.
+    help_text : str
+        The description of the metric.
+    unit : str, optional
+        The unit of the metric, which has to be the suffix of ``name``
+        (default: no unit).
+    """
+
+    def __init__(
+        self, name: str, kind: str, help_text: str, unit: Optional[str] = None
+    ) -> None:
+        self.name = name
+        self.kind = kind
+        self.help_text = help_text
+        self.unit = unit
+        self.samples: dict[TLabels, Union[float, Histogram]] = {}
+
+    def render(self) -> list[str]:
+        """Return the lines of the metric family."""
+        lines = [
+            "# TYPE {} {}".format(self.name, self.kind),
+            "# HELP {} {}".format(self.name, self.help_text),
+        ]
+        if self.unit is not None:
+            lines.append("# UNIT {} {}".format(self.name, self.unit))
+
+        for labels in sorted(self.samples):
+            value = self.samples[labels]
+            if isinstance(value, Histogram):
+                for bound, count in value.cumulative():
+                    lines.append(
+                        "{}_bucket{} {}".format(
+                            self.name,
+                            _render_labels(labels + (("le", format_value(bound)),)),
+                            count,
+                        )
+                    )
+                lines.append(
+                    "{}_count{} {}".format(
+                        self.name, _render_labels(labels), value.count
+                    )
+                )
+                lines.append(
+                    "{}_sum{} {}".format(
+                        self.name, _render_labels(labels), format_value(value.sum)
+                    )
+                )
+                continue
+
+            lines.append(
+                "{}{}{} {}".format(
+                    self.name,
+                    "_total" if self.kind == "counter" else "",
+                    _render_labels(labels),
+                    format_value(value),
+                )
+            )
+
+        return lines
+
+
+def _render_labels(labels: TLabels) -> str:
+    if not labels:
+        return ""
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(name, escape_label_value(value)) for name, value in labels
+        )
+    )
+
+
+class MetricsRegistry:
+    """Collect the metrics of a test run.
+
+    The registry may be updated while it is served, all modifications are
+    guarded by a lock.
+
+    Parameters
+    ----------
+    namespace : str, optional
+        The prefix of all metric names (default: mailsrv_test).
+    """
+
+    def __init__(self, namespace: str = "mailsrv_test") -> None:
+        self.namespace = namespace
+        self._families: dict[str, MetricFamily] = {}
+        self._lock = threading.Lock()
+
+    def _family(
+        self, name: str, kind: str, help_text: str, unit: Optional[str] = None
+    ) -> MetricFamily:
+        full_name = "{}_{}".format(self.namespace, name)
+        family = self._families.get(full_name, None)
+        if family is None:
+            family = MetricFamily(full_name, kind, help_text, unit)
+            self._families[full_name] = family
+        elif family.kind != kind:
+            raise ValueError("'{}' is already a {}".format(full_name, family.kind))
+        return family
+
+    def inc(self, name: str, help_text: str, value: float = 1, **labels: str) -> None:
+        """Increase a counter."""
+        with self._lock:
+            family = self._family(name, "counter", help_text)
+            key = tuple(sorted(labels.items()))
+            family.samples[key] = family.samples.get(key, 0) + value  # type: ignore [operator]
+
+    def set(self, name: str, help_text: str, value: float, **labels: str) -> None:
+        """Set a gauge."""
+        with self._lock:
+            family = self._family(name, "gauge", help_text)
+            family.samples[tuple(sorted(labels.items()))] = value
+
+    def observe(
+        self, name: str, help_text: str, recorder: LatencyRecorder, **labels: str
+    ) -> None:
+        """Add the histogram of a ``LatencyRecorder`` to a histogram (in seconds)."""
+        if not recorder.count:
+            return
+
+        with self._lock:
+            family = self._family(name, "histogram", help_text, unit="seconds")
+            key = tuple(sorted(labels.items()))
+            histogram = family.samples.get(key, None)
+            if histogram is None:
+                histogram = Histogram(recorder.buckets)
+                family.samples[key] = histogram
+            histogram.add_recorder(recorder)  # type: ignore [union-attr]
+
+    def observe_value(
+        self, name: str, help_text: str, seconds: float, **labels: str
+    ) -> None:
+        """Add a single sample (in seconds) to a histogram."""
+        with self._lock:
+            family = self._family(name, "histogram", help_text, unit="seconds")
+            key = tuple(sorted(labels.items()))
+            histogram = family.samples.get(key, None)
+            if histogram is None:
+                histogram = Histogram()
+                family.samples[key] = histogram
+            histogram.add(seconds)  # type: ignore [union-attr]
+
+    def record_messages(
+        self, suite: str, target: str, protocol: SmtpTestProtocol
+    ) -> None:
+        """Count the sent, accepted, rejected and deferred messages of a protocol."""
+        for event, value in (
+            ("sent", protocol.get_mail_count()),
+            ("accepted", protocol.get_accepted_count()),
+            ("rejected", protocol.get_rejected_count()),
+            ("deferred", protocol.get_deferred_count()),
+        ):
+            self.inc(
+                "messages",
+                "Messages by event; accepted counts recipients.",
+                value,
+                suite=suite,
+                target=target,
+                event=event,
+            )
+
+    def record_commands(
+        self,
+        protocol: str,
+        suite: str,
+        target: str,
+        recorders: dict[str, LatencyRecorder],
+    ) -> None:
+        """Add the latencies of the commands of a suite.
+
+        The greeting (``CONNECT``) and the authentication commands are
+        exported as their own metrics, all other commands by verb.
+        """
+        for command, recorder in recorders.items():
+            labels = {"suite": suite, "target": target, "protocol": protocol}
+            if command == "CONNECT":
+                self.observe(
+                    "connect_seconds",
+                    "Time from connecting until the greeting.",
+                    recorder,
+                    **labels,
+                )
+            elif command in AUTH_COMMANDS:
+                self.observe(
+                    "auth_seconds", "Latency of the authentication.", recorder, **labels
+                )
+            else:
+                self.observe(
+                    "command_seconds",
+                    "Latency of the commands.",
+                    recorder,
+                    command=command,
+                    **labels,
+                )
+
+    def record_smtp_suite(self, suite: SmtpGenericTestSuite) -> None:
+        """Add the messages and command latencies of an SMTP suite."""
+        target = "{}:{}".format(suite.target_ip, suite.target_port)
+        self.record_messages(suite.suite_name, target, suite.protocol)
+        self.record_commands("smtp", suite.suite_name, target, suite.command_latency)
+
+    def record_pop3_suite(self, suite: Pop3GenericTestSuite) -> None:
+        """Add the command latencies of a POP3 suite."""
+        self.record_commands(
+            "pop3",
+            suite.suite_name,
+            "{}:{}".format(suite.target_ip, suite.target_port),
+            suite.command_latency,
+        )
+
+    def record_imap_suite(self, suite: ImapVerifyMailGotDelivered) -> None:
+        """Add the search latency of an IMAP suite."""
+        self.record_commands(
+            "imap",
+            suite.suite_name,
+            "{}:{}".format(suite.target_ip, suite.target_port),
+            {"SEARCH": suite.search_latency},
+        )
+
+    def record_tls(self, stats: TlsHandshakeStats, target: str) -> None:
+        """Add the TLS handshake latencies."""
+        for resumed, recorder in (("false", stats.full), ("true", stats.resumed)):
+            self.observe(
+                "tls_handshake_seconds",
+                "Duration of the TLS handshakes.",
+                recorder,
+                target=target,
+                resumed=resumed,
+            )
+
+    def record_delivery(self, report: DeliveryLatencyReport, target: str) -> None:
+        """Add the delivery latencies, by delivery path."""
+        for path in DELIVERY_PATHS:
+            self.observe(
+                "delivery_seconds",
+                "Time from queueing until the message showed up in the mailbox.",
+                report.latency[path],
+                target=target,
+                path=path,
+            )
+        self.set(
+            "delivery_missing",
+            "Messages, that did not show up before the timeout.",
+            sum(len(subjects) for subjects in report.missing.values()),
+            target=target,
+        )
+
+    def record_cleanup(self, messages: int, reclaimed: int, target: str) -> None:
+        """Add the result of the cleanup phase."""
+        self.inc(
+            "cleanup_messages",
+            "Test messages deleted by the cleanup.",
+            messages,
+            target=target,
+        )
+        self.inc(
+            "cleanup_bytes",
+            "Size of the test messages deleted by the cleanup.",
+            reclaimed,
+            target=target,
+        )
+
+    def record_run(self, success: bool) -> None:
+        """Record the outcome and the end of a run."""
+        self.set("run_success", "1, if the last run was successful.", int(success))
+        self.set(
+            "run_timestamp_seconds", "The end of the last run (Unix time).", time.time()
+        )
+
+    def render(self) -> str:
+        """Return the metrics in the OpenMetrics text format."""
+        with self._lock:
+            lines = []
+            for name in sorted(self._families):
+                lines.extend(self._families[name].render())
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, file_path: str) -> None:
+        """Write the metrics to ``file_path``.
+
+        The file is replaced atomically, so a collector never reads a partial
+        file.
+
+        Raises
+        ------
+        MailsrvIOException
+            Raised if the file could not be written.
+        """
+        directory = os.path.dirname(os.path.abspath(file_path))
+        try:
+            handle, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(handle, "w", encoding="utf-8") as f:
+                f.write(self.render())
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, file_path)
+        except OSError as e:
+            logger.error("Could not write metrics to '%s'", file_path)
+            logger.debug(e, exc_info=True)  # noqa: G200
+            raise MailsrvIOException("Could not write metrics file")
+
+        logger.verbose("Metrics written to '%s'", file_path)  # type: ignore [attr-defined]
+
+    def serve(self, host: str = "127.0.0.1", port: int = 9465) -> "MetricsServer":
+        """Serve the metrics over HTTP in a background thread.
+
+        Raises
+        ------
+        MailsrvIOException
+            Raised if the server could not listen on the given address.
+        """
+        try:
+            server = MetricsServer((host, port), self)
+        except OSError as e:
+            logger.error("Could not serve metrics on %s:%d", host, port)
+            logger.debug(e, exc_info=True)  # noqa: G200
+            raise MailsrvIOException("Could not start metrics server")
+        threading.Thread(
+            target=server.serve_forever, name="metrics-server", daemon=True
+        ).start()
+        logger.info("Serving metrics on http://%s:%d/metrics", host, port)
+        return server
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Answer ``GET /metrics`` with the metrics of the server's registry."""
+
+    server: "MetricsServer"
+
+    def do_GET(self) -> None:  # noqa: N802 D102
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:  # noqa: D102
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class MetricsServer(http.server.ThreadingHTTPServer):
+    """Serve a ``MetricsRegistry`` on ``/metrics``.
+
+    Parameters
+    ----------
+    address : tuple
+        The address to listen on, as tuple of host and port.
+    registry : MetricsRegistry
+        The metrics to serve.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], registry: MetricsRegistry) -> None:
+        self.registry = registry
+        super().__init__(address, MetricsRequestHandler)
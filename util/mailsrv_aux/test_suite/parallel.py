@@ -0,0 +1,188 @@
+# SPDX-FileCopyrightText: 2022 Mischback
+# SPDX-License-Identifier: MIT
+# SPDX-FileType: SOURCE
+
+"""Run several test suites concurrently.
+
+The suites use the blocking ``smtplib`` / ``poplib``, so they are run in a
+bounded pool of threads. Every suite works on its own connection and its own
+protocol; the results are collected in the order of the given suites.
+"""
+
+# Python imports
+import concurrent.futures
+import logging
+from typing import Callable, Optional, Sequence, TypeVar, Union
+
+# local imports
+from ..common.log import add_level
+from .exceptions import MailsrvTestException
+from .imap import ImapVerifyMailGotDelivered
+from .maildir import MaildirVerifyMailGotDelivered
+from .pop3 import VerifyMailGotDelivered
+from .protocols import SmtpTestProtocol
+from .smtp import SmtpGenericTestSuite
+
+# get a module-level logger
+logger = logging.getLogger(__name__)
+
+# add VERBOSE / SUMMARY log levels
+add_level("VERBOSE", logging.INFO - 1)
+add_level("SUMMARY", logging.INFO + 1)
+
+# Typing stuff
+TSuite = TypeVar("TSuite")
+TResult = TypeVar("TResult")
+TVerifySuite = Union[
+    VerifyMailGotDelivered, ImapVerifyMailGotDelivered, MaildirVerifyMailGotDelivered
+]
+
+# The mailbox was checked, but the latencies violate the suite's SLOs
+_SLO_VIOLATIONS = (
+    VerifyMailGotDelivered.Pop3SloViolation,
+    ImapVerifyMailGotDelivered.ImapSloViolation,
+)
+
+
+def run_in_pool(
+    func: Callable[[TSuite], TResult],
+    suites: Sequence[TSuite],
+    max_workers: int = 8,
+) -> list[TResult]:
+    """Apply ``func`` to all ``suites``, using a bounded pool of threads.
+
+    Parameters
+    ----------
+    func : callable
+        The function to apply, e.g. the unbound ``run()`` method of a suite.
+    suites : list
+        The suites (or any other work items).
+    max_workers : int, optional
+        The maximum number of concurrent workers (default: 8).
+
+    Returns
+    -------
+    list
+        The results of ``func``, in the order of ``suites``.
+
+    Raises
+    ------
+    Exception
+        The first exception (in the order of ``suites``) is re-raised. Pending
+        work items are cancelled.
+    """
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(max_workers, 1))
+    futures = [executor.submit(func, suite) for suite in suites]
+
+    try:
+        results = [future.result() for future in futures]
+    except BaseException:
+        executor.shutdown(wait=True, cancel_futures=True)
+        raise
+
+    executor.shutdown(wait=True)
+    return results
+
+
+def run_smtp_suites(
+    suites: Sequence[SmtpGenericTestSuite], max_workers: int = 8
+) -> SmtpTestProtocol:
+    """Run SMTP suites concurrently and merge their protocols.
+
+    Parameters
+    ----------
+    suites : list
+        The SMTP suites to run. Each suite should have its own tagger of a
+        shared ``RunTagger``, see ``mailsrv_aux.test_suite.tagging``.
+    max_workers : int, optional
+        The maximum number of concurrent suites (default: 8).
+
+    Returns
+    -------
+    SmtpTestProtocol
+        The merged protocol of all suites, in the order of ``suites``.
+    """
+    logger.verbose("Running %d SMTP suites with up to %d workers", len(suites), max_workers)  # type: ignore [attr-defined]
+    protocols = run_in_pool(SmtpGenericTestSuite.run, suites, max_workers=max_workers)
+
+    return SmtpTestProtocol.merge(*protocols)
+
+
+def _verify_mailbox(suite: TVerifySuite) -> Optional[Exception]:
+    """Run a single verification suite and return an error, if any.
+
+    No exception is propagated, so a failing mailbox does not cancel the
+    checks of the others.
+    """
+    try:
+        suite.run()
+    except MailsrvTestException as e:
+        # Missing messages are available from the suite, everything else is
+        # an SLO violation or an operational error.
+        if not suite.missing_messages:
+            return e
+    except Exception as e:
+        logger.debug(e, exc_info=True)  # noqa: G200
+        return e
+
+    return None
+
+
+def verify_mailboxes(suites: Sequence[TVerifySuite], max_workers: int = 8) -> None:
+    """Verify several mailboxes concurrently.
+
+    Other than running the suites one by one, a failing mailbox does not stop
+    the verification. All results are collected and reported together.
+
+    Parameters
+    ----------
+    suites : list
+        The verification suites (POP3, IMAP or Maildir), one per mailbox.
+    max_workers : int, optional
+        The maximum number of concurrent connections (default: 8).
+
+    Raises
+    ------
+    MailsrvTestException
+        Raised after all mailboxes were checked, if at least one expected
+        message is missing, a mailbox could not be checked or the latencies
+        of a check violate its SLOs.
+    """
+    logger.verbose("Verifying %d mailboxes with up to %d workers", len(suites), max_workers)  # type: ignore [attr-defined]
+    errors = run_in_pool(_verify_mailbox, suites, max_workers=max_workers)
+
+    missing = {
+        suite.username: suite.missing_messages
+        for suite in suites
+        if suite.missing_messages
+    }
+    violations = {
+        suite.username: error
+        for suite, error in zip(suites, errors)
+        if isinstance(error, _SLO_VIOLATIONS)
+    }
+    failed = {
+        suite.username: error
+        for suite, error in zip(suites, errors)
+        if error is not None and not isinstance(error, _SLO_VIOLATIONS)
+    }
+
+    for username, subjects in missing.items():
+        logger.error("Missing in '%s': %r", username, subjects)
+    for username, violation in violations.items():
+        logger.error("SLO violated in '%s': %s", username, violation)
+    for username, error in failed.items():
+        logger.error("Could not check '%s': %s", username, error)
+
+    if missing or violations or failed:
+        logger.error(
+            "%d message(s) missing in %d of %d mailboxes, %d mailboxes violating SLOs, %d mailboxes not checked",
+            sum(len(subjects) for subjects in missing.values()),
+            len(missing),
+            len(suites),
+            len(violations),
+            len(failed),
+        )
+        raise MailsrvTestException("Mailbox verification failed")
+
+    logger.summary("All expected messages found in %d mailboxes", len(suites))  # type: ignore [attr-defined]
@@ -0,0 +1,132 @@
+# SPDX-FileCopyrightText: 2022 Mischback
+# SPDX-License-Identifier: MIT
+# SPDX-FileType: SOURCE
+
+"""Plan the deliveries of the accepted mails.
+
+The SMTP suites record the accepted mails by recipient. To verify the
+delivery, the recipients have to be expanded to the actual mailboxes, the way
+Postfix does it:
+
+- A recipient with an entry in the virtual alias map is replaced by the
+  (resolved) targets of the alias; only other recipients are delivered to
+  their virtual mailbox.
+- A message is delivered only once per mailbox, even if several of its
+  recipients expand to the same mailbox (Postfix's duplicate elimination).
+
+A message is identified by its subject, which is unique, as all mails of a run
+are tagged (see ``mailsrv_aux.test_suite.tagging``).
+"""
+
+# Python imports
+import collections
+import logging
+from typing import Iterator
+
+# local imports
+from ..common.log import add_level
+from .protocols import SmtpTestProtocol
+
+# get a module-level logger
+logger = logging.getLogger(__name__)
+
+# add VERBOSE / SUMMARY log levels
+add_level("VERBOSE", logging.INFO - 1)
+add_level("SUMMARY", logging.INFO + 1)
+
+
+class DeliveryPlanner:
+    """Map accepted recipients to mailboxes.
+
+    The expansion of every recipient is looked up in indexes, that are built
+    once, so planning is linear in the number of accepted recipients (and
+    their expansions).
+
+    Parameters
+    ----------
+    postfix_vmailboxes : list
+        The actual mailboxes.
+    resolved_aliases : dict
+        The resolved aliases, as provided by ``PostfixAliasResolver``.
+        External targets are ignored.
+    """
+
+    def __init__(
+        self, postfix_vmailboxes: list[str], resolved_aliases: dict[str, list[str]]
+    ) -> None:
+        self._mailboxes = frozenset(postfix_vmailboxes)
+        self._aliases = {
+            alias: tuple(
+                dict.fromkeys(target for target in targets if target in self._mailboxes)
+            )
+            for alias, targets in resolved_aliases.items()
+        }
+
+    def is_alias(self, recipient: str) -> bool:
+        """Return ``True``, if ``recipient`` is rewritten by the alias map."""
+        return recipient in self._aliases
+
+    def expand(self, recipient: str) -> tuple[str, ...]:
+        """Return the mailboxes, ``recipient`` is delivered to."""
+        targets = self._aliases.get(recipient, None)
+        if targets is not None:
+            return targets
+        if recipient in self._mailboxes:
+            return (recipient,)
+        return ()
+
+    def deliveries(
+        self, smtp_protocol: SmtpTestProtocol
+    ) -> Iterator[tuple[str, str, str]]:
+        """Generate the deliveries of the accepted mails.
+
+        Parameters
+        ----------
+        smtp_protocol : SmtpTestProtocol
+            The protocol of the SMTP suites.
+
+        Returns
+        -------
+        iterator
+            Tuples of mailbox, subject and the recipient, the delivery is
+            caused by. For every subject, a mailbox is included only once.
+        """
+        # All recipients of a message are expanded together
+        recipients: dict[str, list[str]] = collections.defaultdict(list)
+        for rcpt, subjects in smtp_protocol.get_accepted().items():
+            for subject in subjects:
+                recipients[subject].append(rcpt)
+
+        for subject, rcpts in recipients.items():
+            delivered: set[str] = set()
+            for rcpt in rcpts:
+                for mailbox in self.expand(rcpt):
+                    if mailbox in delivered:
+                        logger.debug("'%s': duplicate delivery to %s", subject, mailbox)
+                        continue
+                    delivered.add(mailbox)
+                    yield mailbox, subject, rcpt
+
+    def plan(
+        self, smtp_protocol: SmtpTestProtocol
+    ) -> dict[str, collections.Counter[str]]:
+        """Return the expected messages by mailbox.
+
+        Returns
+        -------
+        dict
+            The mailboxes (as keys) with a ``collections.Counter`` of the
+            expected subjects.
+        """
+        result: dict[str, collections.Counter[str]] = collections.defaultdict(
+            collections.Counter
+        )
+        for mailbox, subject, _ in self.deliveries(smtp_protocol):
+            result[mailbox][subject] += 1
+
+        logger.verbose(  # type: ignore [attr-defined]
+            "Planned %d deliveries to %d mailboxes",
+            sum(sum(expected.values()) for expected in result.values()),
+            len(result),
+        )
+        return dict(result)
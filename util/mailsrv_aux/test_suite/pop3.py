@@ -9,13 +9,26 @@ server **and** verify, that all mails got delivered as expected.
 """
 
 # Python imports
+import collections
+import email.policy
+import json
 import logging
+import os
 import poplib
+import socket
+import ssl
+import threading
+import time
+from email.parser import BytesHeaderParser
 from typing import Any, Optional
 
 # local imports
+from ..common.exceptions import MailsrvIOException
 from ..common.log import add_level
 from .exceptions import MailsrvTestException
+from .metrics import LatencyRecorder, LatencySlo, check_slos
+from .tagging import TRACKING_HEADER
+from .tls import TlsSessionContext
 
 # get a module-level logger
 logger = logging.getLogger(__name__)
@@ -25,6 +38,61 @@ add_level("VERBOSE", logging.INFO - 1)
 add_level("SUMMARY", logging.INFO + 1)
 
 
+class TimedPOP3(poplib.POP3):
+    """Measure the time between every command and its (complete) response.
+
+    The latencies are recorded by operation: the command, e.g. ``UIDL``, and
+    ``CONNECT`` for the greeting. For multi-line responses, the time until
+    the last line is measured.
+
+    Parameters
+    ----------
+    recorders : dict
+        The ``LatencyRecorder`` instances by operation; missing recorders
+        are added.
+    max_samples : int, optional
+        Passed to the added recorders (default: ``None``, keep all samples).
+
+    Notes
+    -----
+    For all other parameters refer to ``poplib.POP3``.
+    """
+
+    def __init__(
+        self,
+        *args: Any,
+        recorders: dict[str, LatencyRecorder],
+        max_samples: Optional[int] = None,
+        **kwargs: Any,
+    ) -> None:
+        self.recorders = recorders
+        self.max_samples = max_samples
+        start = time.perf_counter()
+        super().__init__(*args, **kwargs)
+        self._record("CONNECT", start)
+
+    def _record(self, operation: str, start: float) -> None:
+        recorder = self.recorders.setdefault(
+            operation,
+            LatencyRecorder("POP3 {}".format(operation), max_samples=self.max_samples),
+        )
+        recorder.add(time.perf_counter() - start)
+
+    def _shortcmd(self, line: str) -> bytes:
+        start = time.perf_counter()
+        try:
+            return super()._shortcmd(line)  # type: ignore [misc, no-any-return]
+        finally:
+            self._record(line.split(" ", 1)[0].upper(), start)
+
+    def _longcmd(self, line: str) -> tuple[bytes, list[bytes], int]:
+        start = time.perf_counter()
+        try:
+            return super()._longcmd(line)  # type: ignore [misc, no-any-return]
+        finally:
+            self._record(line.split(" ", 1)[0].upper(), start)
+
+
 class Pop3GenericTestSuite:
     """Provide the POP3 protocol abstraction for actual test suites.
 
@@ -45,8 +113,26 @@ class Pop3GenericTestSuite:
         The password to use during POP3's login. This is marked as *optional*
         for Python's typing, but a default value of ``None`` is provided which
         results in a ``Pop3OperationalError`` if not overwritten.
+    tls_context : ssl.SSLContext, optional
+        The context to be used for ``STLS``. Provide a shared
+        ``TlsSessionContext`` to resume TLS sessions across suites (default:
+        ``None``, meaning ``poplib``'s default context).
+    timeout : float, optional
+        The timeout of every blocking operation in seconds (default: 30).
+    slos : list, optional
+        The ``LatencySlo`` instances to check the command latencies against,
+        e.g. ``p95 UIDL < 100ms``. A violation fails the suite (default: no
+        SLOs).
+
+    Notes
+    -----
+    After the run, ``command_latency`` contains the latencies of the POP3
+    commands, see ``TimedPOP3``.
     """
 
+    # Limit the memory of the command latencies, see ``LatencyRecorder``
+    latency_samples: Optional[int] = None
+
     class Pop3GenericException(MailsrvTestException):
         """Base class for all exceptions of POP3 test suites."""
 
@@ -56,6 +142,9 @@ class Pop3GenericTestSuite:
     class Pop3TestSuiteError(Pop3GenericException):
         """Indicate an actual test failure."""
 
+    class Pop3SloViolation(Pop3TestSuiteError):
+        """Indicate that the measured latencies violate the suite's SLOs."""
+
     def __init__(
         self,
         target_ip: str = "127.0.0.1",
@@ -63,10 +152,17 @@ class Pop3GenericTestSuite:
         suite_name: str = "Generic POP3 Suite",
         username: Optional[str] = None,
         password: Optional[str] = None,
+        tls_context: Optional[ssl.SSLContext] = None,
+        timeout: float = 30.0,
+        slos: Optional[list[LatencySlo]] = None,
     ) -> None:
         self.target_ip = target_ip
         self.target_port = target_port
         self.suite_name = suite_name
+        self.tls_context = tls_context
+        self.timeout = timeout
+        self.slos = slos or []
+        self.command_latency: dict[str, LatencyRecorder] = {}
 
         if username is None:
             logger.critical("Missing parameter: 'username'")
@@ -80,10 +176,27 @@ class Pop3GenericTestSuite:
 
     def _connect(self) -> None:
         try:
-            self.pop = poplib.POP3(self.target_ip, port=self.target_port)
+            self.pop = TimedPOP3(
+                self.target_ip,
+                port=self.target_port,
+                timeout=self.timeout,
+                recorders=self.command_latency,
+                max_samples=self.latency_samples,
+            )
         except ConnectionRefusedError:
             logger.critical("Target (%s) refused the connection", self.target_ip)
             raise self.Pop3OperationalError("Connection refused")
+        except socket.timeout:
+            logger.critical(
+                "Target (%s) did not answer within %.1fs", self.target_ip, self.timeout
+            )
+            raise self.Pop3OperationalError("Timeout")
+        except (poplib.error_proto, OSError) as e:
+            # e.g. a connection closed before the greeting or a reset
+            logger.critical(  # noqa: G200
+                "Could not connect to target (%s): %s", self.target_ip, e
+            )
+            raise self.Pop3OperationalError("Connection failed")
 
         logger.info("Connection to target (%s) established", self.target_ip)
 
@@ -95,6 +208,13 @@ class Pop3GenericTestSuite:
             logger.critical("Authentication failed: %s", e)  # noqa: G200
             raise self.Pop3OperationalError("Authentication failed")
 
+    def _stls(self) -> None:
+        try:
+            self.pop.stls(context=self.tls_context)
+        except poplib.error_proto as e:
+            logger.critical("STLS failed: %s", e)  # noqa: G200
+            raise self.Pop3OperationalError("TLS failure")
+
     def _pre_connect(self) -> None:
         pass
 
@@ -118,17 +238,49 @@ class Pop3GenericTestSuite:
     def _run_tests(self) -> None:
         raise NotImplementedError("Has to be implemented in real test suite")
 
+    def _check_slos(self) -> None:
+        """Check the command latencies against the suite's SLOs.
+
+        Raises
+        ------
+        Pop3SloViolation
+            Raised if at least one SLO is violated.
+        """
+        for operation in sorted(self.command_latency):
+            logger.verbose("%s", self.command_latency[operation])  # type: ignore [attr-defined]
+
+        violations = check_slos(self.slos, self.command_latency)
+        for violation in violations:
+            logger.error("SLO violated: %s", violation)
+        if violations:
+            raise self.Pop3SloViolation(
+                "{} SLO violation(s) in {}".format(len(violations), self.suite_name)
+            )
+
     def run(self) -> None:
         """Run the test suite."""
         logger.summary("Running %s", self.suite_name)  # type: ignore [attr-defined]
         self._pre_connect()
         self._connect()
-        self._pre_run()
         try:
-            self._run_tests()
-            self._post_run()
-        finally:
-            self._disconnect()
+            self._pre_run()
+            try:
+                self._run_tests()
+                self._post_run()
+            finally:
+                self._disconnect()
+        except socket.timeout:
+            logger.critical(
+                "Target (%s) did not answer within %.1fs", self.target_ip, self.timeout
+            )
+            raise self.Pop3OperationalError("Timeout")
+        except (poplib.error_proto, OSError) as e:
+            logger.critical(  # noqa: G200
+                "Connection to target (%s) failed: %s", self.target_ip, e
+            )
+            raise self.Pop3OperationalError("Connection failed")
+
+        self._check_slos()
 
         logger.summary("%s finished successfully", self.suite_name)  # type: ignore [attr-defined]
 
@@ -162,17 +314,98 @@ class NoNonSecureAuth(Pop3GenericTestSuite):
         raise self.Pop3TestSuiteError("Server accepted login without secure connection")
 
 
+class UidlCache:
+    """Remember the subjects of already seen messages, per mailbox.
+
+    POP3's ``UIDL`` provides a unique and persistent ID for every message in
+    a mailbox. Once the subject of a message is known, it never has to be
+    fetched again. The cache may be persisted to a JSON file, so it is
+    available to subsequent runs.
+
+    Parameters
+    ----------
+    file_path : str, optional
+        The path to the cache file. If the file does not exist, the cache
+        starts empty. If no path is given, the cache is kept in memory only
+        (default: ``None``).
+
+    Notes
+    -----
+    The cache may be shared between suites running in different threads.
+    """
+
+    def __init__(self, file_path: Optional[str] = None) -> None:
+        self.file_path = file_path
+        self._mailboxes: dict[str, dict[str, str]] = {}
+        self._lock = threading.Lock()
+
+        if file_path is None or not os.path.exists(file_path):
+            return
+
+        try:
+            with open(file_path, "r") as f:
+                self._mailboxes = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning("Could not read UIDL cache '%s', starting empty", file_path)
+            logger.debug(e, exc_info=True)  # noqa: G200
+
+    def get_mailbox(self, mailbox: str) -> dict[str, str]:
+        """Return a copy of the cached ``UIDL`` to subject mapping."""
+        with self._lock:
+            return dict(self._mailboxes.get(mailbox, {}))
+
+    def set_mailbox(self, mailbox: str, entries: dict[str, str]) -> None:
+        """Replace the cached ``UIDL`` to subject mapping of a mailbox."""
+        with self._lock:
+            self._mailboxes[mailbox] = entries
+
+    def save(self) -> None:
+        """Write the cache to its file, if a path was provided.
+
+        Raises
+        ------
+        MailsrvIOException
+            Any ``OSError`` will be catched and converted to an
+            ``MailsrvIOException``.
+        """
+        if self.file_path is None:
+            return
+
+        tmp_path = "{}.tmp".format(self.file_path)
+        try:
+            with self._lock:
+                with open(tmp_path, "w") as f:
+                    json.dump(self._mailboxes, f)
+            os.replace(tmp_path, self.file_path)
+        except OSError as e:
+            logger.error("Error while writing '%s'", self.file_path)
+            logger.debug(e, exc_info=True)  # noqa: G200
+            raise MailsrvIOException("Error while writing '{}'".format(self.file_path))
+
+
 class VerifyMailGotDelivered(Pop3GenericTestSuite):
     """Check the mailbox of a given user for expected mails.
 
+    Only the headers of the messages are fetched (``TOP n 0``). Messages are
+    identified by their tag (see ``mailsrv_aux.test_suite.tagging``), which is
+    cached by the messages' ``UIDL``, so messages that were already seen
+    (during this run or, with a persistent ``UidlCache``, a previous one) are
+    not fetched again.
+
     Parameters
     ----------
     expected_messages : list
         A ``list`` of ``str``, representing the subjects of the messages,
-        expected to be present in the mailbox.
+        expected to be present in the mailbox. A subject may be included
+        several times, if several messages with that subject are expected.
+    uidl_cache : UidlCache, optional
+        The cache of already known subjects (default: a new in-memory cache).
 
     Notes
     -----
+    After the run, ``missing_messages`` contains the subjects that could not
+    be found.
+
     For a full list of parameters refer to ``Pop3GenericTestSuite``.
     """
 
@@ -181,6 +414,7 @@ class VerifyMailGotDelivered(Pop3GenericTestSuite):
         *args: Any,
         suite_name: str = "Verify messages in Mailbox Test Suite",
         expected_messages: Optional[list[str]] = None,
+        uidl_cache: Optional[UidlCache] = None,
         **kwargs: Optional[Any],
     ) -> None:
         super().__init__(  # type: ignore
@@ -193,44 +427,77 @@ class VerifyMailGotDelivered(Pop3GenericTestSuite):
             raise self.Pop3OperationalError("Missing parameter: 'expected_mails'")
         self.expected_messages = expected_messages
 
-    def _pre_run(self) -> None:
-        self.pop.stls()
-        self._auth()
+        if uidl_cache is None:
+            self.uidl_cache = UidlCache()
+        else:
+            self.uidl_cache = uidl_cache
 
-    def _get_message_subject(self, message: list[bytes]) -> str:
-        # This is crazily kluged together...
-        # It retrieves the actual subject by looking for the substring
-        # ``"Subject: "`` in all *lines* of the message, then decodes the line
-        # to UTF-8 / ASCII and removes the prefix.
-        return [
-            i.decode().removeprefix("Subject: ")
-            for i in message
-            if "Subject: " in i.decode()
-        ][0]
+        self.missing_messages: list[str] = []
 
-    def _run_tests(self) -> None:
-        # Get a list of all messages in the mailbox
-        msg_list = self.pop.list()[1]
+    def _pre_run(self) -> None:
+        self._stls()
+        self._auth()
 
-        # Loop all messages, find their *Subject* line and compare to the
-        # provided list of expected messages (which is in fact a list of
-        # subjects). The message is removed from the list of expected messages.
-        for item in msg_list:
-            msg_id = item.decode().split(" ")[0]
-            # logger.debug("Processing message: %s", msg_id)
+        if isinstance(self.tls_context, TlsSessionContext):
+            self.tls_context.remember_session(self.pop.sock)
 
-            msg = self.pop.retr(msg_id)[1]
+    def _get_message_tag(self, msg_num: str) -> str:
+        """Fetch the headers of a message and return its tag.
 
-            subject = self._get_message_subject(msg)
-            # logger.debug("Subject of %s: %s", msg_id, subject)
+        The tag is read from the ``TRACKING_HEADER``. For messages without
+        that header, the subject is used.
+        """
+        try:
+            header_lines = self.pop.top(msg_num, 0)[1]
+        except poplib.error_proto as e:
+            logger.critical("Could not fetch headers: %s", e)  # noqa: G200
+            raise self.Pop3OperationalError("TOP failed")
 
-            if subject in self.expected_messages:
-                logger.debug("Found '%s' (message ID %s)", subject, msg_id)
-                self.expected_messages.pop(self.expected_messages.index(subject))
+        headers = BytesHeaderParser(policy=email.policy.default).parsebytes(
+            b"\r\n".join(header_lines)
+        )
+        return str(headers.get(TRACKING_HEADER, None) or headers.get("Subject", ""))
+
+    def _find_expected(self) -> list[str]:
+        """Search the mailbox and return the subjects of missing messages."""
+        expected = collections.Counter(self.expected_messages)
+        remaining = sum(expected.values())
+
+        known = self.uidl_cache.get_mailbox(self.username)
+        seen: dict[str, str] = {}
+
+        # Get the unique IDs of all messages in the mailbox. The most recent
+        # messages are the most likely candidates, so the list is processed
+        # in reverse order.
+        uidl_list = self.pop.uidl()[1]
+        for item in reversed(uidl_list):
+            msg_num, uid = item.decode().split(" ", 1)
+
+            subject = known.get(uid)
+            if subject is None:
+                subject = self._get_message_tag(msg_num)
+            seen[uid] = subject
+
+            if expected[subject] > 0:
+                logger.debug("Found '%s' (message ID %s)", subject, msg_num)
+                expected[subject] -= 1
+                remaining -= 1
+                if remaining == 0:
+                    break
+
+        # Keep the cached entries of messages that were not processed, but
+        # only if they are still present in the mailbox.
+        present = {item.decode().split(" ", 1)[1] for item in uidl_list}
+        seen.update({uid: known[uid] for uid in (known.keys() & present) - seen.keys()})
+        self.uidl_cache.set_mailbox(self.username, seen)
+
+        return list(expected.elements())
 
-        if self.expected_messages:
+    def _run_tests(self) -> None:
+        self.missing_messages = self._find_expected()
+        if self.missing_messages:
             logger.error(
-                "Could not find expected message(s): %s", self.expected_messages
+                "Could not find expected message(s): %s", self.missing_messages
             )
             raise self.Pop3TestSuiteError(
                 "At least one expected message could not be found"
@@ -7,20 +7,76 @@
 from __future__ import annotations
 
 # Python imports
-from collections import defaultdict
+from collections import Counter, defaultdict
 from functools import total_ordering
-from typing import Any, Optional
+from typing import Any, Iterable, Iterator, Optional
+
+# local imports
+from .eventlog import EventLog, read_events
+from .tagging import tag_run_id, tag_source
+
+
+class MailRecord:
+    """Store the correlation data of a single mail.
+
+    Parameters
+    ----------
+    tag : str
+        The tag of the mail, see ``mailsrv_aux.test_suite.tagging``.
+    suite : str
+        The name of the sending suite.
+    origin : str
+        How the mail was handed to the server, e.g. ``"mta"`` or
+        ``"submission"``.
+    """
+
+    __slots__ = ("tag", "suite", "origin", "recipients", "queued_at")
+
+    def __init__(self, tag: str, suite: str, origin: str) -> None:
+        self.tag = tag
+        self.suite = suite
+        self.origin = origin
+        # The recipients, that were accepted by the server
+        self.recipients: set[str] = set()
+        # The time (as returned by ``time.time()``), the server accepted the
+        # mail for delivery
+        self.queued_at: Optional[float] = None
+
+    def __repr__(self) -> str:  # noqa: D105
+        return "<{classname}: {tag} ({suite}, {origin}), recipients={recipients!r}, queued_at={queued_at!r}>".format(
+            classname=self.__class__.__name__,
+            tag=self.tag,
+            suite=self.suite,
+            origin=self.origin,
+            recipients=self.recipients,
+            queued_at=self.queued_at,
+        )
 
 
 @total_ordering
 class SmtpTestProtocol:
-    """Data class to store the results of a SMTP-related test suite."""
+    """Data class to store the results of a SMTP-related test suite.
+
+    Besides the lists of sent, rejected and deferred mails, the protocol
+    provides a correlation index: the ``MailRecord`` of a mail may be looked up
+    by its tag (which is also the mail's subject), see ``lookup()``.
+
+    If an ``event_log`` is provided, the events are written to the log instead
+    of being kept in memory. Only the counters are maintained; the accepted
+    mails and the correlation index are read from the log on access, keeping
+    only the requested events. The log may be shared between several
+    protocols, as every protocol only considers the events of its own mails
+    (identified by their tags).
+    """
 
     def __init__(
         self,
         sent: Optional[list[str]] = None,
         rejected: Optional[list[str]] = None,
         accepted: Optional[dict[str, list[str]]] = None,
+        deferred: Optional[list[str]] = None,
+        index: Optional[dict[str, MailRecord]] = None,
+        event_log: Optional[EventLog] = None,
     ) -> None:
         if sent is None:
             self._sent: list[str] = []
@@ -37,36 +93,333 @@ class SmtpTestProtocol:
         else:
             self._accepted = accepted
 
+        if deferred is None:
+            self._deferred: list[str] = []
+        else:
+            self._deferred = deferred
+
+        if index is None:
+            self._index: dict[str, MailRecord] = {}
+        else:
+            self._index = index
+
+        # Only used with an event log: the number of events by type and the
+        # sources (see ``tag_source()``) of the protocol's mails.
+        self._event_log = event_log
+        self._counts: Counter[str] = Counter()
+        self._sources: set[str] = set()
+
+    def _log(self, event: str, subject: str, **fields: Any) -> None:
+        self._event_log.append(dict(event=event, tag=subject, **fields))  # type: ignore [union-attr]
+        self._counts[event] += 1
+        self._sources.add(tag_source(subject))
+
+    def _events(self) -> Iterator[dict[str, Any]]:
+        """Generate the events of the protocol's mails.
+
+        With an event log, the events are read from the log. Otherwise, they
+        are derived from the lists and the index, grouped by type.
+        """
+        if self._event_log is not None:
+            self._event_log.flush()
+            for event in read_events(self._event_log.file_path):
+                if tag_source(event.get("tag", "")) in self._sources:
+                    yield event
+            return
+
+        for subject in self._sent:
+            record = self._index[subject]
+            yield {
+                "event": "sent",
+                "tag": subject,
+                "suite": record.suite,
+                "origin": record.origin,
+            }
+        for recipient, subjects in self._accepted.items():
+            for subject in subjects:
+                yield {"event": "accepted", "tag": subject, "recipient": recipient}
+        for record in self._index.values():
+            if record.queued_at is not None:
+                yield {"event": "queued", "tag": record.tag, "time": record.queued_at}
+        for subject in self._deferred:
+            yield {"event": "deferred", "tag": subject}
+        for subject in self._rejected:
+            yield {"event": "rejected", "tag": subject}
+
+    def _apply(self, event: dict[str, Any]) -> None:
+        """Add a single event, as read from an event log."""
+        subject = event.get("tag", "")
+        kind = event.get("event", None)
+        if kind == "sent":
+            self.mail_sent(subject, event.get("suite", ""), event.get("origin", "mta"))
+        elif kind == "accepted":
+            self.mail_accepted(event.get("recipient", ""), subject)
+        elif kind == "queued":
+            self.mail_queued(subject, event.get("time", 0.0))
+        elif kind == "deferred":
+            self.mail_deferred(subject)
+        elif kind == "rejected":
+            self.mail_rejected(subject)
+
     def get_mail_count(self) -> int:
         """Return the number of sent mails during a run."""
+        if self._event_log is not None:
+            return self._counts["sent"]
         return len(self._sent)
 
     def mail_accepted(self, recipient: str, subject: str) -> None:
         """Add the subject of a mail to the dict of accepted mails."""
+        if self._event_log is not None:
+            self._log("accepted", subject, recipient=recipient)
+            return
+
         self._accepted[recipient].append(subject)
 
+        record = self._index.get(subject, None)
+        if record is not None:
+            record.recipients.add(recipient)
+
+    def get_accepted_count(self) -> int:
+        """Return the number of accepted recipients during a run."""
+        if self._event_log is not None:
+            return self._counts["accepted"]
+        return sum(len(subjects) for subjects in self._accepted.values())
+
+    def get_accepted(self) -> dict[str, list[str]]:
+        """Return the subjects of accepted mails, by recipient."""
+        if self._event_log is None:
+            return dict(self._accepted)
+
+        result: dict[str, list[str]] = defaultdict(list)
+        for event in self._events():
+            if event.get("event", None) == "accepted":
+                result[event.get("recipient", "")].append(event.get("tag", ""))
+        return dict(result)
+
+    def mail_queued(self, subject: str, timestamp: float) -> None:
+        """Record the time, the server accepted a mail for delivery.
+
+        Parameters
+        ----------
+        subject : str
+            The subject of the mail.
+        timestamp : float
+            The time (as returned by ``time.time()``), the server responded to
+            the end of the mail's data.
+        """
+        if self._event_log is not None:
+            self._log("queued", subject, time=timestamp)
+            return
+
+        record = self._index.get(subject, None)
+        if record is not None:
+            record.queued_at = timestamp
+
+    def lookup(self, tag: str) -> Optional[MailRecord]:
+        """Return the ``MailRecord`` of a mail, if it was sent.
+
+        With an event log, every call reads the log; use ``lookup_many()`` to
+        look up several mails.
+        """
+        return self.lookup_many((tag,)).get(tag, None)
+
+    def lookup_many(self, tags: Iterable[str]) -> dict[str, MailRecord]:
+        """Return the ``MailRecord`` instances of several mails, by tag.
+
+        Mails, that were not sent, are not included. With an event log, the
+        log is read once and only the records of ``tags`` are kept.
+        """
+        if self._event_log is None:
+            return {tag: self._index[tag] for tag in tags if tag in self._index}
+
+        wanted = set(tags)
+        records: dict[str, MailRecord] = {}
+        for event in self._events():
+            tag = event.get("tag", "")
+            if tag not in wanted:
+                continue
+
+            kind = event.get("event", None)
+            if kind == "sent":
+                records[tag] = MailRecord(
+                    tag, event.get("suite", ""), event.get("origin", "mta")
+                )
+            elif tag in records:
+                if kind == "accepted":
+                    records[tag].recipients.add(event.get("recipient", ""))
+                elif kind == "queued":
+                    records[tag].queued_at = event.get("time", 0.0)
+
+        return records
+
+    def get_deferred_count(self) -> int:
+        """Return the number of temporary failures during a run."""
+        if self._event_log is not None:
+            return self._counts["deferred"]
+        return len(self._deferred)
+
+    def mail_deferred(self, subject: str) -> None:
+        """Add the subject of a mail to the list of deferred mails.
+
+        A mail is *deferred*, if the server responded with a temporary failure
+        (``4xx``). The subject is added for every temporary failure, so a mail
+        that is retried several times may be included more than once.
+        """
+        if self._event_log is not None:
+            self._log("deferred", subject)
+            return
+
+        self._deferred.append(subject)
+
+    def get_rejected_count(self) -> int:
+        """Return the number of rejected mails during a run."""
+        if self._event_log is not None:
+            return self._counts["rejected"]
+        return len(self._rejected)
+
     def mail_rejected(self, subject: str) -> None:
         """Add the subject of a mail to the list of rejected mails."""
+        if self._event_log is not None:
+            self._log("rejected", subject)
+            return
+
         self._rejected.append(subject)
 
-    def mail_sent(self, subject: str) -> None:
-        """Add the subject of a mail to the list of sent mails."""
+    def mail_sent(self, subject: str, suite: str = "", origin: str = "mta") -> None:
+        """Add the subject of a mail to the list of sent mails.
+
+        The subject is the mail's tag and is added to the correlation index.
+        """
+        if self._event_log is not None:
+            self._log("sent", subject, suite=suite, origin=origin)
+            return
+
         self._sent.append(subject)
+        self._index[subject] = MailRecord(subject, suite, origin)
+
+    @classmethod
+    def from_event_log(
+        cls,
+        file_path: str,
+        sources: Optional[set[str]] = None,
+        run_id: Optional[str] = None,
+    ) -> SmtpTestProtocol:
+        """Rebuild the protocol of a run from an event log.
+
+        The log is appended to by every run, so only the events of a single
+        run are considered. The log is read once to count the events; just
+        like with a protocol writing to the log, the accepted mails and the
+        correlation index are read from the log on access.
+
+        Parameters
+        ----------
+        file_path : str
+            The path of the log file.
+        sources : set, optional
+            Only consider the mails of these sources, see ``tag_source()``
+            (default: ``None``, meaning all mails of the run).
+        run_id : str, optional
+            The ID of the run (default: ``None``, meaning the run of the last
+            event of the log).
+
+        Returns
+        -------
+        SmtpTestProtocol
+            The protocol, backed by the log. It is meant to be read only, no
+            further events can be added.
+        """
+        counts: dict[str, Counter[str]] = defaultdict(Counter)
+        run_sources: dict[str, set[str]] = defaultdict(set)
+        last_run = None
+        for event in read_events(file_path):
+            tag = event.get("tag", "")
+            source = tag_source(tag)
+            current = tag_run_id(tag)
+            if sources is not None and source not in sources:
+                continue
+            if run_id is not None and current != run_id:
+                continue
+
+            counts[current][event.get("event", "")] += 1
+            run_sources[current].add(source)
+            last_run = current
+
+        event_log = EventLog(file_path)
+        event_log.close()
+
+        result = cls(event_log=event_log)
+        selected = last_run if run_id is None else run_id
+        if selected is not None:
+            result._counts = counts[selected]
+            result._sources = run_sources[selected]
+
+        return result
+
+    def _extend(self, other: SmtpTestProtocol) -> None:
+        """Add the events of ``other`` (keeping all events in memory)."""
+        if other._event_log is not None:
+            # Streamed into this instance, without an intermediate copy
+            for event in other._events():
+                self._apply(event)
+            return
+
+        self._sent.extend(other._sent)
+        self._rejected.extend(other._rejected)
+        self._deferred.extend(other._deferred)
+        for recipient, subjects in other._accepted.items():
+            self._accepted[recipient].extend(subjects)
+        self._index.update(other._index)
+
+    @classmethod
+    def merge(cls, *protocols: SmtpTestProtocol) -> SmtpTestProtocol:
+        """Merge several instances into a new one.
+
+        The lists of the given instances are concatenated in the order of the
+        instances, so merging the protocols of concurrently run suites is
+        deterministic.
+
+        If all instances use the same event log, the result uses that log as
+        well and only the counters are merged.
+        """
+        event_logs = {protocol._event_log for protocol in protocols}
+        if len(event_logs) == 1 and None not in event_logs:
+            result = cls(event_log=event_logs.pop())
+            for protocol in protocols:
+                result._counts.update(protocol._counts)
+                result._sources.update(protocol._sources)
+            return result
+
+        result = cls()
+        for protocol in protocols:
+            result._extend(protocol)
+
+        return result
 
     def __add__(self, other: Any) -> SmtpTestProtocol:
         """**Add** is implemented as *merging* two instances."""
         if not isinstance(other, SmtpTestProtocol):
             return NotImplemented
 
-        # FIXME: What if ``other`` contains keys that are not present in self?
-        return SmtpTestProtocol(
-            sent=self._sent + other._sent,
-            rejected=self._rejected + other._rejected,
-            accepted=defaultdict(
-                list,
-                {k: self._accepted[k] + other._accepted[k] for k in self._accepted},
-            ),
-        )
+        return SmtpTestProtocol.merge(self, other)
+
+    def __iadd__(self, other: Any) -> SmtpTestProtocol:
+        """Merge ``other`` into this instance, without copying this instance."""
+        if not isinstance(other, SmtpTestProtocol):
+            return NotImplemented
+
+        if self._event_log is None:
+            self._extend(other)
+            return self
+
+        if self._event_log is other._event_log:
+            self._counts.update(other._counts)
+            self._sources.update(other._sources)
+            return self
+
+        # The events of ``other`` are appended to this instance's log
+        for event in other._events():
+            self._apply(event)
+        return self
 
     def __bool__(self) -> bool:  # noqa: D105
         return self.get_mail_count() > 0
@@ -88,18 +441,37 @@ class SmtpTestProtocol:
         return NotImplemented
 
     def __repr__(self) -> str:  # noqa: D105
-        return "<{classname}: sent={sent!r}, rejected={rejected!r}, accepted={accepted!r}>".format(
+        if self._event_log is not None:
+            # The events are not read from the log, only counted
+            return "<{classname}: event_log={file_path!r}, counts={counts!r}>".format(
+                classname=self.__class__.__name__,
+                file_path=self._event_log.file_path,
+                counts=dict(self._counts),
+            )
+        return "<{classname}: sent={sent!r}, rejected={rejected!r}, accepted={accepted!r}, deferred={deferred!r}>".format(
             classname=self.__class__.__name__,
             sent=self._sent,
             rejected=self._rejected,
             accepted=self._accepted,
+            deferred=self._deferred,
         )
 
     def __str__(self) -> str:  # noqa: D105
-        return "Mails sent: {} ({} rejected)".format(
-            len(self._sent), len(self._rejected)
+        return "Mails sent: {} ({} rejected, {} deferred)".format(
+            self.get_mail_count(),
+            self.get_rejected_count(),
+            self.get_deferred_count(),
         )
 
     def __key(self) -> tuple:
         # see https://stackoverflow.com/a/2909119
-        return (self._sent, self._rejected, self._accepted)
+        # The index is derived from the other attributes (besides the times)
+        if self._event_log is not None:
+            # Protocols of the same log are compared by their mails and
+            # counters, without reading the log.
+            return (
+                self._event_log.file_path,
+                sorted(self._sources),
+                sorted(self._counts.items()),
+            )
+        return (self._sent, self._rejected, self._accepted, self._deferred)
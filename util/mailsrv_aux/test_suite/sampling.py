@@ -0,0 +1,185 @@
+# SPDX-FileCopyrightText: 2022 Mischback
+# SPDX-License-Identifier: MIT
+# SPDX-FileType: SOURCE
+
+"""Select a representative sample of recipients.
+
+Sending a mail to every mailbox and every alias does not scale with the
+configuration. For smoke tests, a fixed-size sample is sufficient, as long as
+it covers the different kinds of recipients. The sample is stratified:
+
+- every virtual domain is represented by at least one address,
+- every *alias depth* (the number of alias levels until all targets are
+  mailboxes or external addresses) is represented by at least one alias,
+- at least one alias with external targets is included,
+- every account, that is allowed to send mails (see Postfix's sender login
+  map), is included.
+
+The remaining slots are filled with randomly chosen addresses. The selection
+only depends on the configuration and the seed, so a sample is reproducible.
+"""
+
+# Python imports
+import logging
+import random
+
+# local imports
+from ..common.log import add_level
+from ..common.parser import PostfixAliasResolver
+
+# get a module-level logger
+logger = logging.getLogger(__name__)
+
+# add VERBOSE / SUMMARY log levels
+add_level("VERBOSE", logging.INFO - 1)
+add_level("SUMMARY", logging.INFO + 1)
+
+
+def alias_depths(postfix_valiases: dict[str, list[str]]) -> dict[str, int]:
+    """Return the depth of every alias.
+
+    An alias, that only targets mailboxes or external addresses, has the
+    depth 1; an alias targeting other aliases is one level deeper than its
+    deepest target. Circular aliases are not resolved any further.
+    """
+    depths: dict[str, int] = {}
+
+    def _depth(alias: str, visiting: set[str]) -> int:
+        if alias in depths:
+            return depths[alias]
+
+        visiting.add(alias)
+        nested = [
+            _depth(target, visiting)
+            for target in postfix_valiases[alias]
+            if target in postfix_valiases and target not in visiting
+        ]
+        visiting.discard(alias)
+
+        depths[alias] = max(nested, default=0) + 1
+        return depths[alias]
+
+    for alias in postfix_valiases:
+        _depth(alias, set())
+
+    return depths
+
+
+class RecipientSampler:
+    """Select a stratified sample of the valid recipients.
+
+    Parameters
+    ----------
+    postfix_vmailboxes : list
+        The actual mailboxes.
+    postfix_valiases : dict
+        The (unresolved) alias configuration. The ``dict`` is not modified.
+    postfix_vdomains : list
+        The virtual domains.
+    sender_logins : list
+        The accounts, that are allowed to send mails.
+    seed : int, optional
+        The seed of the random selection (default: 0).
+    """
+
+    def __init__(
+        self,
+        postfix_vmailboxes: list[str],
+        postfix_valiases: dict[str, list[str]],
+        postfix_vdomains: list[str],
+        sender_logins: list[str],
+        seed: int = 0,
+    ) -> None:
+        self.postfix_vmailboxes = postfix_vmailboxes
+        self.postfix_valiases = postfix_valiases
+        self.postfix_vdomains = postfix_vdomains
+        self.sender_logins = sender_logins
+        self.seed = seed
+
+    def _strata(self) -> list[tuple[str, list[str]]]:
+        """Return the strata, that have to be covered, with their candidates.
+
+        The most specific strata come first, so the broader ones are most
+        likely covered already.
+        """
+        strata: list[tuple[str, list[str]]] = []
+
+        mailboxes = set(self.postfix_vmailboxes)
+        for account in sorted(self.sender_logins):
+            if account in mailboxes:
+                strata.append(("sender login {}".format(account), [account]))
+
+        # The resolver replaces the values of the given ``dict``
+        _, _, external = PostfixAliasResolver(
+            self.postfix_vmailboxes,
+            dict(self.postfix_valiases),
+            self.postfix_vdomains,
+        ).resolve()
+        if external:
+            strata.append(("external alias", sorted(external)))
+
+        by_depth: dict[int, list[str]] = {}
+        for alias, depth in alias_depths(self.postfix_valiases).items():
+            by_depth.setdefault(depth, []).append(alias)
+        for depth in sorted(by_depth):
+            strata.append(("alias depth {}".format(depth), sorted(by_depth[depth])))
+
+        by_domain: dict[str, list[str]] = {}
+        for address in sorted(mailboxes | self.postfix_valiases.keys()):
+            by_domain.setdefault(address.rsplit("@", 1)[-1], []).append(address)
+        for domain in self.postfix_vdomains:
+            if domain in by_domain:
+                strata.append(("domain {}".format(domain), by_domain[domain]))
+
+        return strata
+
+    def sample(self, size: int) -> list[str]:
+        """Return a sample of (at least) ``size`` addresses.
+
+        Every stratum is covered by one address, chosen randomly among its
+        candidates, unless it is already covered by an address selected for
+        another stratum. If the strata require more than ``size`` addresses, all of
+        them are included anyway and a warning is logged.
+
+        Parameters
+        ----------
+        size : int
+            The number of addresses to select.
+
+        Returns
+        -------
+        list
+            The selected addresses, in a stable order.
+        """
+        rng = random.Random(self.seed)
+        population = set(self.postfix_vmailboxes) | self.postfix_valiases.keys()
+
+        selected: list[str] = []
+        for stratum, candidates in self._strata():
+            covered = set(selected).intersection(candidates)
+            if covered:
+                logger.debug("%s: covered by %r", stratum, covered)
+                continue
+            address = rng.choice(candidates)
+            logger.debug("%s: selected %s", stratum, address)
+            selected.append(address)
+
+        if len(selected) > size:
+            logger.warning(
+                "Covering all strata requires %d recipients (sample size: %d)",
+                len(selected),
+                size,
+            )
+
+        remaining = sorted(population - set(selected))
+        selected += rng.sample(
+            remaining, min(max(size - len(selected), 0), len(remaining))
+        )
+
+        logger.verbose(  # type: ignore [attr-defined]
+            "Sampled %d of %d recipients (seed: %d)",
+            len(selected),
+            len(population),
+            self.seed,
+        )
+        return selected
@@ -0,0 +1,923 @@
+# SPDX-FileCopyrightText: 2022 Mischback
+# SPDX-License-Identifier: MIT
+# SPDX-FileType: SOURCE
+
+"""Run scenario-driven load profiles against the SUT.
+
+A scenario is a TOML file, describing a sequence of phases::
+
+    [scenario]
+    name = "capacity"
+    seed = 42
+
+    [[phase]]
+    name = "warm-up"
+    shape = "ramp"           # ramp, steady, soak or burst
+    duration = "5m"          # seconds or with unit (s, m, h)
+    start_rate = 1           # ramp: the rate at the start of the phase
+    rate = 20                # the target rate in mails per second
+    concurrency = 4          # the number of concurrent connections
+    submission_share = 0.2   # the share of mails sent by submission
+    recipients = { mailbox = 70, alias = 20, invalid = 5, relay = 5 }
+    message_sizes = "4k:70,64k:25,1m:5"
+    message_kinds = ["text", "html"]
+
+    [[phase]]
+    name = "spikes"
+    shape = "burst"
+    duration = "10m"
+    rate = 5
+    burst_rate = 50          # burst: the rate during a burst
+    burst_length = "10s"     # burst: the duration of a burst
+    burst_interval = "1m"    # burst: the time between the starts of bursts
+
+The mails are scheduled *open loop*, following the shape of the phase, and
+handed to a pool of workers, each working on its own connection. The workers
+are the existing suites: ``ScenarioWorker`` sends like ``OtherMtaTestSuite``,
+``SubmissionScenarioWorker`` authenticates like ``SubmissionTestSuite``. If
+the workers can not keep up, the mails queue up; the delay between the
+scheduled and the actual start of a transaction is reported as *lag*.
+
+Every phase reports the achieved rate, the outcomes per recipient class
+(unexpected outcomes are counted separately) and the transaction latency.
+
+The client's memory does not grow with the duration of a phase: the events
+are written to an ``EventLog``, the latency recorders keep a bounded number
+of samples and the message bodies are cached per kind and size.
+"""
+
+# Python imports
+import collections
+import logging
+import queue
+import random
+import re
+import smtplib
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Iterator, Optional
+
+# local imports
+from ..common.exceptions import MailsrvIOException, MailsrvParserException
+from ..common.log import add_level
+from .eventlog import EventLog
+from .exceptions import MailsrvTestException
+from .messages import MESSAGE_KINDS, MessageFactory, SizeDistribution
+from .metrics import LatencyRecorder, LatencySlo, check_slos
+from .protocols import SmtpTestProtocol
+from .smtp import SmtpGenericTestSuite, SubmissionTestSuite
+from .tagging import RunTagger
+
+# get a module-level logger
+logger = logging.getLogger(__name__)
+
+# add VERBOSE / SUMMARY log levels
+add_level("VERBOSE", logging.INFO - 1)
+add_level("SUMMARY", logging.INFO + 1)
+
+# The shapes of phases
+SHAPE_RAMP = "ramp"
+SHAPE_STEADY = "steady"
+SHAPE_SOAK = "soak"
+SHAPE_BURST = "burst"
+SHAPES = (SHAPE_RAMP, SHAPE_STEADY, SHAPE_SOAK, SHAPE_BURST)
+
+# The classes of recipients
+RCPT_MAILBOX = "mailbox"
+RCPT_ALIAS = "alias"
+RCPT_INVALID = "invalid"
+RCPT_RELAY = "relay"
+RECIPIENT_CLASSES = (RCPT_MAILBOX, RCPT_ALIAS, RCPT_INVALID, RCPT_RELAY)
+
+# The outcomes of a single mail
+OUTCOME_ACCEPTED = "accepted"
+OUTCOME_REJECTED = "rejected"
+OUTCOME_DEFERRED = "deferred"
+OUTCOME_ERROR = "error"
+
+# Soak phases report their progress in this interval (in seconds)
+SOAK_REPORT_INTERVAL = 300.0
+
+# The number of latency samples kept per phase
+MAX_LATENCY_SAMPLES = 10000
+
+_DURATION_PATTERN = re.compile(r"^(\d+(?:\.\d+)?)\s*([smh]?)$")
+_DURATION_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value: Any) -> float:
+    """Parse a duration in seconds, optionally with a unit (``s``, ``m``, ``h``).
+
+    Raises
+    ------
+    MailsrvParserException
+        If the value is not a valid duration.
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+
+    match = _DURATION_PATTERN.match(str(value).strip())
+    if match is None:
+        raise MailsrvParserException("Invalid duration: '{}'".format(value))
+
+    return float(match.group(1)) * _DURATION_UNITS[match.group(2)]
+
+
+def expected_outcome(recipient_class: str, submission: bool) -> str:
+    """Return the outcome the SUT should produce for a recipient class.
+
+    Local recipients are accepted, unknown ones rejected. Relaying is only
+    permitted for authenticated users (submission).
+    """
+    if recipient_class == RCPT_INVALID:
+        return OUTCOME_REJECTED
+    if recipient_class == RCPT_RELAY and not submission:
+        return OUTCOME_REJECTED
+    return OUTCOME_ACCEPTED
+
+
+class Phase:
+    """A phase of a scenario.
+
+    Parameters
+    ----------
+    name : str
+        The name of the phase, used in the reports.
+    shape : str
+        The shape of the load, one of ``SHAPES``.
+    duration : float
+        The duration of the phase in seconds.
+    rate : float
+        The target rate in mails per second. Ramps increase linearly from
+        ``start_rate`` to ``rate``, bursts fall back to ``rate`` between the
+        bursts.
+    concurrency : int, optional
+        The number of concurrent connections (default: 1).
+    start_rate : float, optional
+        The rate at the start of a ramp (default: 1).
+    burst_rate : float, optional
+        The rate during a burst (default: ``10 * rate``).
+    burst_length : float, optional
+        The duration of a burst in seconds (default: 10).
+    burst_interval : float, optional
+        The time between the starts of two bursts in seconds (default: 60).
+    submission_share : float, optional
+        The share of mails sent by submission, ``0 <= share <= 1``
+        (default: 0).
+    recipients : dict, optional
+        The recipient classes (see ``RECIPIENT_CLASSES``) with their relative
+        weights (default: mailboxes only).
+    message_sizes : str, optional
+        The specification of the message sizes, see
+        ``SizeDistribution.parse()`` (default: 1k).
+    message_kinds : list, optional
+        The kinds of messages, see ``MESSAGE_KINDS`` (default: text).
+    report_interval : float, optional
+        Report the progress in this interval in seconds (default: ``None``,
+        soak phases use ``SOAK_REPORT_INTERVAL``).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        shape: str,
+        duration: float,
+        rate: float,
+        concurrency: int = 1,
+        start_rate: float = 1.0,
+        burst_rate: Optional[float] = None,
+        burst_length: float = 10.0,
+        burst_interval: float = 60.0,
+        submission_share: float = 0.0,
+        recipients: Optional[dict[str, float]] = None,
+        message_sizes: str = "1k",
+        message_kinds: Optional[list[str]] = None,
+        report_interval: Optional[float] = None,
+    ) -> None:
+        if shape not in SHAPES:
+            raise MailsrvParserException(
+                "Phase '{}': unknown shape '{}'".format(name, shape)
+            )
+        if duration <= 0 or rate <= 0 or start_rate <= 0:
+            raise MailsrvParserException(
+                "Phase '{}': duration and rates have to be positive".format(name)
+            )
+        if concurrency < 1:
+            raise MailsrvParserException("Phase '{}': invalid concurrency".format(name))
+        if not 0 <= submission_share <= 1:
+            raise MailsrvParserException(
+                "Phase '{}': invalid submission share".format(name)
+            )
+        if burst_length <= 0 or burst_interval < burst_length:
+            raise MailsrvParserException(
+                "Phase '{}': invalid burst timing".format(name)
+            )
+
+        if recipients is None:
+            recipients = {RCPT_MAILBOX: 1.0}
+        for recipient_class, weight in recipients.items():
+            if recipient_class not in RECIPIENT_CLASSES or weight < 0:
+                raise MailsrvParserException(
+                    "Phase '{}': invalid recipient class '{}'".format(
+                        name, recipient_class
+                    )
+                )
+        if not sum(recipients.values()) > 0:
+            raise MailsrvParserException("Phase '{}': empty recipient mix".format(name))
+
+        if message_kinds is None:
+            message_kinds = ["text"]
+        for kind in message_kinds:
+            if kind not in MESSAGE_KINDS:
+                raise MailsrvParserException(
+                    "Phase '{}': unknown message kind '{}'".format(name, kind)
+                )
+
+        self.name = name
+        self.shape = shape
+        self.duration = duration
+        self.rate = rate
+        self.concurrency = concurrency
+        self.start_rate = start_rate
+        self.burst_rate = 10 * rate if burst_rate is None else burst_rate
+        self.burst_length = burst_length
+        self.burst_interval = burst_interval
+        self.submission_share = submission_share
+        self.recipients = recipients
+        self.message_sizes = message_sizes
+        self.message_kinds = message_kinds
+
+        if report_interval is None and shape == SHAPE_SOAK:
+            report_interval = SOAK_REPORT_INTERVAL
+        self.report_interval = report_interval
+
+    @classmethod
+    def from_dict(cls, values: dict[str, Any], number: int) -> "Phase":
+        """Create a phase from a ``[[phase]]`` table of a scenario file."""
+        values = dict(values)
+        name = str(values.pop("name", "phase-{}".format(number)))
+        try:
+            for key in (
+                "duration",
+                "burst_length",
+                "burst_interval",
+                "report_interval",
+            ):
+                if key in values:
+                    values[key] = parse_duration(values[key])
+            if isinstance(values.get("message_kinds", None), str):
+                values["message_kinds"] = values["message_kinds"].split(",")
+            return cls(name, **values)
+        except TypeError as e:
+            # unknown or missing keys
+            raise MailsrvParserException("Phase '{}': {}".format(name, e))
+
+    def rate_at(self, offset: float) -> float:
+        """Return the target rate at ``offset`` seconds into the phase."""
+        if self.shape == SHAPE_RAMP:
+            return self.start_rate + (self.rate - self.start_rate) * (
+                offset / self.duration
+            )
+        if self.shape == SHAPE_BURST:
+            if offset % self.burst_interval < self.burst_length:
+                return self.burst_rate
+        return self.rate
+
+    def schedule(self) -> Iterator[float]:
+        """Generate the offsets (in seconds) of the mails of the phase."""
+        offset = 0.0
+        while offset < self.duration:
+            yield offset
+            offset += 1 / self.rate_at(offset)
+
+    def __str__(self) -> str:  # noqa: D105
+        return "{} ({}, {:.0f}s, {:g}/s, {} connection(s))".format(
+            self.name, self.shape, self.duration, self.rate, self.concurrency
+        )
+
+
+class Scenario:
+    """A sequence of phases.
+
+    Parameters
+    ----------
+    name : str
+        The name of the scenario.
+    phases : list
+        The ``Phase`` objects, run in the given order.
+    seed : int, optional
+        The seed for the choice of recipients and messages (default: 0).
+    from_address : str, optional
+        The address to be used as value to ``MAIL FROM:`` by MTA workers
+        (default: sender@another-host.test).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        phases: list[Phase],
+        seed: int = 0,
+        from_address: str = "sender@another-host.test",
+    ) -> None:
+        if not phases:
+            raise MailsrvParserException("Scenario '{}' has no phases".format(name))
+
+        self.name = name
+        self.phases = phases
+        self.seed = seed
+        self.from_address = from_address
+
+    @classmethod
+    def from_file(cls, file_path: str) -> "Scenario":
+        """Read a scenario file.
+
+        Raises
+        ------
+        MailsrvIOException
+            If the file could not be read.
+        MailsrvParserException
+            If the file describes an invalid scenario.
+        """
+        # ``tomllib`` is available from Python 3.11 on; before, the
+        # (API-compatible) ``tomli`` has to be installed.
+        if sys.version_info >= (3, 11):
+            # Python imports
+            import tomllib
+        else:
+            try:
+                # external imports
+                import tomli as tomllib
+            except ImportError:
+                logger.error("Reading scenario files requires 'tomli' (Python < 3.11)")
+                raise MailsrvParserException("Missing dependency: 'tomli'")
+
+        try:
+            with open(file_path, "rb") as scenario_file:
+                values = tomllib.load(scenario_file)
+        except OSError as e:
+            logger.error("Could not read scenario file '%s'", file_path)
+            logger.debug(e, exc_info=True)  # noqa: G200
+            raise MailsrvIOException("Error while accessing '{}'".format(file_path))
+        except tomllib.TOMLDecodeError as e:
+            logger.error("Invalid scenario file '%s': %s", file_path, e)  # noqa: G200
+            raise MailsrvParserException("Invalid scenario file")
+
+        settings = values.get("scenario", {})
+        return cls(
+            settings.get("name", file_path),
+            [
+                Phase.from_dict(phase, number)
+                for number, phase in enumerate(values.get("phase", []), start=1)
+            ],
+            seed=settings.get("seed", 0),
+            from_address=settings.get("from_address", "sender@another-host.test"),
+        )
+
+    @property
+    def duration(self) -> float:
+        """Return the scheduled duration of all phases in seconds."""
+        return sum(phase.duration for phase in self.phases)
+
+
+class ScenarioJob:
+    """A single mail, scheduled by the dispatcher.
+
+    Parameters
+    ----------
+    recipient : str
+        The recipient of the mail.
+    recipient_class : str
+        The class of the recipient, one of ``RECIPIENT_CLASSES``.
+    due : float
+        The scheduled start of the transaction (as returned by
+        ``time.perf_counter()``).
+    """
+
+    __slots__ = ("recipient", "recipient_class", "due")
+
+    def __init__(self, recipient: str, recipient_class: str, due: float) -> None:
+        self.recipient = recipient
+        self.recipient_class = recipient_class
+        self.due = due
+
+
+class PhaseStats:
+    """Collect the results of a phase.
+
+    The statistics are shared between the workers, all modifications are
+    guarded by a lock.
+
+    Parameters
+    ----------
+    phase : Phase
+        The phase.
+    """
+
+    def __init__(self, phase: Phase) -> None:
+        self.phase = phase
+
+        # The outcomes by (recipient class, outcome)
+        self.outcomes: collections.Counter[tuple[str, str]] = collections.Counter()
+        self.unexpected = 0
+        self.bytes = 0
+        self.scheduled = 0
+
+        self.latency = LatencyRecorder(
+            "{} transaction".format(phase.name), max_samples=MAX_LATENCY_SAMPLES
+        )
+        self.lag = LatencyRecorder(
+            "{} lag".format(phase.name), max_samples=MAX_LATENCY_SAMPLES
+        )
+        # The transactions since the last progress report
+        self.interval = LatencyRecorder(max_samples=MAX_LATENCY_SAMPLES)
+
+        self.started = time.perf_counter()
+        self.finished: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def record(
+        self,
+        job: ScenarioJob,
+        outcome: str,
+        submission: bool,
+        started: float,
+        size: int,
+    ) -> None:
+        """Record the outcome of a single mail."""
+        duration = time.perf_counter() - started
+        self.latency.add(duration)
+        self.lag.add(max(started - job.due, 0.0))
+
+        with self._lock:
+            self.interval.add(duration)
+            self.outcomes[(job.recipient_class, outcome)] += 1
+            self.bytes += size
+            if outcome != expected_outcome(job.recipient_class, submission):
+                self.unexpected += 1
+                logger.verbose(  # type: ignore [attr-defined]
+                    "Unexpected outcome for %s recipient %s: %s",
+                    job.recipient_class,
+                    job.recipient,
+                    outcome,
+                )
+
+    @property
+    def count(self) -> int:
+        """Return the number of finished mails."""
+        return self.latency.count
+
+    @property
+    def elapsed(self) -> float:
+        """Return the duration of the phase (so far) in seconds."""
+        end = time.perf_counter() if self.finished is None else self.finished
+        return end - self.started
+
+    def report_progress(self) -> None:
+        """Log the progress since the last report and start a new interval."""
+        with self._lock:
+            interval, self.interval = self.interval, LatencyRecorder(
+                max_samples=MAX_LATENCY_SAMPLES
+            )
+
+        logger.summary(  # type: ignore [attr-defined]
+            "[%s] %.0fs: %d mail(s), %d unexpected so far; last interval: %d mail(s), p95=%s",
+            self.phase.name,
+            self.elapsed,
+            self.count,
+            self.unexpected,
+            interval.count,
+            "-"
+            if interval.count == 0
+            else "{:.1f}ms".format(interval.percentile(95) * 1000),  # type: ignore [operator]
+        )
+
+    def log_report(self) -> None:
+        """Log the results of the phase."""
+        elapsed = self.elapsed
+        logger.summary(  # type: ignore [attr-defined]
+            "Phase %s: %d of %d mail(s) in %.1fs, %.1f mails/s, %.2f MiB/s, %d unexpected",
+            self.phase,
+            self.count,
+            self.scheduled,
+            elapsed,
+            self.count / elapsed,
+            self.bytes / elapsed / (1024 * 1024),
+            self.unexpected,
+        )
+        for recipient_class in RECIPIENT_CLASSES:
+            outcomes = {
+                outcome: count
+                for (rcpt_class, outcome), count in sorted(self.outcomes.items())
+                if rcpt_class == recipient_class
+            }
+            if outcomes:
+                logger.summary(  # type: ignore [attr-defined]
+                    "  %s: %s",
+                    recipient_class,
+                    ", ".join(
+                        "{} {}".format(count, outcome)
+                        for outcome, count in outcomes.items()
+                    ),
+                )
+        logger.summary("  %s", self.latency)  # type: ignore [attr-defined]
+        logger.summary("  %s", self.lag)  # type: ignore [attr-defined]
+
+
+class ScenarioWorker(SmtpGenericTestSuite):
+    """Send the mails of a phase, as scheduled by the dispatcher.
+
+    The worker takes ``ScenarioJob`` objects from ``jobs`` until it receives
+    ``None``. Rejections and temporary failures are recorded, but do not stop
+    the worker; after connection errors, it reconnects.
+
+    Parameters
+    ----------
+    jobs : queue.Queue
+        The queue of scheduled mails.
+    stats : PhaseStats
+        The statistics of the phase.
+    message_factory : MessageFactory
+        Generate the mails with this factory.
+    from_address : str, optional
+        The address to be used as value to ``MAIL FROM:`` (default:
+        sender@another-host.test).
+    starttls : bool, optional
+        Use ``STARTTLS`` before sending (default: ``False``).
+    suite_name : str, optional
+        The suites verbose name (default: Scenario Worker).
+
+    Notes
+    -----
+    For a full list of parameters refer to ``SmtpGenericTestSuite``.
+    """
+
+    submission = False
+    latency_samples = MAX_LATENCY_SAMPLES
+    raise_on_transient = True
+
+    def __init__(
+        self,
+        *args: Any,
+        jobs: "Optional[queue.Queue[Optional[ScenarioJob]]]" = None,
+        stats: Optional[PhaseStats] = None,
+        message_factory: Optional[MessageFactory] = None,
+        from_address: str = "sender@another-host.test",
+        starttls: bool = False,
+        suite_name: str = "Scenario Worker",
+        **kwargs: Optional[Any],
+    ) -> None:
+        super().__init__(  # type: ignore
+            *args,
+            suite_name=suite_name,
+            **kwargs,  # type: ignore
+        )
+
+        if jobs is None or stats is None or message_factory is None:
+            raise self.SmtpOperationalError(
+                "Missing parameter: 'jobs', 'stats' or 'message_factory'"
+            )
+        self._jobs = jobs
+        self._stats = stats
+        self._message_factory = message_factory
+        self._from_address = from_address
+        self._starttls_enabled = starttls
+
+    def _pre_run(self) -> None:
+        if self._starttls_enabled:
+            self._starttls()
+
+    def _send(self, job: ScenarioJob) -> None:
+        started = time.perf_counter()
+        bytes_sent = self.bytes_sent
+        try:
+            if self.smtp.sock is None:
+                self._reconnect()
+            if self._sendmail(self._from_address, job.recipient, self._message_factory):
+                outcome = OUTCOME_ACCEPTED
+            else:
+                outcome = OUTCOME_REJECTED
+        except self.SmtpTransientError as e:
+            # The scenario does not retry, so the mail is given up right away
+            self._protocol.mail_rejected(e.subject)
+            outcome = OUTCOME_DEFERRED
+        except (smtplib.SMTPException, OSError, self.SmtpOperationalError) as e:
+            logger.verbose("%s: %s", self.suite_name, e)  # type: ignore [attr-defined]
+            outcome = OUTCOME_ERROR
+            # reconnect with the next job
+            self.smtp.close()
+
+        self._stats.record(
+            job, outcome, self.submission, started, self.bytes_sent - bytes_sent
+        )
+
+    def _run_tests(self) -> None:
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            self._send(job)
+
+        # ``run()`` expects an established connection to send ``QUIT``
+        if self.smtp.sock is None:
+            self._reconnect()
+
+
+class SubmissionScenarioWorker(ScenarioWorker, SubmissionTestSuite):
+    """Submit the mails of a phase as an authenticated user.
+
+    The worker uses the submission port, ``STARTTLS`` and authenticates (see
+    ``SubmissionTestSuite``); ``from_address`` has to be a valid sender of
+    the given user.
+
+    For a full list of parameters refer to ``ScenarioWorker`` and
+    ``SubmissionTestSuite``.
+    """
+
+    submission = True
+
+    def __init__(
+        self,
+        *args: Any,
+        suite_name: str = "Scenario Worker (Submission)",
+        **kwargs: Optional[Any],
+    ) -> None:
+        super().__init__(*args, suite_name=suite_name, **kwargs)  # type: ignore [arg-type]
+
+    def _pre_run(self) -> None:
+        SubmissionTestSuite._pre_run(self)
+
+
+class ScenarioRunner:
+    """Run the phases of a scenario.
+
+    Parameters
+    ----------
+    scenario : Scenario
+        The scenario.
+    recipients : dict
+        The addresses by recipient class; classes without addresses can not
+        be used in the phases.
+    submission_accounts : list, optional
+        The accounts for submission, as tuples of username, password and a
+        valid sender address (default: no submission).
+    target_ip : str, optional
+        The IP to connect to (default: 127.0.0.1).
+    smtp_port : int, optional
+        The port of the SMTP service (default: 25).
+    submission_port : int, optional
+        The port of the submission service (default: 587).
+    starttls : bool, optional
+        Use ``STARTTLS`` on the SMTP port (default: ``False``).
+    tls_context : ssl.SSLContext, optional
+        The context to be used for ``STARTTLS``.
+    event_log : EventLog
+        The events of all workers are written to this log, keeping the
+        memory of long phases flat.
+    timeout : float, optional
+        The timeout of every blocking operation of the workers in seconds
+        (default: 30).
+    slos : list, optional
+        The ``LatencySlo`` instances to check the SMTP command latencies of
+        all workers against (default: no SLOs).
+
+    Notes
+    -----
+    After the run, ``command_latency`` contains the latencies of the SMTP
+    commands of all phases, see ``TimedSMTP``.
+    """
+
+    class ScenarioError(MailsrvTestException):
+        """Indicate an invalid combination of scenario and SUT or an aborted run."""
+
+    def __init__(
+        self,
+        scenario: Scenario,
+        recipients: dict[str, list[str]],
+        event_log: EventLog,
+        submission_accounts: Optional[list[tuple[str, str, str]]] = None,
+        target_ip: str = "127.0.0.1",
+        smtp_port: int = smtplib.SMTP_PORT,
+        submission_port: int = 587,
+        starttls: bool = False,
+        tls_context: Optional[Any] = None,
+        timeout: float = 30.0,
+        slos: Optional[list[LatencySlo]] = None,
+    ) -> None:
+        self.scenario = scenario
+        self.recipients = recipients
+        self.event_log = event_log
+        self.submission_accounts = submission_accounts or []
+        self.target_ip = target_ip
+        self.smtp_port = smtp_port
+        self.submission_port = submission_port
+        self.starttls = starttls
+        self.tls_context = tls_context
+        self.timeout = timeout
+        self.slos = slos or []
+        self.command_latency: dict[str, LatencyRecorder] = {}
+
+        for phase in scenario.phases:
+            for recipient_class, weight in phase.recipients.items():
+                if weight > 0 and not recipients.get(recipient_class, None):
+                    raise self.ScenarioError(
+                        "Phase '{}': no addresses of class '{}'".format(
+                            phase.name, recipient_class
+                        )
+                    )
+            if phase.submission_share > 0 and not self.submission_accounts:
+                raise self.ScenarioError(
+                    "Phase '{}': no accounts for submission".format(phase.name)
+                )
+
+        self._random = random.Random(scenario.seed)
+        self._tagger = RunTagger()
+        self.stats: list[PhaseStats] = []
+
+    def _workers(
+        self,
+        phase: Phase,
+        stats: PhaseStats,
+        mta_jobs: "queue.Queue[Optional[ScenarioJob]]",
+        submission_jobs: "queue.Queue[Optional[ScenarioJob]]",
+    ) -> list[ScenarioWorker]:
+        # Split the connections according to the submission share
+        submission_count = 0
+        if phase.submission_share > 0:
+            submission_count = max(1, round(phase.concurrency * phase.submission_share))
+        mta_count = phase.concurrency - submission_count
+        if phase.submission_share < 1:
+            mta_count = max(mta_count, 1)
+
+        message_factory = MessageFactory(
+            sizes=SizeDistribution.parse(phase.message_sizes, seed=self.scenario.seed),
+            kinds=phase.message_kinds,
+            seed=self.scenario.seed,
+        )
+        common: dict[str, Any] = {
+            "target_ip": self.target_ip,
+            "stats": stats,
+            "message_factory": message_factory,
+            "event_log": self.event_log,
+            "tls_context": self.tls_context,
+            "timeout": self.timeout,
+        }
+
+        workers: list[ScenarioWorker] = [
+            ScenarioWorker(
+                target_port=self.smtp_port,
+                jobs=mta_jobs,
+                from_address=self.scenario.from_address,
+                starttls=self.starttls,
+                tagger=self._tagger.suite(),
+                suite_name="Scenario Worker ({}, {})".format(phase.name, number),
+                **common,
+            )
+            for number in range(1, mta_count + 1)
+        ]
+        for number in range(submission_count):
+            username, password, from_address = self.submission_accounts[
+                number % len(self.submission_accounts)
+            ]
+            workers.append(
+                SubmissionScenarioWorker(
+                    target_port=self.submission_port,
+                    jobs=submission_jobs,
+                    username=username,
+                    password=password,
+                    from_address=from_address,
+                    tagger=self._tagger.suite(),
+                    suite_name="Scenario Worker ({}, {})".format(phase.name, username),
+                    **common,
+                )
+            )
+
+        return workers
+
+    def _next_job(self, phase: Phase, due: float) -> tuple[ScenarioJob, bool]:
+        """Return the next mail and whether it is sent by submission."""
+        recipient_class = self._random.choices(
+            list(phase.recipients.keys()), list(phase.recipients.values())
+        )[0]
+        recipient = self._random.choice(self.recipients[recipient_class])
+        submission = self._random.random() < phase.submission_share
+        return ScenarioJob(recipient, recipient_class, due), submission
+
+    def _put(
+        self,
+        jobs: "queue.Queue[Optional[ScenarioJob]]",
+        job: Optional[ScenarioJob],
+        futures: list[Future],
+    ) -> None:
+        """Queue a job, unless all workers died."""
+        while True:
+            try:
+                jobs.put(job, timeout=1.0)
+                return
+            except queue.Full:
+                if all(future.done() for future in futures):
+                    raise self.ScenarioError("All workers terminated")
+
+    def _run_phase(self, phase: Phase) -> SmtpTestProtocol:
+        logger.summary("Running phase %s", phase)  # type: ignore [attr-defined]
+
+        stats = PhaseStats(phase)
+        self.stats.append(stats)
+
+        # The queues are bounded, so a slow server does not let the backlog
+        # (and the memory) grow.
+        mta_jobs: "queue.Queue[Optional[ScenarioJob]]" = queue.Queue(
+            maxsize=phase.concurrency * 4
+        )
+        submission_jobs: "queue.Queue[Optional[ScenarioJob]]" = queue.Queue(
+            maxsize=phase.concurrency * 4
+        )
+        workers = self._workers(phase, stats, mta_jobs, submission_jobs)
+        has_submission = any(worker.submission for worker in workers)
+        has_mta = any(not worker.submission for worker in workers)
+
+        with ThreadPoolExecutor(max_workers=len(workers)) as executor:
+            futures = [executor.submit(worker.run) for worker in workers]
+            mta_futures = [
+                future
+                for worker, future in zip(workers, futures)
+                if not worker.submission
+            ]
+            submission_futures = [
+                future for worker, future in zip(workers, futures) if worker.submission
+            ]
+
+            try:
+                start = time.perf_counter()
+                next_report = phase.report_interval
+                for offset in phase.schedule():
+                    due = start + offset
+                    delay = due - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+
+                    if next_report is not None and offset >= next_report:
+                        stats.report_progress()
+                        next_report += phase.report_interval  # type: ignore [operator]
+
+                    job, submission = self._next_job(phase, due)
+                    if (submission and has_submission) or not has_mta:
+                        self._put(submission_jobs, job, submission_futures)
+                    else:
+                        self._put(mta_jobs, job, mta_futures)
+                    stats.scheduled += 1
+            finally:
+                for worker in workers:
+                    if worker.submission:
+                        self._put(submission_jobs, None, submission_futures)
+                    else:
+                        self._put(mta_jobs, None, mta_futures)
+
+            protocols = [future.result() for future in futures]
+
+        stats.finished = time.perf_counter()
+        stats.log_report()
+
+        for worker in workers:
+            for operation, recorder in worker.command_latency.items():
+                self.command_latency.setdefault(
+                    operation,
+                    LatencyRecorder(recorder.name, max_samples=MAX_LATENCY_SAMPLES),
+                ).merge(recorder)
+        return SmtpTestProtocol.merge(*protocols)
+
+    def run(self) -> SmtpTestProtocol:
+        """Run all phases and return the merged protocol."""
+        logger.summary(  # type: ignore [attr-defined]
+            "Running scenario '%s': %d phase(s), %.0fs (run ID: %s)",
+            self.scenario.name,
+            len(self.scenario.phases),
+            self.scenario.duration,
+            self._tagger.run_id,
+        )
+
+        protocols = [self._run_phase(phase) for phase in self.scenario.phases]
+
+        unexpected = sum(stats.unexpected for stats in self.stats)
+        logger.summary(  # type: ignore [attr-defined]
+            "Scenario '%s' finished: %d mail(s), %d unexpected outcome(s)",
+            self.scenario.name,
+            sum(stats.count for stats in self.stats),
+            unexpected,
+        )
+
+        for operation in sorted(self.command_latency):
+            logger.summary("%s", self.command_latency[operation])  # type: ignore [attr-defined]
+
+        violations = check_slos(self.slos, self.command_latency)
+        for violation in violations:
+            logger.error("SLO violated: %s", violation)
+        if violations:
+            raise SmtpGenericTestSuite.SmtpSloViolation(
+                "{} SLO violation(s) in scenario '{}'".format(
+                    len(violations), self.scenario.name
+                )
+            )
+
+        return SmtpTestProtocol.merge(*protocols)
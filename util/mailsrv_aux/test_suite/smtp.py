@@ -10,14 +10,21 @@ These tests are meant to verify the SMTP-part of the mail setup.
 # Python imports
 import logging
 import smtplib
+import socket
+import ssl
 import time
-from typing import Any, Optional, Union
+from typing import Any, Optional, Sequence, Union
 
 # local imports
 from ..common.log import add_level
+from .eventlog import EventLog
 from .exceptions import MailsrvTestException
 from .fixture_mail import GENERIC_VALID_MAIL
+from .messages import MessageFactory
+from .metrics import LatencyRecorder, LatencySlo, check_slos
 from .protocols import SmtpTestProtocol
+from .tagging import RunTagger, SuiteTagger
+from .tls import TlsSessionContext
 
 # get a module-level logger
 logger = logging.getLogger(__name__)
@@ -27,6 +34,174 @@ add_level("VERBOSE", logging.INFO - 1)
 add_level("SUMMARY", logging.INFO + 1)
 
 
+# The commands, that are measured by their verb; everything else is a
+# continuation line of ``AUTH``.
+SMTP_VERBS = frozenset(
+    (
+        "EHLO",
+        "HELO",
+        "LHLO",
+        "STARTTLS",
+        "AUTH",
+        "MAIL",
+        "RCPT",
+        "DATA",
+        "BDAT",
+        "RSET",
+        "NOOP",
+        "VRFY",
+        "EXPN",
+        "HELP",
+        "QUIT",
+    )
+)
+
+
+def is_transient(code: int) -> bool:
+    """Return ``True`` if the SMTP reply code indicates a temporary failure."""
+    return 400 <= code < 500
+
+
+def _rset(smtp: smtplib.SMTP) -> None:
+    """Reset the transaction, ignoring a closed connection (like ``smtplib``)."""
+    try:
+        smtp.rset()
+    except smtplib.SMTPServerDisconnected:
+        pass
+
+
+def sendmail_parts(
+    smtp: smtplib.SMTP,
+    from_addr: str,
+    to_addrs: list[str],
+    parts: Sequence[bytes],
+    mail_options: Sequence[str] = (),
+    rcpt_options: Sequence[str] = (),
+) -> dict[str, tuple[int, bytes]]:
+    """Send a mail, that is provided in several parts, like ``sendmail()``.
+
+    The parts are written to the socket one after the other, so the
+    (potentially big and shared) body is not copied into a single message.
+    Other than ``smtplib.SMTP.sendmail()``, the parts are expected to be
+    dot-stuffed already and the last part has to end with ``CRLF``.
+
+    The return value and the exceptions are the same as with
+    ``smtplib.SMTP.sendmail()``.
+    """
+    smtp.ehlo_or_helo_if_needed()
+
+    esmtp_opts = []
+    if smtp.does_esmtp:
+        if smtp.has_extn("size"):
+            esmtp_opts.append("size={}".format(sum(len(part) for part in parts)))
+        esmtp_opts.extend(mail_options)
+
+    code, resp = smtp.mail(from_addr, esmtp_opts)
+    if code != 250:
+        if code == 421:
+            smtp.close()
+        else:
+            _rset(smtp)
+        raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+
+    senderrs = {}
+    for addr in to_addrs:
+        code, resp = smtp.rcpt(addr, rcpt_options)
+        if code not in (250, 251):
+            senderrs[addr] = (code, resp)
+        if code == 421:
+            smtp.close()
+            raise smtplib.SMTPRecipientsRefused(senderrs)
+    if len(senderrs) == len(to_addrs):
+        _rset(smtp)
+        raise smtplib.SMTPRecipientsRefused(senderrs)
+
+    smtp.putcmd("data")
+    code, resp = smtp.getreply()
+    if code == 354:
+        for part in parts:
+            smtp.send(part)
+        smtp.send(b".\r\n")
+        code, resp = smtp.getreply()
+    if code != 250:
+        if code == 421:
+            smtp.close()
+        else:
+            _rset(smtp)
+        raise smtplib.SMTPDataError(code, resp)
+
+    return senderrs
+
+
+class TimedSMTP(smtplib.SMTP):
+    """Measure the time between every command and its reply.
+
+    The latencies are recorded by operation: the verb of the command,
+    ``CONNECT`` for the greeting and ``MESSAGE`` for the reply to the end of
+    the mail's data (the actual queueing of the mail).
+
+    Parameters
+    ----------
+    recorders : dict
+        The ``LatencyRecorder`` instances by operation; missing recorders
+        are added. May be shared between several connections.
+    max_samples : int, optional
+        Passed to the added recorders (default: ``None``, keep all samples).
+
+    Notes
+    -----
+    For all other parameters refer to ``smtplib.SMTP``.
+    """
+
+    # Prefix of the names of the added recorders
+    protocol_name = "SMTP"
+
+    def __init__(
+        self,
+        *args: Any,
+        recorders: dict[str, LatencyRecorder],
+        max_samples: Optional[int] = None,
+        **kwargs: Any,
+    ) -> None:
+        self.recorders = recorders
+        self.max_samples = max_samples
+        self._pending: Optional[tuple[str, float]] = None
+        super().__init__(*args, **kwargs)
+
+    def connect(self, *args: Any, **kwargs: Any) -> tuple[int, bytes]:  # noqa: D102
+        self._pending = ("CONNECT", time.perf_counter())
+        return super().connect(*args, **kwargs)
+
+    def putcmd(self, cmd: str, args: str = "") -> None:  # noqa: D102
+        verb = cmd.upper()
+        self._pending = (
+            verb if verb in SMTP_VERBS else "AUTH",
+            time.perf_counter(),
+        )
+        super().putcmd(cmd, args)
+
+    def send(self, s: Any) -> None:  # noqa: D102
+        # Data without a command is the mail's content (or a BDAT chunk)
+        if self._pending is None:
+            self._pending = ("MESSAGE", time.perf_counter())
+        super().send(s)
+
+    def getreply(self) -> tuple[int, bytes]:  # noqa: D102
+        reply = super().getreply()
+        if self._pending is not None:
+            operation, start = self._pending
+            self._pending = None
+            recorder = self.recorders.setdefault(
+                operation,
+                LatencyRecorder(
+                    "{} {}".format(self.protocol_name, operation),
+                    max_samples=self.max_samples,
+                ),
+            )
+            recorder.add(time.perf_counter() - start)
+        return reply
+
+
 class SmtpGenericTestSuite:
     """Provide the SMTP protocol abstraction for actual test suites.
 
@@ -41,10 +216,39 @@ class SmtpGenericTestSuite:
         (default: Generic SMTP Suite).
     local_hostname : str, optional
         The hostname to use in SMTP HELO/EHLO (default: mail.another-host.test).
-    mail_count_offset : int, optional
-        Start counting the mails with this offset (default: 0).
+    tagger : SuiteTagger, optional
+        Provides the tags of the mails, which are used as subject and in the
+        ``TRACKING_HEADER``. Provide a tagger of a shared ``RunTagger`` to
+        make all mails of a run distinguishable (default: a tagger of a new
+        run).
+    event_log : EventLog, optional
+        Write the events of the suite's protocol to this log instead of
+        keeping them in memory (default: ``None``).
+    tls_context : ssl.SSLContext, optional
+        The context to be used for ``STARTTLS``. Provide a shared
+        ``TlsSessionContext`` to resume TLS sessions across suites (default:
+        ``None``, meaning ``smtplib``'s default context).
+    timeout : float, optional
+        The timeout of every blocking operation in seconds (default: 30).
+    slos : list, optional
+        The ``LatencySlo`` instances to check the command latencies against,
+        e.g. ``p99 RCPT < 200ms``. A violation fails the suite (default: no
+        SLOs).
+
+    Notes
+    -----
+    After the run, ``command_latency`` contains the latencies of the SMTP
+    commands by verb, see ``TimedSMTP``.
     """
 
+    # How the suite hands mails to the server; recorded in the protocol
+    origin = "mta"
+    # Limit the memory of the command latencies, see ``LatencyRecorder``
+    latency_samples: Optional[int] = None
+    # Raise ``SmtpTransientError`` on temporary failures, so the mail may be
+    # retried; otherwise the failure is only recorded in the protocol.
+    raise_on_transient = False
+
     class SmtpGenericException(MailsrvTestException):
         """Base class for all exceptions of SMTP test suites."""
 
@@ -54,23 +258,59 @@ class SmtpGenericTestSuite:
     class SmtpTestSuiteError(SmtpGenericException):
         """Indicate an actual test failure."""
 
+    class SmtpSloViolation(SmtpTestSuiteError):
+        """Indicate that the measured latencies violate the suite's SLOs."""
+
+    class SmtpTransientError(SmtpGenericException):
+        """Indicate a temporary failure (``4xx``); the mail may be retried.
+
+        Parameters
+        ----------
+        msg : str
+            The actual message.
+        subject : str
+            The subject of the affected mail.
+        recipients : list
+            A ``list`` of ``str``, the recipients that were not accepted.
+        """
+
+        def __init__(self, msg: str, subject: str, recipients: list[str]) -> None:
+            super().__init__(msg, subject, recipients)
+            self.subject = subject
+            self.recipients = recipients
+
     def __init__(
         self,
         target_ip: str = "127.0.0.1",
         target_port: int = smtplib.SMTP_PORT,
         suite_name: str = "Generic SMTP Suite",
         local_hostname: str = "mail.another-host.test",
-        mail_count_offset: int = 0,
+        tagger: Optional[SuiteTagger] = None,
+        event_log: Optional[EventLog] = None,
+        tls_context: Optional[ssl.SSLContext] = None,
+        timeout: float = 30.0,
+        slos: Optional[list[LatencySlo]] = None,
     ) -> None:
         self.target_ip = target_ip
         self.target_port = target_port
         self.suite_name = suite_name
         self.local_hostname = local_hostname
-        # ``__init__()``'s parameter is called ``_offset``, but this attribute
-        # will only be incremented at the end of ``_sendmail()``, so in order
-        # to let the numbering start with *1*, this has to be added here.
-        self._mail_counter = mail_count_offset + 1
-        self._protocol: SmtpTestProtocol = SmtpTestProtocol()
+        self.tls_context = tls_context
+        self.timeout = timeout
+        self.slos = slos or []
+        self.command_latency: dict[str, LatencyRecorder] = {}
+        if tagger is None:
+            self.tagger = RunTagger().suite()
+        else:
+            self.tagger = tagger
+        self._protocol: SmtpTestProtocol = SmtpTestProtocol(event_log=event_log)
+        # The size of all queued mails
+        self.bytes_sent = 0
+
+    @property
+    def protocol(self) -> SmtpTestProtocol:
+        """Return the protocol of the suite's mails."""
+        return self._protocol
 
     def _pre_connect(self) -> None:
         pass
@@ -84,19 +324,57 @@ class SmtpGenericTestSuite:
     def _run_tests(self) -> None:
         raise NotImplementedError("Has to be implemented in real test suite")
 
-    def _generate_subject(self) -> str:
-        return "{} {}".format(self._mail_counter, hash(time.time()))
+    def _open_connection(self) -> smtplib.SMTP:
+        """Open a connection to the target.
+
+        ``run()`` uses this method to establish the suite's connection, but
+        suites may use it to open additional connections.
+        """
+        return TimedSMTP(
+            host=self.target_ip,
+            port=self.target_port,
+            local_hostname=self.local_hostname,
+            timeout=self.timeout,
+            recorders=self.command_latency,
+            max_samples=self.latency_samples,
+        )
+
+    def _starttls(self, smtp: Optional[smtplib.SMTP] = None) -> None:
+        """Establish TLS on the suite's connection or on ``smtp``."""
+        if smtp is None:
+            smtp = self.smtp
+
+        logger.verbose("Sending command STARTTLS...")  # type: ignore [attr-defined]
+
+        try:
+            smtp.starttls(context=self.tls_context)
+        except (
+            smtplib.SMTPNotSupportedError,
+            RuntimeError,
+            ValueError,
+            smtplib.SMTPResponseException,
+        ):
+            logger.critical("Could not establish TLS connection using STARTTLS")
+            raise self.SmtpOperationalError("TLS failure")
+        logger.verbose("TLS encryption established")  # type: ignore [attr-defined]
+
+        # With TLS 1.3 the session ticket arrives after the handshake, so the
+        # session is picked up again after the (required) EHLO.
+        smtp.ehlo()
+        if isinstance(self.tls_context, TlsSessionContext):
+            self.tls_context.remember_session(smtp.sock)
 
-    def _increment_mail_counter(self) -> None:
-        self._mail_counter += 1
+    def _generate_subject(self) -> str:
+        return self.tagger.next_tag()
 
     def _sendmail(
         self,
         from_addr: str,
         to_addrs: Union[str, list[str]],
-        msg_template: str,
+        msg_template: Union[str, MessageFactory],
         mail_options: tuple = (),
         rcpt_options: tuple = (),
+        subject: Optional[str] = None,
     ) -> bool:
         # Prepare the actual mail for sending:
         # 1) RCPT TO:
@@ -108,43 +386,123 @@ class SmtpGenericTestSuite:
             header_to = ", ".join(to_addrs)
 
         # 2) Generate the subject
-        header_subject = self._generate_subject()
+        # A given ``subject`` marks the retry of a deferred mail, which is
+        # already included in the protocol.
+        if subject is None:
+            header_subject = self._generate_subject()
+        else:
+            header_subject = subject
 
-        # 3) Actualle generate the message from the template
+        # 3) Actualle generate the message from the template (or the factory)
+        # The factory's body is shared between the mails, so it is sent
+        # separately from the per-message headers, without being copied.
         # TODO: Actually name the parameters in ``tests/test_suite/fixture_mail.py``
-        msg = msg_template.format(
-            mail_from=from_addr,
-            rcpt_to=header_to,
-            subject=header_subject,
-        )
+        msg: Union[str, tuple[bytes, bytes]]
+        if isinstance(msg_template, MessageFactory):
+            headers = msg_template.build_headers(
+                from_addr, header_to, header_subject, header_subject
+            )
+            body = msg_template.next_body()
+            msg = (headers, body.stuffed)
+            size = len(headers) + body.size
+        else:
+            msg = msg_template.format(
+                mail_from=from_addr,
+                rcpt_to=header_to,
+                subject=header_subject,
+                tracking_id=header_subject,
+            )
+            size = len(msg)
 
         logger.debug(
-            "sendmail(): %s, %r, %s, %r, %r",
+            "sendmail(): %s, %r, %d bytes, %r, %r",
             from_addr,
             to_addrs,
-            msg[:16],
+            size,
             mail_options,
             rcpt_options,
         )
 
-        self._increment_mail_counter()
-        self._protocol.mail_sent(header_subject)
+        if subject is None:
+            self._protocol.mail_sent(header_subject, self.suite_name, self.origin)
 
         try:
             # actually send the mail
-            resp = self.smtp.sendmail(
-                from_addr, to_addrs, msg, mail_options, rcpt_options
-            )
-        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused):
+            if isinstance(msg, tuple):
+                resp = sendmail_parts(
+                    self.smtp, from_addr, to_addrs, msg, mail_options, rcpt_options
+                )
+            else:
+                resp = self.smtp.sendmail(
+                    from_addr, to_addrs, msg, mail_options, rcpt_options
+                )
+        except smtplib.SMTPRecipientsRefused as e:
+            deferred = [
+                addr for addr, (code, _) in e.recipients.items() if is_transient(code)
+            ]
+            if deferred:
+                self._defer(header_subject, deferred)
+            # Only reached, if the mail is not retried
+            self._protocol.mail_rejected(header_subject)
+            return False
+        except (smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+            if is_transient(e.smtp_code):
+                self._defer(header_subject, to_addrs)
+            # Only reached, if the mail is not retried
             self._protocol.mail_rejected(header_subject)
             return False
 
+        self._protocol.mail_queued(header_subject, time.time())
+        self.bytes_sent += size
         for addr in to_addrs:
             if addr not in resp:
                 self._protocol.mail_accepted(addr, header_subject)
 
+        # The mail is queued for the other recipients, so a partial deferral
+        # is only recorded.
+        deferred = [addr for addr in resp if is_transient(resp[addr][0])]
+        if deferred:
+            logger.verbose("Mail '%s' deferred for %r", header_subject, deferred)  # type: ignore [attr-defined]
+            self._protocol.mail_deferred(header_subject)
+
         return True
 
+    def _defer(self, subject: str, recipients: list[str]) -> None:
+        """Track a temporary failure.
+
+        If the mail is retried, it is not recorded as rejected (yet); the
+        caller records the rejection, if it gives up on the mail.
+
+        Raises
+        ------
+        SmtpTransientError
+            Raised if the suite's ``raise_on_transient`` is set.
+        """
+        logger.verbose("Mail '%s' deferred for %r", subject, recipients)  # type: ignore [attr-defined]
+        self._protocol.mail_deferred(subject)
+        if self.raise_on_transient:
+            raise self.SmtpTransientError("Temporary failure", subject, recipients)
+
+    def _reconnect(self) -> None:
+        """Re-establish the suite's connection, e.g. after a ``421``.
+
+        The state of the ``EHLO`` is reset (just like ``smtplib``'s
+        ``quit()`` does), then ``_pre_run()`` is executed again.
+        """
+        self.smtp.close()
+        self.smtp.ehlo_resp = self.smtp.helo_resp = None
+        self.smtp.esmtp_features = {}
+        self.smtp.does_esmtp = False
+
+        try:
+            self.smtp.connect(self.target_ip, self.target_port)
+        except OSError:
+            logger.error("Could not reconnect to target (%s)", self.target_ip)
+            raise self.SmtpOperationalError("Reconnect failed")
+        logger.verbose("Connection to target (%s) re-established", self.target_ip)  # type: ignore [attr-defined]
+
+        self._pre_run()
+
     def _sendmail_expect_queue(
         self,
         from_addr: str,
@@ -191,6 +549,25 @@ class SmtpGenericTestSuite:
         if self._sendmail(from_addr, to_addrs, GENERIC_VALID_MAIL):
             raise self.SmtpTestSuiteError("Expected mail to be queued, got rejected")
 
+    def _check_slos(self) -> None:
+        """Check the command latencies against the suite's SLOs.
+
+        Raises
+        ------
+        SmtpSloViolation
+            Raised if at least one SLO is violated.
+        """
+        for operation in sorted(self.command_latency):
+            logger.verbose("%s", self.command_latency[operation])  # type: ignore [attr-defined]
+
+        violations = check_slos(self.slos, self.command_latency)
+        for violation in violations:
+            logger.error("SLO violated: %s", violation)
+        if violations:
+            raise self.SmtpSloViolation(
+                "{} SLO violation(s) in {}".format(len(violations), self.suite_name)
+            )
+
     def run(self) -> SmtpTestProtocol:
         """Run the test suite."""
         logger.summary("Running %s", self.suite_name)  # type: ignore [attr-defined]
@@ -198,11 +575,7 @@ class SmtpGenericTestSuite:
         self._pre_connect()
 
         try:
-            with smtplib.SMTP(
-                host=self.target_ip,
-                port=self.target_port,
-                local_hostname=self.local_hostname,
-            ) as self.smtp:
+            with self._open_connection() as self.smtp:
                 logger.info("Connection to target (%s) established", self.target_ip)
 
                 self._pre_run()
@@ -217,10 +590,17 @@ class SmtpGenericTestSuite:
         except ConnectionRefusedError:
             logger.critical("Target (%s) refused the connection", self.target_ip)
             raise self.SmtpOperationalError("Connection refused")
+        except socket.timeout:
+            logger.critical(
+                "Target (%s) did not answer within %.1fs", self.target_ip, self.timeout
+            )
+            raise self.SmtpOperationalError("Timeout")
         except OSError:
             logger.critical("Target (%s) is not reachable", self.target_ip)
             raise self.SmtpOperationalError("Target not reachable")
 
+        self._check_slos()
+
         logger.summary("%s finished successfully", self.suite_name)  # type: ignore [attr-defined]
         return self._protocol
 
@@ -325,19 +705,7 @@ class OtherMtaTlsTestSuite(OtherMtaTestSuite):
         super().__init__(*args, suite_name=suite_name, **kwargs)  # type: ignore [arg-type]
 
     def _pre_run(self) -> None:
-        logger.verbose("Sending command STARTTLS...")  # type: ignore [attr-defined]
-
-        try:
-            self.smtp.starttls()
-        except (
-            smtplib.SMTPNotSupportedError,
-            RuntimeError,
-            ValueError,
-            smtplib.SMTPResponseException,
-        ):
-            logger.critical("Could not establish TLS connection using STARTTLS")
-            raise self.SmtpOperationalError("TLS failure")
-        logger.verbose("TLS encryption established")  # type: ignore [attr-defined]
+        self._starttls()
 
 
 class SubmissionTestSuite(SmtpGenericTestSuite):
@@ -369,10 +737,14 @@ class SubmissionTestSuite(SmtpGenericTestSuite):
         (default: submission@sut-one.test).
     external_rcpt : str, optional
         An address on another MTA (default: submission@another-host.test).
+    target_port : int, optional
+        The port to use for the connection (default: 587).
     suite_name : str, optional
         The suites verbose name (default: Submission Test Suite).
     """
 
+    origin = "submission"
+
     def __init__(
         self,
         *args: Any,
@@ -382,12 +754,13 @@ class SubmissionTestSuite(SmtpGenericTestSuite):
         invalid_from: str = "no_sending@sut-one.test",
         local_rcpt: str = "submission@sut-one.test",
         external_rcpt: str = "submission@another-host.test",
+        target_port: int = 587,
         suite_name: str = "Submission Test Suite",
         **kwargs: Optional[Any],
     ) -> None:
         super().__init__(  # type: ignore
             *args,
-            target_port=587,
+            target_port=target_port,
             suite_name=suite_name,
             **kwargs,  # type: ignore
         )
@@ -404,20 +777,10 @@ class SubmissionTestSuite(SmtpGenericTestSuite):
             self.valid_from = valid_from
 
     def _pre_run(self) -> None:
-        logger.verbose("Sending command STARTTLS...")  # type: ignore [attr-defined]
-
-        try:
-            self.smtp.starttls()
-        except (
-            smtplib.SMTPNotSupportedError,
-            RuntimeError,
-            ValueError,
-            smtplib.SMTPResponseException,
-        ):
-            logger.critical("Could not establish TLS connection using STARTTLS")
-            raise self.SmtpOperationalError("TLS failure")
-        logger.verbose("TLS encryption established")  # type: ignore [attr-defined]
+        self._starttls()
+        self._login()
 
+    def _login(self) -> None:
         try:
             self.smtp.login(self.username, self.password)
         except (
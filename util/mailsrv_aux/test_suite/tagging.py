@@ -0,0 +1,103 @@
+# SPDX-FileCopyrightText: 2022 Mischback
+# SPDX-License-Identifier: MIT
+# SPDX-FileType: SOURCE
+
+"""Provide unique tags for the mails of a test run.
+
+Every mail gets a tag of the form ``<run>-<suite>-<sequence>``: the run ID
+identifies the test run, the suite number the sending suite (in the order the
+suites were created) and the sequence number the mail within its suite.
+
+The parts have a fixed width, so all tags have the same length. Thus, a tag is
+never a substring of another tag, which makes them safe to be used with IMAP's
+``SEARCH HEADER`` (matching substrings). The tag is sent as ``Subject`` and in
+the ``TRACKING_HEADER``.
+"""
+
+# Python imports
+import itertools
+import secrets
+import string
+import threading
+import time
+from typing import Optional
+
+# The header carrying the tag of a mail
+TRACKING_HEADER = "X-Mailsrv-Test-Id"
+
+# The alphabet of the run IDs
+_RUN_ID_ALPHABET = string.digits + string.ascii_lowercase
+
+
+def generate_run_id() -> str:
+    """Return a new run ID.
+
+    The run ID consists of the current time in seconds (encoded with base 36,
+    six characters until the year 2038) and four random characters, so runs
+    started within the same second are still distinguishable.
+    """
+    value = int(time.time())
+    encoded = ""
+    while value:
+        value, remainder = divmod(value, 36)
+        encoded = _RUN_ID_ALPHABET[remainder] + encoded
+
+    random_part = "".join(secrets.choice(_RUN_ID_ALPHABET) for _ in range(4))
+    return "{:0>6}{}".format(encoded, random_part)
+
+
+def tag_source(tag: str) -> str:
+    """Return the run and suite part of a tag."""
+    return tag.rsplit("-", 1)[0]
+
+
+def tag_run_id(tag: str) -> str:
+    """Return the run part of a tag."""
+    return tag.split("-", 1)[0]
+
+
+class SuiteTagger:
+    """Generate the tags for the mails of a single suite.
+
+    Parameters
+    ----------
+    run_id : str
+        The ID of the test run.
+    suite_number : int
+        The number of the suite within the run.
+    """
+
+    def __init__(self, run_id: str, suite_number: int) -> None:
+        self.run_id = run_id
+        self.suite_number = suite_number
+        self._sequence = itertools.count(1)
+
+    def next_tag(self) -> str:
+        """Return the tag for the next mail."""
+        return "{}-{:03x}-{:06x}".format(
+            self.run_id, self.suite_number, next(self._sequence)
+        )
+
+
+class RunTagger:
+    """Hand out ``SuiteTagger`` instances for the suites of a test run.
+
+    Parameters
+    ----------
+    run_id : str, optional
+        The ID of the test run (default: a new ID from ``generate_run_id()``).
+    """
+
+    def __init__(self, run_id: Optional[str] = None) -> None:
+        if run_id is None:
+            self.run_id = generate_run_id()
+        else:
+            self.run_id = run_id
+
+        self._suites = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def suite(self) -> SuiteTagger:
+        """Return the tagger for the next suite."""
+        with self._lock:
+            return SuiteTagger(self.run_id, next(self._suites))
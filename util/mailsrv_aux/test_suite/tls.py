@@ -0,0 +1,185 @@
+# SPDX-FileCopyrightText: 2022 Mischback
+# SPDX-License-Identifier: MIT
+# SPDX-FileType: SOURCE
+
+"""Provide a client-side TLS context that resumes sessions.
+
+``smtplib`` and ``poplib`` perform a full TLS handshake on a fresh context for
+every STARTTLS / STLS command. ``TlsSessionContext`` is meant to be shared
+between all test suites of a run: it remembers the last session per target
+(IP and port) and offers it to the server on the next handshake. The
+handshakes are timed and the statistics show, if the server's session cache
+is actually effective.
+"""
+
+# Python imports
+import logging
+import socket
+import ssl
+import threading
+import time
+from typing import Any, Optional, Union
+
+# local imports
+from ..common.log import add_level
+from .metrics import LatencyRecorder
+
+# get a module-level logger
+logger = logging.getLogger(__name__)
+
+# add VERBOSE / SUMMARY log levels
+add_level("VERBOSE", logging.INFO - 1)
+add_level("SUMMARY", logging.INFO + 1)
+
+
+class TlsHandshakeStats:
+    """Track the duration of full and resumed TLS handshakes.
+
+    Parameters
+    ----------
+    max_samples : int, optional
+        Passed to the ``LatencyRecorder`` instances (default: ``None``, keep
+        all samples).
+    """
+
+    def __init__(self, max_samples: Optional[int] = None) -> None:
+        self.full = LatencyRecorder("full handshakes", max_samples=max_samples)
+        self.resumed = LatencyRecorder("resumed handshakes", max_samples=max_samples)
+        # Number of handshakes, where a cached session was offered
+        self.offered = 0
+
+    def record(self, reused: bool, duration: float, offered: bool) -> None:
+        """Record a single handshake."""
+        if reused:
+            self.resumed.add(duration)
+        else:
+            self.full.add(duration)
+
+        if offered:
+            self.offered += 1
+
+    @property
+    def hit_rate(self) -> Optional[float]:
+        """Return the ratio of resumed handshakes to offered sessions."""
+        if self.offered == 0:
+            return None
+        return self.resumed.count / self.offered
+
+    def __str__(self) -> str:  # noqa: D105
+        hit_rate = self.hit_rate
+        return "TLS handshakes: {} full, {} resumed (resumption hit rate: {})".format(
+            self.full.count,
+            self.resumed.count,
+            "n/a" if hit_rate is None else "{:.1%}".format(hit_rate),
+        )
+
+
+class TlsSessionContext(ssl.SSLContext):
+    """A ``SSLContext`` that caches and re-offers TLS sessions.
+
+    The context may be passed to ``smtplib.SMTP.starttls()`` and
+    ``poplib.POP3.stls()``, as both just call ``wrap_socket()``. Sessions are
+    cached by the peer's address, so port 25 and port 587 are handled
+    independently.
+
+    The context is created with ``ssl.PROTOCOL_TLS_CLIENT``, but hostname
+    checking and certificate verification are disabled, just like
+    ``smtplib``'s default context. The SUT is expected to use a self-signed
+    certificate during development.
+
+    Notes
+    -----
+    With TLS 1.3 the server sends its session tickets *after* the handshake,
+    so the session is not stored by ``wrap_socket()``. The suites store it
+    after the first read on the connection, see ``remember_session()``.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        self.check_hostname = False
+        self.verify_mode = ssl.CERT_NONE
+
+        self.stats = TlsHandshakeStats()
+        self._sessions: dict[Any, ssl.SSLSession] = {}
+        self._lock = threading.Lock()
+
+    def _session_key(self, sock: socket.socket) -> Any:
+        try:
+            return sock.getpeername()[:2]
+        except OSError:
+            return None
+
+    def remember_session(self, sock: Optional[socket.socket]) -> None:
+        """Store the session of an established TLS connection for re-use."""
+        if not isinstance(sock, ssl.SSLSocket) or sock.session is None:
+            return
+
+        key = self._session_key(sock)
+        if key is None:
+            return
+
+        with self._lock:
+            self._sessions[key] = sock.session
+
+    def wrap_socket(  # noqa: D102
+        self,
+        sock: socket.socket,
+        server_side: bool = False,
+        do_handshake_on_connect: bool = True,
+        suppress_ragged_eofs: bool = True,
+        server_hostname: Optional[Union[str, bytes]] = None,
+        session: Optional[ssl.SSLSession] = None,
+    ) -> ssl.SSLSocket:
+        if session is None and not server_side:
+            with self._lock:
+                session = self._sessions.get(self._session_key(sock), None)
+
+        tls_sock = super().wrap_socket(
+            sock,
+            server_side=server_side,
+            do_handshake_on_connect=False,
+            suppress_ragged_eofs=suppress_ragged_eofs,
+            server_hostname=server_hostname,
+            session=session,
+        )
+
+        if do_handshake_on_connect:
+            start = time.perf_counter()
+            tls_sock.do_handshake()
+            duration = time.perf_counter() - start
+
+            with self._lock:
+                self.stats.record(
+                    bool(tls_sock.session_reused), duration, session is not None
+                )
+            logger.debug(
+                "TLS handshake (%s) in %.1fms, session reused: %s",
+                tls_sock.version(),
+                duration * 1000,
+                tls_sock.session_reused,
+            )
+
+        return tls_sock
+
+
+def create_session_context(max_samples: Optional[int] = None) -> TlsSessionContext:
+    """Return a ``TlsSessionContext``, ready to be shared between suites.
+
+    Parameters
+    ----------
+    max_samples : int, optional
+        Limit the memory of the handshake statistics, see
+        ``LatencyRecorder`` (default: ``None``, keep all samples).
+    """
+    context = TlsSessionContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.stats = TlsHandshakeStats(max_samples=max_samples)
+    return context
+
+
+def log_handshake_stats(context: Optional[ssl.SSLContext]) -> None:
+    """Log the handshake statistics of a ``TlsSessionContext``."""
+    if not isinstance(context, TlsSessionContext):
+        return
+
+    logger.summary("%s", context.stats)  # type: ignore [attr-defined]
+    logger.verbose("%s", context.stats.full)  # type: ignore [attr-defined]
+    logger.verbose("%s", context.stats.resumed)  # type: ignore [attr-defined]
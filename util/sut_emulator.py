@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2022 Mischback
+# SPDX-License-Identifier: MIT
+# SPDX-FileType: SOURCE
+
+"""Run an emulated SUT on the loopback interface.
+
+The emulator accepts and rejects mails according to the test configuration
+and keeps the delivered messages in memory. The test suite may be run
+against it, using the ``--*-port`` options of ``test_runner.py``.
+"""
+
+
+# Python imports
+import argparse
+import logging
+import logging.config
+import os
+import sys
+
+# app imports
+from mailsrv_aux.common.exceptions import MailsrvBaseException
+from mailsrv_aux.common.log import LOGGING_DEFAULT_CONFIG, add_level
+from mailsrv_aux.emulator.config import SutConfig
+from mailsrv_aux.emulator.server import SutEmulator
+from mailsrv_aux.emulator.session import create_server_context
+
+# get a module-level logger
+logger = logging.getLogger()
+
+# add the VERBOSE / SUMMARY log levels
+add_level("VERBOSE", logging.INFO - 1)
+add_level("SUMMARY", logging.INFO + 1)
+
+
+if __name__ == "__main__":
+    # setup the logging module
+    logging.config.dictConfig(LOGGING_DEFAULT_CONFIG)
+
+    # find the script's path
+    my_dir = os.path.dirname(os.path.realpath(__file__))
+    test_config_dir = os.path.join(my_dir, "test_configs")
+
+    # prepare the argument parser
+    arg_parser = argparse.ArgumentParser(
+        description="Run an emulated mail server setup on the loopback interface"
+    )
+
+    # optional arguments (keyword arguments)
+    arg_parser.add_argument(
+        "-d", "--debug", action="store_true", help="Enable debug messages"
+    )
+    arg_parser.add_argument(
+        "-v",
+        "--verbose",
+        action="count",
+        default=0,
+        help="Be more verbose; may be specified up to two times",
+    )
+
+    arg_parser.add_argument(
+        "--host",
+        action="store",
+        default="127.0.0.1",
+        help="The address to listen on (default: 127.0.0.1)",
+    )
+    arg_parser.add_argument(
+        "--smtp-port",
+        action="store",
+        default=2525,
+        type=int,
+        help="The port of the SMTP service (default: 2525)",
+    )
+    arg_parser.add_argument(
+        "--submission-port",
+        action="store",
+        default=2587,
+        type=int,
+        help="The port of the submission service (default: 2587)",
+    )
+    arg_parser.add_argument(
+        "--pop3-port",
+        action="store",
+        default=2110,
+        type=int,
+        help="The port of the POP3 service (default: 2110)",
+    )
+    arg_parser.add_argument(
+        "--lmtp-port",
+        action="store",
+        default=2024,
+        type=int,
+        help="The port of the LMTP service (default: 2024)",
+    )
+    arg_parser.add_argument(
+        "--command-latency",
+        action="store",
+        default=0.0,
+        type=float,
+        help="Delay every reply by this number of seconds (default: 0)",
+    )
+    arg_parser.add_argument(
+        "--delivery-delay",
+        action="store",
+        default=0.0,
+        type=float,
+        help="Delay the delivery of accepted mails by this number of seconds (default: 0)",
+    )
+    arg_parser.add_argument(
+        "--message-size-limit",
+        action="store",
+        default=10240000,
+        type=int,
+        help="Reject messages larger than this number of bytes (default: 10240000)",
+    )
+    arg_parser.add_argument(
+        "--hostname",
+        action="store",
+        default="mail.sut.test",
+        help="The hostname used in greetings and the generated certificate",
+    )
+    arg_parser.add_argument(
+        "--tls-cert",
+        action="store",
+        default=None,
+        help="The TLS certificate (default: generate a self-signed certificate)",
+    )
+    arg_parser.add_argument(
+        "--tls-key",
+        action="store",
+        default=None,
+        help="The private key of the TLS certificate",
+    )
+
+    # provide overrides for the test config files
+    arg_parser.add_argument(
+        "--dovecot-userdb",
+        action="store",
+        default=os.path.join(test_config_dir, "dovecot_vmail_users"),
+        help="Specify a Dovecot user database file (passwd-like file)",
+    )
+    arg_parser.add_argument(
+        "--postfix-vmailboxes",
+        action="store",
+        default=os.path.join(test_config_dir, "postfix_vmailboxes"),
+        help="Specify a Postfix virtual mailbox file",
+    )
+    arg_parser.add_argument(
+        "--postfix-valiases",
+        action="store",
+        default=os.path.join(test_config_dir, "postfix_valiases"),
+        help="Specify a Postfix virtual alias file",
+    )
+    arg_parser.add_argument(
+        "--postfix-vdomains",
+        action="store",
+        default=os.path.join(test_config_dir, "postfix_vdomains"),
+        help="Specify a Postfix virtual domain file",
+    )
+    arg_parser.add_argument(
+        "--postfix-sendermap",
+        action="store",
+        default=os.path.join(test_config_dir, "postfix_sender-login-map"),
+        help="Specify the Postfix sender to login map file",
+    )
+
+    args = arg_parser.parse_args()
+
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+        logger.debug("DEBUG messages enabled")
+    elif args.verbose == 1:
+        logger.setLevel(logging.INFO)
+    elif args.verbose == 2:
+        logger.setLevel(logging.VERBOSE)  # type: ignore [attr-defined]
+        logger.verbose("Verbose logging enabled")  # type: ignore [attr-defined]
+
+    try:
+        config = SutConfig.from_files(
+            args.dovecot_userdb,
+            args.postfix_vmailboxes,
+            args.postfix_valiases,
+            args.postfix_vdomains,
+            args.postfix_sendermap,
+            hostname=args.hostname,
+            message_size_limit=args.message_size_limit,
+        )
+
+        SutEmulator(
+            config,
+            tls_context=create_server_context(
+                args.tls_cert, args.tls_key, hostname=args.hostname
+            ),
+            host=args.host,
+            smtp_port=args.smtp_port,
+            submission_port=args.submission_port,
+            pop3_port=args.pop3_port,
+            lmtp_port=args.lmtp_port,
+            command_latency=args.command_latency,
+            delivery_delay=args.delivery_delay,
+        ).run()
+    except MailsrvBaseException as e:
+        logger.critical("Execution failed!")
+        logger.debug(e, exc_info=True)  # noqa: G200
+        sys.exit(1)
+    except OSError as e:
+        logger.critical("Could not start the emulator: %s", e.strerror)
+        logger.debug(e, exc_info=True)  # noqa: G200
+        sys.exit(1)
+
+    sys.exit(0)
@@ -13,21 +13,69 @@ import collections
 import logging
 import logging.config
 import os
+import ssl
 import sys
-from typing import Any
+import tempfile
+from typing import Any, Optional
 
 # app imports
 from mailsrv_aux.common import parser
 from mailsrv_aux.common.exceptions import MailsrvBaseException, MailsrvIOException
 from mailsrv_aux.common.log import LOGGING_DEFAULT_CONFIG, add_level
 from mailsrv_aux.common.parser import PostfixAliasResolver
-from mailsrv_aux.test_suite.pop3 import NoNonSecureAuth, VerifyMailGotDelivered
+from mailsrv_aux.test_suite.canary import (
+    DEFAULT_WINDOW,
+    CanaryRunner,
+    select_canary_paths,
+)
+from mailsrv_aux.test_suite.cleanup import (
+    ImapCleanupMailbox,
+    Pop3CleanupMailbox,
+    cleanup_mailboxes,
+)
+from mailsrv_aux.test_suite.eventlog import EventLog
+from mailsrv_aux.test_suite.imap import ImapVerifyMailGotDelivered
+from mailsrv_aux.test_suite.latency import (
+    DeliveryLatencyPoller,
+    log_latency_report,
+    map_deliveries,
+)
+from mailsrv_aux.test_suite.maildir import (
+    DEFAULT_HOME_TEMPLATE,
+    MaildirVerifyMailGotDelivered,
+    expand_home,
+)
+from mailsrv_aux.test_suite.metrics import LatencyRecorder, LatencySlo
+from mailsrv_aux.test_suite.openmetrics import MetricsRegistry
+from mailsrv_aux.test_suite.parallel import run_smtp_suites, verify_mailboxes
+from mailsrv_aux.test_suite.planner import DeliveryPlanner
+from mailsrv_aux.test_suite.pop3 import (
+    NoNonSecureAuth,
+    Pop3GenericTestSuite,
+    UidlCache,
+    VerifyMailGotDelivered,
+)
 from mailsrv_aux.test_suite.protocols import SmtpTestProtocol
+from mailsrv_aux.test_suite.sampling import RecipientSampler
+from mailsrv_aux.test_suite.scenario import (
+    RCPT_ALIAS,
+    RCPT_INVALID,
+    RCPT_MAILBOX,
+    RCPT_RELAY,
+    Scenario,
+    ScenarioRunner,
+)
 from mailsrv_aux.test_suite.smtp import (
     OtherMtaTestSuite,
     OtherMtaTlsTestSuite,
     SubmissionTestSuite,
 )
+from mailsrv_aux.test_suite.tagging import RunTagger, tag_run_id
+from mailsrv_aux.test_suite.tls import (
+    TlsSessionContext,
+    create_session_context,
+    log_handshake_stats,
+)
 
 # get a module-level logger
 logger = logging.getLogger()
@@ -42,46 +90,13 @@ def get_password_plain(
     userdb: parser.PasswdFileParser,
 ) -> str:
     """Return plain text passwords from userdb."""
-    ret = userdb.get_password(username)
+    ret = userdb.get_plain_password(username)
 
-    if "{plain}" not in ret:
+    if ret is None:
         logger.error("Did not find plain text password")
         return ""
 
-    return ret.removeprefix("{plain}")
-
-
-def map_mails_to_mailboxes(
-    smtp_protocol: SmtpTestProtocol,
-    postfix_vmailboxes: list[str],
-    postfix_valiases: dict[str, list[str]],
-    postfix_vdomains: list[str],
-) -> dict[str, list[str]]:
-    """Map the mails to actual mailboxes."""
-    resolved_aliases, _, _ = PostfixAliasResolver(
-        postfix_vmailboxes, postfix_valiases, postfix_vdomains
-    ).resolve()
-
-    logger.debug("smtp protocol: %r", smtp_protocol)
-    logger.debug("resolved aliases: %r", resolved_aliases)
-
-    result: dict[str, list[str]] = collections.defaultdict(list)
-
-    aliases = resolved_aliases.keys()
-    for rcpt in smtp_protocol._accepted.keys():
-        if rcpt in postfix_vmailboxes:
-            logger.debug("Found RCPT with mailbox: %s", rcpt)
-            result[rcpt] += smtp_protocol._accepted[rcpt]
-
-        if rcpt in aliases:
-            logger.debug("Fount RCPT as alias: %s", rcpt)
-
-            for alias_target in resolved_aliases[rcpt]:
-                result[alias_target] += smtp_protocol._accepted[rcpt]
-
-    logger.debug("Result: %r", dict(result))
-
-    return dict(result)
+    return ret
 
 
 def map_logins_to_aliases(
@@ -101,6 +116,247 @@ def map_logins_to_aliases(
     return dict(result)
 
 
+def queue_test_mails(
+    args: argparse.Namespace,
+    postfix_addresses: list[str],
+    invalid_recipient: str,
+    postfix_sendermap: dict[str, list[str]],
+    dovecot_passwd: parser.PasswdFileParser,
+    tls_context: Optional[ssl.SSLContext],
+    event_log: Optional[EventLog],
+    slos: list[LatencySlo],
+    metrics: Optional[MetricsRegistry],
+) -> SmtpTestProtocol:
+    """Queue the test mails, using the SMTP suites."""
+    # All mails of the run are tagged with the run ID, every suite gets
+    # its own tagger. The tags are used as subjects.
+    run_tagger = RunTagger()
+    logger.summary("Run ID: %s", run_tagger.run_id)  # type: ignore [attr-defined]
+
+    # Queue some mails to the mailserver (non-secure)
+    suite: Any = OtherMtaTestSuite(
+        valid_recipients=postfix_addresses,
+        invalid_recipients=[invalid_recipient],
+        target_ip=args.target_host,
+        target_port=args.smtp_port,
+        tagger=run_tagger.suite(),
+        event_log=event_log,
+        timeout=args.timeout,
+        slos=slos,
+    )
+    overall_result: SmtpTestProtocol = suite.run()
+    if metrics is not None:
+        metrics.record_smtp_suite(suite)
+
+    # Queue some more mails to the mailserver (using STARTTLS)
+    suite = OtherMtaTlsTestSuite(
+        valid_recipients=postfix_addresses,
+        invalid_recipients=[invalid_recipient],
+        target_ip=args.target_host,
+        target_port=args.smtp_port,
+        tagger=run_tagger.suite(),
+        event_log=event_log,
+        tls_context=tls_context,
+        timeout=args.timeout,
+        slos=slos,
+    )
+    overall_result += suite.run()
+    if metrics is not None:
+        metrics.record_smtp_suite(suite)
+
+    mapped_aliases = map_logins_to_aliases(postfix_sendermap)
+
+    # The submission suites are run concurrently. As every suite has its
+    # own tagger, the subjects do not depend on the order of execution.
+    submission_suites = [
+        SubmissionTestSuite(
+            username=account,
+            password=get_password_plain(account, dovecot_passwd),
+            valid_from=mapped_aliases[account],
+            target_ip=args.target_host,
+            target_port=args.submission_port,
+            suite_name="Submission Test Suite ({})".format(account),
+            tagger=run_tagger.suite(),
+            event_log=event_log,
+            tls_context=tls_context,
+            timeout=args.timeout,
+            slos=slos,
+        )
+        for account in mapped_aliases
+    ]
+    overall_result += run_smtp_suites(submission_suites, max_workers=args.workers)
+    if metrics is not None:
+        for suite in submission_suites:
+            metrics.record_smtp_suite(suite)
+
+    return overall_result
+
+
+def run_scenario(
+    args: argparse.Namespace,
+    postfix_vmailboxes: list[str],
+    postfix_valiases: dict[str, list[str]],
+    invalid_recipient: str,
+    postfix_sendermap: dict[str, list[str]],
+    dovecot_passwd: parser.PasswdFileParser,
+    tls_context: Optional[ssl.SSLContext],
+    slos: list[LatencySlo],
+    metrics: Optional[MetricsRegistry],
+) -> SmtpTestProtocol:
+    """Send the test mails following the phases of a scenario file."""
+    scenario = Scenario.from_file(args.scenario)
+
+    mapped_aliases = map_logins_to_aliases(postfix_sendermap)
+    submission_accounts = [
+        (account, get_password_plain(account, dovecot_passwd), senders[0])
+        for account, senders in mapped_aliases.items()
+    ]
+
+    # The events of long phases must not be kept in memory
+    event_log_path = args.event_log
+    if event_log_path is None:
+        handle, event_log_path = tempfile.mkstemp(
+            prefix="mailsrv-scenario-", suffix=".jsonl"
+        )
+        os.close(handle)
+    logger.summary("Writing the events to '%s'", event_log_path)  # type: ignore [attr-defined]
+
+    event_log = EventLog(event_log_path)
+    try:
+        runner = ScenarioRunner(
+            scenario,
+            {
+                RCPT_MAILBOX: postfix_vmailboxes,
+                RCPT_ALIAS: list(postfix_valiases.keys()),
+                RCPT_INVALID: [invalid_recipient],
+                RCPT_RELAY: ["relay@another-host.test"],
+            },
+            event_log,
+            submission_accounts=submission_accounts,
+            target_ip=args.target_host,
+            smtp_port=args.smtp_port,
+            submission_port=args.submission_port,
+            tls_context=tls_context,
+            timeout=args.timeout,
+            slos=slos,
+        )
+        protocol = runner.run()
+    finally:
+        event_log.close()
+
+    if metrics is not None:
+        suite_name = "Scenario '{}'".format(scenario.name)
+        target = "{}:{}".format(args.target_host, args.smtp_port)
+        metrics.record_messages(suite_name, target, protocol)
+        metrics.record_commands("smtp", suite_name, target, runner.command_latency)
+
+    return protocol
+
+
+def run_canary(
+    args: argparse.Namespace,
+    postfix_vmailboxes: list[str],
+    postfix_valiases: dict[str, list[str]],
+    postfix_vdomains: list[str],
+    postfix_sendermap: dict[str, list[str]],
+    dovecot_passwd: parser.PasswdFileParser,
+    tls_context: Optional[ssl.SSLContext],
+    metrics: Optional[MetricsRegistry],
+) -> None:
+    """Probe the delivery paths until interrupted."""
+    resolved_aliases, _, external_aliases = PostfixAliasResolver(
+        postfix_vmailboxes, postfix_valiases, postfix_vdomains
+    ).resolve()
+
+    paths = select_canary_paths(
+        postfix_vmailboxes,
+        resolved_aliases,
+        external_aliases or {},
+        map_logins_to_aliases(postfix_sendermap),
+        dovecot_passwd.get_usernames(),
+    )
+    mailboxes = set()
+    for path in paths:
+        mailboxes.update(path.mailboxes)
+        if path.username is not None:
+            path.password = get_password_plain(path.username, dovecot_passwd)
+
+    CanaryRunner(
+        paths,
+        {mailbox: get_password_plain(mailbox, dovecot_passwd) for mailbox in mailboxes},
+        target_ip=args.target_host,
+        smtp_port=args.smtp_port,
+        submission_port=args.submission_port,
+        pop3_port=args.pop3_port,
+        tls_context=tls_context,
+        timeout=args.timeout,
+        interval=args.canary_interval,
+        probe_timeout=args.canary_timeout,
+        metrics=metrics,
+        metrics_file=args.metrics_file,
+        cycles=args.canary_cycles,
+    ).run()
+
+
+def run_cleanup(
+    args: argparse.Namespace,
+    mailboxes: list[str],
+    protocol: SmtpTestProtocol,
+    dovecot_passwd: parser.PasswdFileParser,
+    tls_context: Optional[ssl.SSLContext],
+    uidl_cache: UidlCache,
+    metrics: Optional[MetricsRegistry],
+) -> None:
+    """Delete the mails of the run from the mailboxes."""
+    run_ids = sorted(
+        {
+            tag_run_id(tag)
+            for subjects in protocol.get_accepted().values()
+            for tag in subjects
+        }
+    )
+    logger.debug("Cleaning up run(s) %r", run_ids)
+
+    suites: list[Any] = []
+    for mailbox in mailboxes:
+        if args.imap:
+            suites.append(
+                ImapCleanupMailbox(
+                    target_ip=args.target_host,
+                    target_port=args.imap_port,
+                    username=mailbox,
+                    password=get_password_plain(mailbox, dovecot_passwd),
+                    run_ids=run_ids,
+                    suite_name="Cleanup Mailbox Test Suite (IMAP, {})".format(mailbox),
+                    tls_context=tls_context,
+                    timeout=args.timeout,
+                )
+            )
+            continue
+
+        suites.append(
+            Pop3CleanupMailbox(
+                target_ip=args.target_host,
+                target_port=args.pop3_port,
+                username=mailbox,
+                password=get_password_plain(mailbox, dovecot_passwd),
+                run_ids=run_ids,
+                suite_name="Cleanup Mailbox Test Suite ({})".format(mailbox),
+                uidl_cache=uidl_cache,
+                tls_context=tls_context,
+                timeout=args.timeout,
+            )
+        )
+
+    try:
+        messages, reclaimed = cleanup_mailboxes(suites, max_workers=args.workers)
+    finally:
+        uidl_cache.save()
+
+    if metrics is not None:
+        metrics.record_cleanup(messages, reclaimed, args.target_host)
+
+
 if __name__ == "__main__":
     # setup the logging module
     logging.config.dictConfig(LOGGING_DEFAULT_CONFIG)
@@ -137,6 +393,201 @@ if __name__ == "__main__":
         help="Be more verbose; may be specified up to two times",
     )
 
+    arg_parser.add_argument(
+        "--smtp-port",
+        action="store",
+        default=25,
+        type=int,
+        help="The port of the SMTP service (default: 25)",
+    )
+    arg_parser.add_argument(
+        "--submission-port",
+        action="store",
+        default=587,
+        type=int,
+        help="The port of the submission service (default: 587)",
+    )
+    arg_parser.add_argument(
+        "--pop3-port",
+        action="store",
+        default=110,
+        type=int,
+        help="The port of the POP3 service (default: 110)",
+    )
+    arg_parser.add_argument(
+        "--imap-port",
+        action="store",
+        default=143,
+        type=int,
+        help="The port of the IMAP service, used with --imap (default: 143)",
+    )
+
+    arg_parser.add_argument(
+        "--timeout",
+        action="store",
+        default=30.0,
+        type=float,
+        help="The timeout of every network operation in seconds (default: 30)",
+    )
+    arg_parser.add_argument(
+        "--slo",
+        action="append",
+        default=[],
+        help=(
+            "Fail the run, if a latency violates this SLO, e.g. 'p99 RCPT < 200ms' "
+            "or 'p95 delivery < 5s'; may be specified several times"
+        ),
+    )
+
+    arg_parser.add_argument(
+        "-w",
+        "--workers",
+        action="store",
+        default=8,
+        type=int,
+        help="Maximum number of concurrent connections (default: 8)",
+    )
+    arg_parser.add_argument(
+        "--no-tls-resumption",
+        action="store_true",
+        help="Perform a full TLS handshake on every connection",
+    )
+
+    arg_parser.add_argument(
+        "--uidl-cache",
+        action="store",
+        default=None,
+        help="Keep the subjects of already seen messages in this file",
+    )
+
+    arg_parser.add_argument(
+        "--imap",
+        action="store_true",
+        help="Verify the delivered mails using IMAP's SEARCH instead of POP3",
+    )
+    arg_parser.add_argument(
+        "--maildir",
+        action="store",
+        nargs="?",
+        const=DEFAULT_HOME_TEMPLATE,
+        default=None,
+        metavar="HOME_TEMPLATE",
+        help="Verify the delivered mails by reading the Maildirs on this host; "
+        "homes without userdb entry are derived from HOME_TEMPLATE "
+        "(default: {})".format(DEFAULT_HOME_TEMPLATE.replace("%", "%%")),
+    )
+    arg_parser.add_argument(
+        "--maildir-index",
+        action="store",
+        default=None,
+        help="Keep the tags of already seen Maildir messages in this file",
+    )
+
+    arg_parser.add_argument(
+        "--sample-size",
+        action="store",
+        default=None,
+        type=int,
+        help="Send mails to a stratified sample of this many addresses only",
+    )
+    arg_parser.add_argument(
+        "--sample-seed",
+        action="store",
+        default=0,
+        type=int,
+        help="The seed of the recipient sample (default: 0)",
+    )
+    arg_parser.add_argument(
+        "--cleanup",
+        action="store_true",
+        help="Delete the mails of this run from the mailboxes after the verification",
+    )
+    arg_parser.add_argument(
+        "--delivery-latency",
+        action="store_true",
+        help="Poll the mailboxes until all mails are delivered and report the latency",
+    )
+    arg_parser.add_argument(
+        "--latency-timeout",
+        action="store",
+        default=300.0,
+        type=float,
+        help="Stop polling the mailboxes after this number of seconds (default: 300)",
+    )
+
+    arg_parser.add_argument(
+        "--metrics-file",
+        action="store",
+        default=None,
+        help=(
+            "Write the metrics of the run to this file (OpenMetrics text format, "
+            "e.g. for the textfile collector of the node exporter)"
+        ),
+    )
+
+    arg_parser.add_argument(
+        "--metrics-port",
+        action="store",
+        default=None,
+        type=int,
+        help="Serve the metrics on http://127.0.0.1:<port>/metrics",
+    )
+
+    arg_parser.add_argument(
+        "--canary",
+        action="store_true",
+        help=(
+            "Run indefinitely, sending a probe through every delivery path per "
+            "interval and reporting the round-trip latency"
+        ),
+    )
+    arg_parser.add_argument(
+        "--canary-interval",
+        action="store",
+        default=60.0,
+        type=float,
+        help="The interval between the canary's probes in seconds (default: 60)",
+    )
+    arg_parser.add_argument(
+        "--canary-timeout",
+        action="store",
+        default=300.0,
+        type=float,
+        help="Consider a probe lost after this number of seconds (default: 300)",
+    )
+    arg_parser.add_argument(
+        "--canary-cycles",
+        action="store",
+        default=None,
+        type=int,
+        help="Stop the canary after this number of intervals (default: run forever)",
+    )
+
+    arg_parser.add_argument(
+        "--event-log",
+        action="store",
+        default=None,
+        help="Write the events of the SMTP suites to this file (JSON lines)",
+    )
+    arg_parser.add_argument(
+        "--scenario",
+        action="store",
+        default=None,
+        help="Send the mails following the phases of this scenario file (TOML)",
+    )
+    arg_parser.add_argument(
+        "--resume",
+        action="store",
+        default=None,
+        help="Do not send mails, but verify the mails of a previous run's event log",
+    )
+    arg_parser.add_argument(
+        "--resume-run-id",
+        action="store",
+        default=None,
+        help="The ID of the run to verify with --resume (default: the last run of the log)",
+    )
+
     # provide overrides for the test config files
     arg_parser.add_argument(
         "--dovecot-userdb",
@@ -180,7 +631,19 @@ if __name__ == "__main__":
         logger.setLevel(logging.VERBOSE)  # type: ignore [attr-defined]
         logger.verbose("Verbose logging enabled")  # type: ignore [attr-defined]
 
+    metrics = None
+    if args.metrics_file is not None or args.metrics_port is not None:
+        metrics = MetricsRegistry()
+    success = False
+    tls_context: Optional[ssl.SSLContext] = None
+    slos: list[LatencySlo] = []
+
     try:
+        slos = [LatencySlo.parse(spec) for spec in args.slo]
+
+        if metrics is not None and args.metrics_port is not None:
+            metrics.serve(port=args.metrics_port)
+
         try:
             # Read and parse the configuration files
             logger.verbose("Reading configuration files")  # type: ignore [attr-defined]
@@ -224,34 +687,77 @@ if __name__ == "__main__":
             logger.error("Could not read config files")
             raise e
 
-        # Queue some mails to the mailserver (non-secure)
-        suite: Any = OtherMtaTestSuite(
-            valid_recipients=postfix_addresses,
-            invalid_recipients=[invalid_recipient],
-            target_ip=args.target_host,
-        )
-        overall_result = suite.run()
-
-        # Queue some more mails to the mailserver (using STARTTLS)
-        suite = OtherMtaTlsTestSuite(
-            valid_recipients=postfix_addresses,
-            invalid_recipients=[invalid_recipient],
-            target_ip=args.target_host,
-            mail_count_offset=overall_result.get_mail_count(),
-        )
-        overall_result += suite.run()
-
-        mapped_aliases = map_logins_to_aliases(postfix_sendermap)
+        # All suites share one TLS context, which resumes TLS sessions
+        if args.no_tls_resumption:
+            tls_context = None
+        else:
+            # The canary runs for months, so only the recent handshakes are
+            # kept
+            tls_context = create_session_context(
+                max_samples=DEFAULT_WINDOW if args.canary else None
+            )
 
-        for account in mapped_aliases:
-            suite = SubmissionTestSuite(
-                username=account,
-                password=get_password_plain(account, dovecot_passwd),
-                valid_from=mapped_aliases[account],
-                target_ip=args.target_host,
-                mail_count_offset=overall_result.get_mail_count(),
+        if args.canary:
+            run_canary(
+                args,
+                postfix_vmailboxes,
+                postfix_valiases,
+                postfix_vdomains,
+                postfix_sendermap,
+                dovecot_passwd,
+                tls_context,
+                metrics,
+            )
+            success = True
+            sys.exit(0)
+
+        if args.resume is not None:
+            # Skip sending, verify the mails of a previous run
+            logger.summary("Resuming from event log '%s'", args.resume)  # type: ignore [attr-defined]
+            overall_result = SmtpTestProtocol.from_event_log(
+                args.resume, run_id=args.resume_run_id
             )
-            overall_result += suite.run()
+        elif args.scenario is not None:
+            # Replace the fixed sequence of suites by the scenario's phases
+            overall_result = run_scenario(
+                args,
+                postfix_vmailboxes,
+                postfix_valiases,
+                invalid_recipient,
+                postfix_sendermap,
+                dovecot_passwd,
+                tls_context,
+                slos,
+                metrics,
+            )
+        else:
+            if args.sample_size is not None:
+                # Send the mails to a stratified sample of the addresses only
+                postfix_addresses = RecipientSampler(
+                    postfix_vmailboxes,
+                    postfix_valiases,
+                    postfix_vdomains,
+                    list(map_logins_to_aliases(postfix_sendermap)),
+                    seed=args.sample_seed,
+                ).sample(args.sample_size)
+                logger.debug("Sampled addresses: %r", postfix_addresses)
+
+            event_log = None if args.event_log is None else EventLog(args.event_log)
+            try:
+                overall_result = queue_test_mails(
+                    args,
+                    postfix_addresses,
+                    invalid_recipient,
+                    postfix_sendermap,
+                    dovecot_passwd,
+                    tls_context,
+                    event_log,
+                    slos,
+                    metrics,
+                )
+            finally:
+                if event_log is not None:
+                    event_log.close()
 
         logger.info("Result: %s", overall_result)
         logger.debug("Result (detail): %r", overall_result)
@@ -260,35 +766,212 @@ if __name__ == "__main__":
         # performed over a secure connection (using STARTTLS)
         suite = NoNonSecureAuth(
             target_ip=args.target_host,
+            target_port=args.pop3_port,
+            timeout=args.timeout,
         )
         suite.run()
+        if metrics is not None:
+            metrics.record_pop3_suite(suite)
+
+        uidl_cache = UidlCache(args.uidl_cache)
+
+        resolved_aliases, _, _ = PostfixAliasResolver(
+            postfix_vmailboxes, postfix_valiases, postfix_vdomains
+        ).resolve()
+        logger.debug("resolved aliases: %r", resolved_aliases)
+
+        if args.delivery_latency:
+            # Poll the mailboxes until all mails are delivered, measuring the
+            # latency per delivery path.
+            deliveries = {
+                mailbox: expected
+                for mailbox, expected in map_deliveries(
+                    overall_result, postfix_vmailboxes, resolved_aliases
+                ).items()
+                if mailbox in dovecot_users
+            }
+            poller = DeliveryLatencyPoller(
+                deliveries,
+                overall_result,
+                {
+                    mailbox: get_password_plain(mailbox, dovecot_passwd)
+                    for mailbox in deliveries
+                },
+                target_ip=args.target_host,
+                target_port=args.pop3_port,
+                tls_context=tls_context,
+                uidl_cache=uidl_cache,
+                timeout=args.latency_timeout,
+                max_workers=args.workers,
+                pop3_timeout=args.timeout,
+            )
+            try:
+                latency_report = poller.run()
+            finally:
+                uidl_cache.save()
+
+            log_latency_report(latency_report)
+            log_handshake_stats(tls_context)
+            if metrics is not None:
+                metrics.record_delivery(
+                    latency_report, "{}:{}".format(args.target_host, args.pop3_port)
+                )
+            if not latency_report.complete:
+                raise Pop3GenericTestSuite.Pop3TestSuiteError(
+                    "Not all messages were delivered"
+                )
+
+            violations = latency_report.check_slos(slos)
+            for violation in violations:
+                logger.error("SLO violated: %s", violation)
+            if violations:
+                raise Pop3GenericTestSuite.Pop3SloViolation(
+                    "{} delivery SLO violation(s)".format(len(violations))
+                )
+
+            if args.cleanup:
+                run_cleanup(
+                    args,
+                    list(deliveries),
+                    overall_result,
+                    dovecot_passwd,
+                    tls_context,
+                    uidl_cache,
+                    metrics,
+                )
+
+            logger.summary("Test suite completed successfully!")  # type: ignore [attr-defined]
+            success = True
+            sys.exit(0)
 
         # Map the mails to mailboxes
         # This result is then used to verify the actual delivery of the
         # messages as required, using the POP3 protocol, see
-        # ``VerifyMailGotDelivered``
-        mapped_mails = map_mails_to_mailboxes(
-            overall_result, postfix_vmailboxes, postfix_valiases, postfix_vdomains
+        # ``VerifyMailGotDelivered`` (or IMAP, see ``ImapVerifyMailGotDelivered``)
+        mapped_mails = DeliveryPlanner(postfix_vmailboxes, resolved_aliases).plan(
+            overall_result
         )
         logger.debug("Mapped Mails: %r", mapped_mails)
 
+        # The mailboxes are checked concurrently; all missing messages are
+        # reported together.
+        verify_suites: list[Any] = []
+        maildir_index = UidlCache(args.maildir_index)
         for rcpt in mapped_mails:
             if rcpt not in dovecot_users:
                 logger.debug("Skipping mailbox check for '%s'", rcpt)
                 continue
 
-            logger.verbose("Checking mailbox of '%s'", rcpt)  # type: ignore [attr-defined]
-            suite = VerifyMailGotDelivered(
-                target_ip=args.target_host,
-                username=rcpt,
-                password=get_password_plain(rcpt, dovecot_passwd),
-                expected_messages=mapped_mails[rcpt],
+            if args.maildir is not None:
+                # Read the Maildirs directly (on the mail host)
+                home = dovecot_passwd.get_home(rcpt) or expand_home(args.maildir, rcpt)
+                verify_suites.append(
+                    MaildirVerifyMailGotDelivered(
+                        username=rcpt,
+                        maildir=os.path.join(home, "Maildir"),
+                        expected_messages=list(mapped_mails[rcpt].elements()),
+                        index=maildir_index,
+                        suite_name="Verify messages in Maildir Test Suite ({})".format(
+                            rcpt
+                        ),
+                    )
+                )
+                continue
+
+            if args.imap:
+                # Let the server search for the messages (using IMAP)
+                verify_suites.append(
+                    ImapVerifyMailGotDelivered(
+                        target_ip=args.target_host,
+                        target_port=args.imap_port,
+                        username=rcpt,
+                        password=get_password_plain(rcpt, dovecot_passwd),
+                        expected_messages=list(mapped_mails[rcpt].elements()),
+                        suite_name="Verify messages in Mailbox Test Suite (IMAP, {})".format(
+                            rcpt
+                        ),
+                        tls_context=tls_context,
+                        timeout=args.timeout,
+                        slos=slos,
+                    )
+                )
+                continue
+
+            verify_suites.append(
+                VerifyMailGotDelivered(
+                    target_ip=args.target_host,
+                    target_port=args.pop3_port,
+                    username=rcpt,
+                    password=get_password_plain(rcpt, dovecot_passwd),
+                    expected_messages=list(mapped_mails[rcpt].elements()),
+                    suite_name="Verify messages in Mailbox Test Suite ({})".format(
+                        rcpt
+                    ),
+                    uidl_cache=uidl_cache,
+                    tls_context=tls_context,
+                    timeout=args.timeout,
+                    slos=slos,
+                )
             )
-            suite.run()
+        try:
+            verify_mailboxes(verify_suites, max_workers=args.workers)
+        finally:
+            uidl_cache.save()
+            maildir_index.save()
+
+            if args.imap and args.maildir is None:
+                search_latency = LatencyRecorder("IMAP search")
+                for suite in verify_suites:
+                    search_latency.merge(suite.search_latency)
+                logger.summary("%s", search_latency)  # type: ignore [attr-defined]
+
+            if metrics is not None and args.maildir is None:
+                for suite in verify_suites:
+                    if args.imap:
+                        metrics.record_imap_suite(suite)
+                    else:
+                        metrics.record_pop3_suite(suite)
+
+        if args.cleanup:
+            # Only after a successful verification, so the mails of a failed
+            # run are available for inspection
+            run_cleanup(
+                args,
+                [suite.username for suite in verify_suites],
+                overall_result,
+                dovecot_passwd,
+                tls_context,
+                uidl_cache,
+                metrics,
+            )
+
+        log_handshake_stats(tls_context)
 
         logger.summary("Test suite completed successfully!")  # type: ignore [attr-defined]
+        success = True
         sys.exit(0)
     except MailsrvBaseException as e:
         logger.critical("Execution failed!")
         logger.debug(e, exc_info=True)  # noqa: G200
         sys.exit(1)
+    finally:
+        if success:
+            # Such an SLO always passes, e.g. because of a typo
+            for slo in slos:
+                if not slo.checked:
+                    logger.warning(
+                        "SLO '%s' was not checked, %s was never measured",
+                        slo,
+                        slo.operation,
+                    )
+
+        # The metrics are written for failed runs as well
+        if metrics is not None:
+            if isinstance(tls_context, TlsSessionContext):
+                metrics.record_tls(tls_context.stats, args.target_host)
+            metrics.record_run(success)
+            if args.metrics_file is not None:
+                try:
+                    metrics.write_textfile(args.metrics_file)
+                except MailsrvIOException:
+                    sys.exit(1)